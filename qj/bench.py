@@ -0,0 +1,489 @@
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks for qj's hot paths.
+
+Run like this:
+  python -m qj.bench                        # Print results as JSON.
+  python -m qj.bench --output base.json     # Save a baseline.
+  python -m qj.bench --compare base.json    # Flag regressions against it.
+
+Every scenario logs to a sink that discards its input, so the numbers measure
+qj's own overhead rather than the cost of the logging backend.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import re
+import sys
+import timeit
+
+from qj import qj
+
+
+_SCENARIOS = []
+
+
+def _scenario(calls_per_run, requires=None):
+  """Register a benchmark scenario.
+
+  The decorated function takes the number of runs and returns a function that
+  performs them. Setup happens in the outer function so it isn't timed.
+
+  Arguments:
+    calls_per_run: Number of qj calls (or wrapped calls) made in each run, used
+                   to report the time per call.
+    requires: Optional module name that must be importable for the scenario to
+              run. Scenarios with missing requirements are skipped.
+
+  Returns:
+    The decorator.
+  """
+  def register(fn):
+    _SCENARIOS.append((fn.__name__.lstrip('_'), fn, calls_per_run, requires))
+    return fn
+  return register
+
+
+def _sink(*_):
+  pass
+
+
+class _Settings(object):
+  """Swap in benchmark settings for qj and restore the originals afterwards."""
+
+  _NAMES = ('LOG', 'LOG_FN', 'STR_FN', 'MAX_FRAME_LOGS', 'COLOR', 'PREFIX')
+
+  def __init__(self, **overrides):
+    self._overrides = overrides
+    self._saved = {}
+
+  def __enter__(self):
+    for name in self._NAMES:
+      self._saved[name] = getattr(qj, name)
+    qj.LOG = True
+    qj.LOG_FN = _sink
+    qj.STR_FN = str
+    qj.MAX_FRAME_LOGS = sys.maxsize
+    qj.COLOR = True
+    qj.PREFIX = 'qj: '
+    for name, value in self._overrides.items():
+      setattr(qj, name, value)
+    return self
+
+  def __exit__(self, *_):
+    for name, value in self._saved.items():
+      setattr(qj, name, value)
+
+
+def _reset_label_caches(source=True):
+  """Forget extracted labels, and also the indexed source files if source."""
+  qj._FN_MAPS.clear()
+  if source:
+    qj._source_indexes.clear()
+
+
+###############################################################################
+# Scenarios
+###############################################################################
+@_scenario(calls_per_run=1)
+def _disabled_global(runs):
+  """qj.LOG = False."""
+  def run():
+    x = 1
+    with _Settings(LOG=False):
+      for _ in range(runs):
+        qj(x)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _logger_level_warning(runs):
+  """The 'qj' logger's level is above INFO."""
+  logger = qj._logger or __import__('logging').getLogger('qj')
+
+  def run():
+    x = 1
+    level = logger.level
+    with _Settings(LOG_FN=sys.modules[qj.__module__]._log):
+      logger.setLevel('WARNING')
+      try:
+        for _ in range(runs):
+          qj(x)
+      finally:
+        logger.setLevel(level)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _disabled_b(runs):
+  """qj(x, b=0)."""
+  def run():
+    x = 1
+    with _Settings():
+      for _ in range(runs):
+        qj(x, b=0)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _first_hit_label(runs):
+  """Label extraction for a site that has never logged before."""
+  def site(x):
+    return qj(x + 1)
+
+  def run():
+    with _Settings():
+      for _ in range(runs):
+        _reset_label_caches(source=False)
+        site(1)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _first_hit_label_cold(runs):
+  """Label extraction for the first site to log from its source file."""
+  def site(x):
+    return qj(x + 1)
+
+  def run():
+    with _Settings():
+      for _ in range(runs):
+        _reset_label_caches()
+        site(1)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _warm_log(runs):
+  """Repeated logging from the same site and stack frame."""
+  def run():
+    x = 1
+    with _Settings():
+      for _ in range(runs):
+        qj(x)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _warm_log_colored(runs):
+  """Repeated logging, including the default LOG_FN's color wrapping."""
+  def run():
+    x = 1
+    with _Settings(LOG_FN=qj._COLOR_FN):
+      for _ in range(runs):
+        qj(x)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _warm_log_new_frame(runs):
+  """Repeated logging from the same site, but in a new stack frame each time."""
+  def site(x):
+    return qj(x)
+
+  def run():
+    with _Settings():
+      for _ in range(runs):
+        site(1)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _warm_log_with_s(runs):
+  """Repeated logging from the same site with an explicit description."""
+  def run():
+    x = 1
+    with _Settings():
+      for _ in range(runs):
+        qj(x, 'x')
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _site_logger(runs):
+  """Repeated logging through a logger from qj.at."""
+  def run():
+    x = 1
+    with _Settings():
+      log = qj.at('x')
+      for _ in range(runs):
+        log(x)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _suppressed_after_limit(runs):
+  """Calls made after qj.MAX_FRAME_LOGS has been hit."""
+  def run():
+    x = 1
+    with _Settings(MAX_FRAME_LOGS=1):
+      for _ in range(runs):
+        qj(x)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _rate_meter(runs):
+  """Counting events with qj(x, rate_meter=...) between reports."""
+  def run():
+    x = 1
+    with _Settings():
+      for _ in range(runs):
+        qj(x, rate_meter=3600)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _agg(runs):
+  """Folding values into a summary with qj(x, agg=...) between reports."""
+  def run():
+    with _Settings():
+      for i in range(runs):
+        qj(i, agg=10**9)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _changed_repeat(runs):
+  """Repeated values with qj(x, changed=1)."""
+  def run():
+    x = 'polling'
+    with _Settings():
+      for _ in range(runs):
+        qj(x, changed=1)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _p_repeat(runs):
+  """Repeated qj(x, p=1) logs of objects of the same type."""
+  class Thing(object):
+
+    def method(self, a, b=None):
+      pass
+
+    @property
+    def prop(self):
+      return 1
+
+  def run():
+    x = Thing()
+    with _Settings():
+      for _ in range(runs):
+        qj(x, 'x', p=1)
+  return run
+
+
+@_scenario(calls_per_run=1, requires='numpy')
+def _n_large_array(runs):
+  """qj(arr, n=1) on a 1M element float array."""
+  np = __import__('numpy')
+  arr = np.random.RandomState(0).rand(1000, 1000)
+
+  def run():
+    with _Settings():
+      for _ in range(runs):
+        qj(arr, n=1)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _time_decorated_call(runs):
+  """Calling a function wrapped with @qj(time=...)."""
+  with _Settings():
+    @qj(time=10**9)
+    def foo():
+      pass
+
+  def run():
+    for _ in range(runs):
+      foo()
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _log_all_calls_create(runs):
+  """Wrapping an object with qj(x, log_all_calls=1)."""
+  def run():
+    s = 'abc'
+    with _Settings():
+      for _ in range(runs):
+        qj(s, 'wrap', log_all_calls=1)
+  return run
+
+
+@_scenario(calls_per_run=1)
+def _log_all_calls_method(runs):
+  """Calling a method on an object wrapped with log_all_calls."""
+  with _Settings():
+    s = qj('abc', 'wrap', log_all_calls=1)
+
+  def run():
+    with _Settings():
+      for _ in range(runs):
+        s.upper()
+  return run
+
+
+@_scenario(calls_per_run=100)
+def _comprehension(runs):
+  """Logging every element of a 100 element list comprehension."""
+  values = list(range(100))
+
+  def run():
+    with _Settings():
+      for _ in range(runs):
+        [qj(v * 2) for v in values]  # pylint: disable=expression-not-assigned
+  return run
+
+
+@_scenario(calls_per_run=100)
+def _batch(runs):
+  """Logging a 100 element list with qj.batch(values, limit=100)."""
+  values = list(range(100))
+
+  def run():
+    with _Settings():
+      for _ in range(runs):
+        qj.batch(values, 'values', limit=100)
+  return run
+
+
+###############################################################################
+# Running and comparing
+###############################################################################
+def run_benchmarks(pattern=None, repeat=5, min_time=0.1):
+  """Run the registered scenarios and collect their timings.
+
+  Arguments:
+    pattern: Optional regular expression. Only scenarios whose names match are
+             run.
+    repeat: Number of timed repetitions of each scenario. The reported numbers
+            are the minimum and median across repetitions.
+    min_time: Approximate minimum duration in seconds of each repetition. The
+              number of runs per repetition is calibrated to reach it.
+
+  Returns:
+    A JSON-serializable dict of results.
+  """
+  results = {}
+  for name, make_run, calls_per_run, requires in _SCENARIOS:
+    if pattern and not re.search(pattern, name):
+      continue
+    if requires:
+      try:
+        __import__(requires)
+      except ImportError:
+        results[name] = {'skipped': 'requires %s' % requires}
+        continue
+
+    runs = 1
+    while True:
+      elapsed = timeit.timeit(make_run(runs), number=1)
+      if elapsed >= min_time or runs >= 10**7:
+        break
+      runs *= 10 if elapsed < min_time / 10 else 2
+
+    times = sorted(timeit.timeit(make_run(runs), number=1)
+                   for _ in range(repeat))
+    calls = runs * calls_per_run
+    results[name] = {
+        'calls': calls,
+        'ns_per_call_min': times[0] / calls * 1e9,
+        'ns_per_call_median': times[len(times) // 2] / calls * 1e9,
+    }
+
+  return {
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+      'platform': platform.platform(),
+      'qj_version': qj.__version__,
+      'results': results,
+  }
+
+
+def compare(baseline, current, threshold=0.25):
+  """Compare two benchmark reports.
+
+  Arguments:
+    baseline: A report previously returned by run_benchmarks.
+    current: The report to check against the baseline.
+    threshold: Relative slowdown of the minimum time per call above which a
+               scenario counts as a regression.
+
+  Returns:
+    A list of (name, baseline_ns, current_ns, ratio, regressed) tuples, one per
+    scenario present in both reports.
+  """
+  rows = []
+  for name, result in sorted(current['results'].items()):
+    base = baseline['results'].get(name)
+    if (not base or 'ns_per_call_min' not in base
+        or 'ns_per_call_min' not in result):
+      continue
+    ratio = result['ns_per_call_min'] / base['ns_per_call_min']
+    rows.append((name, base['ns_per_call_min'], result['ns_per_call_min'],
+                 ratio, ratio > 1.0 + threshold))
+  return rows
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      prog='python -m qj.bench',
+      description='Benchmark qj hot paths.')
+  parser.add_argument('-k', '--filter', default=None,
+                      help='Only run scenarios matching this regex.')
+  parser.add_argument('--repeat', type=int, default=5,
+                      help='Timed repetitions per scenario.')
+  parser.add_argument('--min-time', type=float, default=0.1,
+                      help='Minimum seconds per repetition.')
+  parser.add_argument('-o', '--output', default=None,
+                      help='Write the JSON report to this file.')
+  parser.add_argument('--compare', default=None,
+                      help='Baseline JSON report to compare against.')
+  parser.add_argument('--threshold', type=float, default=0.25,
+                      help='Relative slowdown that counts as a regression.')
+  args = parser.parse_args(argv)
+
+  report = run_benchmarks(args.filter, args.repeat, args.min_time)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+  if not args.compare:
+    return 0
+
+  with open(args.compare) as f:
+    baseline = json.load(f)
+  rows = compare(baseline, report, args.threshold)
+  regressions = 0
+  for name, base_ns, cur_ns, ratio, regressed in rows:
+    regressions += regressed
+    print('%-24s %12.1f ns -> %12.1f ns  x%.2f%s' % (
+        name, base_ns, cur_ns, ratio, '  REGRESSION' if regressed else ''),
+          file=sys.stderr)
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
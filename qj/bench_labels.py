@@ -0,0 +1,359 @@
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Correctness and speed corpus for qj's source label extraction.
+
+Run like this:
+  python -m qj.bench_labels                          # Print results as JSON.
+  python -m qj.bench_labels --output labels.json     # Save a baseline.
+  python -m qj.bench_labels --compare labels.json    # Flag regressions.
+  python -m qj.bench_labels --python python3.10 --python python3.11
+
+Each shape in the corpus is a call site like `[qj(x + 1) for _ in l]`. The
+shapes are written to a temporary module so that the real source lookup is
+exercised, and each one is run once with a probe standing in for qj to capture
+the calling frame. The label is then extracted from that frame's code object
+and compared to the text between the call's parentheses.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from qj import qj
+
+
+# Expressions logged at each call site. Names used here are defined by
+# _PREAMBLE in every generated function.
+_EXPRESSIONS = [
+    'x',
+    'x + 1',
+    '1 + x',
+    '1 * x',
+    '3 // x',
+    'x / y',
+    'x - y',
+    'x % 3',
+    'x ** 2',
+    '1 + 2 * x',
+    '2 * x + 1',
+    '2 * (x + 1)',
+    '-x',
+    '~x',
+    'x << 1',
+    'x & y',
+    'x | y',
+    'x ^ y',
+    'x == y',
+    'x < y',
+    'x in l',
+    'l[0]',
+    'l[x]',
+    's[x:]',
+    's[:-1]',
+    's[x:-1]',
+    's[::-1]',
+    "d['x']",
+    'len(l)',
+    'f(x, y)',
+    'f(x, k=y)',
+    'f(f(x))',
+    'obj.method(x)',
+    'obj.attr',
+    '[x, y]',
+    '(x, y)',
+    "{'a': x}",
+    '[v * 2 for v in l]',
+    '{v: v for v in l}',
+    '(v for v in l)',
+    'lambda v: v + x',
+    "'%d' % x",
+    "str(x) + 'a'",
+]
+
+# Contexts each expression is logged in. {} is replaced by the expression.
+_CONTEXTS = [
+    ('plain', 'qj({})', '{}'),
+    ('kwarg', 'qj({}, b=1)', '{}, b=1'),
+    ('assigned', 'z = qj({})', '{}'),
+    ('nested', 'str(qj({}))', '{}'),
+    ('list_comp', '[qj({}) for _ in range(1)]', '{}'),
+    ('lambda', '(lambda: qj({}))()', '{}'),
+    ('multiline', 'qj(\n      {})', '{}'),
+]
+
+# Shapes that don't fit the expression/context grid.
+_EXTRA_SHAPES = [
+    ('empty', 'qj()', '<empty log>'),
+    ('splat', 'qj(*l)', '*l'),
+    ('splat_kw', 'qj(x, **d2)', 'x, **d2'),
+    ('splat_as_well', "qj(x, '', *a)", "x, '', *a"),
+    ('kwargs_only', "qj(s='label', x=x)", "s='label', x=x"),
+    ('multiline_args', 'qj(x,\n      b=1,\n      pad=0)', 'x, b=1, pad=0'),
+    ('comment_between', 'qj(x,\n      # a comment\n      b=1)', 'x, b=1'),
+    ('nested_qj', 'qj(f(qj(x)))', 'f(qj(x))'),
+    ('dict_comp_closure', 'qj({v: x for v in l})', '{v: x for v in l}'),
+    ('long_args', 'qj(f(x, y, x, y, x, y, x, y, x, y, x, y, x, y))',
+     'f(x, y, x, y, x, y, x, y, x, y, x, y, x, y)'),
+]
+
+_PREAMBLE = """\
+  x = 2
+  y = 3
+  s = 'abcdef'
+  l = [1, 2, 3]
+  a = [None]
+  d = {'x': 2}
+  d2 = {'b': 1}
+  f = lambda *args, **kwargs: args[0] if args else None
+  obj = _Obj()
+"""
+
+_MODULE_HEADER = """\
+# Generated by qj.bench_labels. Do not edit.
+
+
+class _Obj(object):
+  attr = 1
+
+  def method(self, v):
+    return v
+
+
+def qj(*args, **kwargs):
+  _probe(args, kwargs)
+  return args[0] if args else None
+
+
+"""
+
+
+def corpus():
+  """Returns a list of (name, source, expected_label) tuples."""
+  shapes = []
+  for i, expression in enumerate(_EXPRESSIONS):
+    for context_name, source, expected in _CONTEXTS:
+      shapes.append(('%s_%02d' % (context_name, i),
+                     source.format(expression),
+                     expected.format(expression)))
+  shapes.extend(_EXTRA_SHAPES)
+  return shapes
+
+
+def _normalize(label):
+  return ' '.join(label.split())
+
+
+def _write_corpus_module(directory, shapes):
+  lines = [_MODULE_HEADER]
+  for name, source, _ in shapes:
+    lines.append('def shape_%s():\n%s  %s\n\n\n' % (name, _PREAMBLE, source))
+  path = os.path.join(directory, '_qj_label_corpus.py')
+  with open(path, 'w') as f:
+    f.write(''.join(lines))
+  return path
+
+
+def run_corpus(pattern=None, repeat=3):
+  """Extract the label of every shape in the corpus.
+
+  Arguments:
+    pattern: Optional regular expression. Only shapes whose names match are
+             run.
+    repeat: Number of timed extractions per shape. The reported time is the
+            minimum, so it measures extraction with the corpus' source already
+            indexed, as it is after the first log from a file. Extraction
+            keeps no other cache, so every timed extraction does the full
+            disassembly and source search.
+
+  Returns:
+    A JSON-serializable dict of results.
+  """
+  # pylint: disable=g-import-not-at-top
+  from qj.labels import _find_current_fn_call
+  # pylint: enable=g-import-not-at-top
+
+  shapes = [shape for shape in corpus()
+            if not pattern or re.search(pattern, shape[0])]
+  directory = tempfile.mkdtemp(prefix='qj_bench_labels_')
+  sys.path.insert(0, directory)
+  results = {}
+  try:
+    _write_corpus_module(directory, shapes)
+    module = importlib.import_module('_qj_label_corpus')
+
+    captured = []
+    module._probe = lambda args, kwargs: captured.append(
+        (sys._getframe(2).f_code, sys._getframe(2).f_lasti))
+
+    for name, source, expected in shapes:
+      result = {'source': source, 'expected': expected}
+      results[name] = result
+      del captured[:]
+      try:
+        getattr(module, 'shape_' + name)()
+        co, lasti = captured[-1]
+        times = []
+        for _ in range(repeat):
+          start = timeit.default_timer()
+          label = _find_current_fn_call(co, lasti)
+          times.append(timeit.default_timer() - start)
+        result['label'] = label
+        result['match'] = _normalize(label) == _normalize(expected)
+        result['ns'] = min(times) * 1e9
+      except Exception as e:  # pylint: disable=broad-except
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['match'] = False
+  finally:
+    sys.path.remove(directory)
+    sys.modules.pop('_qj_label_corpus', None)
+    shutil.rmtree(directory, ignore_errors=True)
+
+  return {
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+      'qj_version': qj.__version__,
+      'matched': sum(r['match'] for r in results.values()),
+      'total': len(results),
+      'total_ns': sum(r.get('ns', 0.0) for r in results.values()),
+      'results': results,
+  }
+
+
+def compare(baseline, current, threshold=0.25):
+  """Compare two corpus reports from the same python version.
+
+  Arguments:
+    baseline: A report previously returned by run_corpus.
+    current: The report to check against the baseline.
+    threshold: Relative slowdown of the total extraction time above which the
+               run counts as a regression.
+
+  Returns:
+    A tuple of (names of shapes that matched in the baseline but no longer
+    match, names of other shapes whose label or error changed, total time
+    ratio, whether the total time regressed).
+  """
+  broken = sorted(
+      name for name, result in current['results'].items()
+      if not result['match']
+      and baseline['results'].get(name, {}).get('match'))
+  changed = sorted(
+      name for name, result in current['results'].items()
+      if name in baseline['results'] and name not in broken
+      and (_outcome(result) != _outcome(baseline['results'][name])))
+  shared = [name for name in current['results']
+            if 'ns' in current['results'][name]
+            and 'ns' in baseline['results'].get(name, {})]
+  base_ns = sum(baseline['results'][name]['ns'] for name in shared)
+  cur_ns = sum(current['results'][name]['ns'] for name in shared)
+  ratio = cur_ns / base_ns if base_ns else 1.0
+  return broken, changed, ratio, ratio > 1.0 + threshold
+
+
+def _outcome(result):
+  return result.get('label', result.get('error'))
+
+
+def _run_with(python, args):
+  """Run the corpus in a different interpreter and return its report."""
+  env = dict(os.environ)
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  env['PYTHONPATH'] = os.pathsep.join(
+      [root] + [p for p in [env.get('PYTHONPATH')] if p])
+  with open(os.devnull, 'w') as devnull:
+    output = subprocess.check_output(
+        [python, '-m', 'qj.bench_labels', '--repeat', str(args.repeat)]
+        + (['-k', args.filter] if args.filter else []),
+        env=env, stderr=devnull)
+  return json.loads(output.decode('utf-8'))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      prog='python -m qj.bench_labels',
+      description='Check and time qj label extraction over a corpus of call '
+                  'sites.')
+  parser.add_argument('-k', '--filter', default=None,
+                      help='Only run shapes matching this regex.')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='Timed extractions per shape.')
+  parser.add_argument('--python', action='append', default=[],
+                      help='Run the corpus under this interpreter instead of '
+                           'the current one. May be repeated.')
+  parser.add_argument('-o', '--output', default=None,
+                      help='Write the JSON report to this file.')
+  parser.add_argument('--compare', default=None,
+                      help='Baseline JSON report to compare against.')
+  parser.add_argument('--threshold', type=float, default=0.25,
+                      help='Relative slowdown that counts as a regression.')
+  args = parser.parse_args(argv)
+
+  if args.python:
+    reports = [_run_with(python, args) for python in args.python]
+  else:
+    reports = [run_corpus(args.filter, args.repeat)]
+
+  report = reports[0] if len(reports) == 1 else {'reports': reports}
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+  for r in reports:
+    print('python %s: %d/%d labels match, %.1f ms total' % (
+        r['python'], r['matched'], r['total'], r['total_ns'] / 1e6),
+          file=sys.stderr)
+
+  if not args.compare:
+    return 0
+
+  with open(args.compare) as f:
+    baseline = json.load(f)
+  baselines = {b['python']: b for b in baseline.get('reports', [baseline])}
+  failed = False
+  for r in reports:
+    if r['python'] not in baselines:
+      print('python %s: no baseline' % r['python'], file=sys.stderr)
+      continue
+    base = baselines[r['python']]
+    broken, changed, ratio, slower = compare(base, r, args.threshold)
+    failed = failed or bool(broken) or bool(changed) or slower
+    print('python %s: time x%.2f%s' % (
+        r['python'], ratio, '  REGRESSION' if slower else ''), file=sys.stderr)
+    for name in broken:
+      print('  no longer matches: %s: %r' % (
+          name, _outcome(r['results'][name])), file=sys.stderr)
+    for name in changed:
+      print('  label changed: %s: %r -> %r' % (
+          name, _outcome(base['results'][name]), _outcome(r['results'][name])),
+            file=sys.stderr)
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,225 @@
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Post-mortem dumps for exceptions caught by qj's `catch` in headless code.
+
+When qj.DUMP_DIR is set, `@qj(catch=1)` writes a dump of the exception to that
+directory instead of dropping into the debugger. Inspect the dumps like this:
+  python -m qj.dumps /path/to/dump_dir          # List the dumps.
+  python -m qj.dumps /path/to/dump_dir/qj_dump_1510608011_123_0.json
+  python -m qj.dumps --all /path/to/dump_dir    # Show every dump in full.
+
+A dump is a JSON file with the exception, its traceback, and size-limited reprs
+of the arguments and locals of each frame, so writing one takes a bounded
+amount of time no matter how big the objects in those frames are.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import inspect
+import itertools
+import json
+import linecache
+import os
+import sys
+import time
+import traceback
+
+try:
+  import reprlib
+except ImportError:  # Python 2
+  import repr as reprlib  # pylint: disable=g-import-not-at-top
+
+
+# Bounds on the size of a dump.
+_MAX_FRAMES = 30
+_MAX_LOCALS = 50
+_MAX_MESSAGE = 2000
+
+_REPR = reprlib.Repr()
+_REPR.maxlevel = 3
+_REPR.maxstring = _REPR.maxother = 200
+_REPR.maxlist = _REPR.maxtuple = _REPR.maxdict = _REPR.maxset = 10
+
+_counter = itertools.count()
+
+
+def _safe_repr(value):
+  try:
+    return _REPR.repr(value)
+  except Exception as e:  # pylint: disable=broad-except
+    return '<repr failed: %s>' % type(e).__name__
+
+
+def _safe_str(value):
+  try:
+    return str(value)[:_MAX_MESSAGE]
+  except Exception as e:  # pylint: disable=broad-except
+    return '<str failed: %s>' % type(e).__name__
+
+
+def _frame_record(frame, lineno):
+  co = frame.f_code
+  nargs = (co.co_argcount + getattr(co, 'co_kwonlyargcount', 0)
+           + bool(co.co_flags & inspect.CO_VARARGS)
+           + bool(co.co_flags & inspect.CO_VARKEYWORDS))
+  arg_names = co.co_varnames[:nargs]
+  f_locals = frame.f_locals
+  names = [name for name in arg_names if name in f_locals]
+  names += sorted(name for name in f_locals
+                  if name not in arg_names and not name.startswith('__qj'))
+  return {
+      'filename': co.co_filename,
+      'lineno': lineno,
+      'function': co.co_name,
+      'line': linecache.getline(co.co_filename, lineno).strip(),
+      'args': {name: _safe_repr(f_locals[name]) for name in names[:_MAX_LOCALS]
+               if name in arg_names},
+      'locals': {name: _safe_repr(f_locals[name]) for name in names[:_MAX_LOCALS]
+                 if name not in arg_names},
+      'omitted_locals': max(0, len(names) - _MAX_LOCALS),
+  }
+
+
+def capture(e, source=None):
+  """Returns a JSON-serializable post-mortem record of exception e.
+
+  Arguments:
+    e: The exception, with its __traceback__ still attached. On Python 2,
+       capture must be called while e is being handled.
+    source: Optional description of where it was caught.
+
+  Returns:
+    A dict with the exception, its formatted traceback, and the arguments and
+    locals of the innermost _MAX_FRAMES frames of the traceback.
+  """
+  # Python 2 exceptions don't hold their traceback, so use the one being handled.
+  exc_tb = (e.__traceback__ if hasattr(e, '__traceback__')
+            else sys.exc_info()[2])
+  frames = []
+  tb = exc_tb
+  while tb is not None:
+    frames.append((tb.tb_frame, tb.tb_lineno))
+    tb = tb.tb_next
+  omitted = max(0, len(frames) - _MAX_FRAMES)
+  frames = frames[omitted:]
+  for _ in range(omitted):
+    exc_tb = exc_tb.tb_next
+  return {
+      'time': time.time(),
+      'pid': os.getpid(),
+      'argv': sys.argv[:20],
+      'source': source,
+      'exception': type(e).__name__,
+      'message': _safe_str(e),
+      'traceback': ''.join(traceback.format_exception(type(e), e, exc_tb)),
+      'omitted_frames': omitted,
+      'frames': [_frame_record(frame, lineno) for frame, lineno in frames],
+  }
+
+
+def write(e, directory, source=None):
+  """Captures exception e and writes it to a new file in directory.
+
+  Returns:
+    The path of the dump.
+  """
+  record = capture(e, source)
+  # Other processes may be creating the directory too. Python 2's makedirs has
+  # no exist_ok.
+  try:
+    os.makedirs(directory)
+  except OSError:
+    if not os.path.isdir(directory):
+      raise
+  path = os.path.join(directory, 'qj_dump_%d_%d_%d.json' % (
+      record['time'], record['pid'], next(_counter)))
+  with open(path, 'w') as f:
+    json.dump(record, f, indent=1, sort_keys=True)
+  return path
+
+
+def load(path):
+  with open(path) as f:
+    return json.load(f)
+
+
+def find(paths):
+  """Returns the dump files named by paths, expanding directories, oldest first."""
+  found = []
+  for path in paths:
+    if os.path.isdir(path):
+      found.extend(os.path.join(path, name) for name in os.listdir(path)
+                   if name.startswith('qj_dump_') and name.endswith('.json'))
+    else:
+      found.append(path)
+  return sorted(found, key=os.path.getmtime)
+
+
+def summarize(path, record):
+  return '%s  %s  %s: %s  (%s)' % (
+      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['time'])),
+      os.path.basename(path), record['exception'], record['message'],
+      record.get('source') or 'unknown source')
+
+
+def format_dump(record):
+  """Formats a dump as a traceback with each frame's arguments and locals."""
+  lines = ['%s: %s' % (record['exception'], record['message']),
+           'caught in %s, pid %d, argv %r' % (
+               record.get('source'), record['pid'], record['argv'])]
+  if record['omitted_frames']:
+    lines.append('... %d outer frames omitted' % record['omitted_frames'])
+  for frame in record['frames']:
+    lines.append('  File "%s", line %d, in %s' % (
+        frame['filename'], frame['lineno'], frame['function']))
+    if frame['line']:
+      lines.append('    %s' % frame['line'])
+    for kind in ('args', 'locals'):
+      for name, value in sorted(frame[kind].items()):
+        lines.append('      %s %s = %s' % (kind[:-1] if kind == 'args' else 'local',
+                                           name, value))
+    if frame['omitted_locals']:
+      lines.append('      ... %d more locals' % frame['omitted_locals'])
+  return '\n'.join(lines)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      prog='python -m qj.dumps',
+      description='Inspect post-mortem dumps written by qj.')
+  parser.add_argument('paths', nargs='+',
+                      help='Dump files, or directories containing them.')
+  parser.add_argument('--all', action='store_true',
+                      help='Show every dump in full rather than listing them.')
+  args = parser.parse_args(argv)
+
+  paths = find(args.paths)
+  show = args.all or all(not os.path.isdir(path) for path in args.paths)
+  for path in paths:
+    record = load(path)
+    if show:
+      print('== %s' % path)
+      print(format_dump(record))
+      print()
+    else:
+      print(summarize(path, record))
+  return 0 if paths else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
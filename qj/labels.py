@@ -0,0 +1,1417 @@
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Extraction of the source code of qj call sites, used as log labels.
+
+qj imports this module the first time it needs a label, so that importing qj
+doesn't pay for disassembly support or the opcode tables below.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import dis
+import linecache
+import opcode
+import os
+import sys
+import types
+
+from qj.qj import qj
+
+
+# pylint: disable=protected-access, expression-not-assigned, line-too-long
+def _disassemble3(co, lasti):
+  """Disassemble a code object."""
+  linestarts = dict(dis.findlinestarts(co))
+  _disassemble_bytes(co, lasti, linestarts)
+
+def _get_instruction_bytes(code, co, linestarts):
+  if sys.version_info[1] < 11:
+    return dis._get_instructions_bytes(code, co.co_varnames, co.co_names,
+                                       co.co_consts, co.co_cellvars + co.co_freevars,
+                                       linestarts)
+  else:
+    return dis._get_instructions_bytes(
+      code,
+      varname_from_oparg=co._varname_from_oparg,
+      names=co.co_names,
+      co_consts=co.co_consts,
+      linestarts=linestarts,
+      line_offset=0,
+      exception_entries=(),
+      co_positions=None,
+      show_caches=False)
+
+
+def _disassemble_bytes(co, lasti=-1, linestarts=None):
+  # Omit the line number column entirely if we have no line number info
+  show_lineno = linestarts is not None
+  lineno_width = 3 if show_lineno else 0
+  for instr in _get_instruction_bytes(co.co_code, co, linestarts):
+    new_source_line = (show_lineno and
+                       instr.starts_line is not None and
+                       instr.offset > 0)
+    if new_source_line:
+      qj.LOG_FN('')
+    is_current_instr = instr.offset == lasti
+    qj.LOG_FN(instr._disassemble(lineno_width, is_current_instr))
+
+
+def _build_instruction_stack3(co, lasti):
+  code = co.co_code
+
+  linestarts = dict(dis.findlinestarts(co))
+
+  stack = []
+
+  num_instr = len(code)
+
+  if qj._DEBUG_QJ:
+    qj.LOG_FN('lasti = %r\nnum_instr = %r' % (lasti, num_instr))
+    assert lasti < num_instr
+  if lasti >= num_instr:
+    return []
+
+  curr_l = 0
+  for instr in _get_instruction_bytes(code, co, linestarts):
+    # instr.{opname opcode arg argval argrepr offset starts_line is_jump_target}
+    curr_i = instr.offset
+    curr_l = instr.starts_line or curr_l
+
+    if curr_i > lasti:
+      # In 3.11 the lasti value falls between instruction numbers for some reason, so we have to break both here and at the end of the loop.
+      break
+
+    op = instr.opcode
+    oparg = instr.arg
+    oparg_repr = instr.argval
+    if op >= opcode.HAVE_ARGUMENT:
+      token = _ARG_TOKENS[op] if oparg > 0 else _ZERO_ARG_TOKENS[op]
+    else:
+      token = _NO_ARG_TOKENS[op]
+
+    if token is _ARGREPR:
+      oparg_repr = instr.argrepr
+    elif token is not None:
+      oparg_repr = token
+    elif op >= opcode.HAVE_ARGUMENT:
+      if isinstance(oparg_repr, str) and oparg_repr.startswith('.'):
+        oparg_repr = ''  # Skip unnamed locals like .0
+      elif isinstance(oparg_repr, types.CodeType):
+        qj._DEBUG_QJ and _disassemble3(oparg_repr, -1)
+        if oparg_repr.co_name == '<lambda>':
+          oparg_repr = ['lambda', ':']
+        elif oparg_repr.co_name == '<dictcomp>' or oparg_repr.co_name == '<setcomp>':
+          oparg_repr = ['{', '}']
+        elif oparg_repr.co_name == '<genexpr>':
+          oparg_repr = ['(', ')']
+        elif oparg_repr.co_name == '<listcomp>':
+          oparg_repr = ['[', ']']
+        else:
+          oparg_repr = ''
+      elif hasattr(dis, '_Unknown') and isinstance(oparg_repr, dis._Unknown):
+        oparg_repr = ''
+
+    if isinstance(oparg_repr, tuple):
+      # E.g., constant tuples, which may hold numbers as well as names.
+      oparg_repr = [r if isinstance(r, str) else repr(r) for r in oparg_repr]
+
+    qj._DEBUG_QJ and qj.LOG_FN('%s\noriginal oparg_repr: %r\n     new oparg_repr: %r' % (instr.opname, instr.argval, oparg_repr))
+
+    instr_arg = 0 if instr.arg is None else instr.arg
+
+    stack_effect = _STACK_EFFECTS[op]
+    stack_entry = _StackEntry(
+        stack_effect if stack_effect.__class__ is int else stack_effect(instr_arg),
+        curr_i,
+        curr_l,
+        instr.opname,
+        instr_arg,
+        oparg_repr if isinstance(oparg_repr, list) else [str(oparg_repr)],
+        [],  # children
+    )
+
+    if len(stack) and op == _CALL_FUNCTION_EX:
+      # CALL_FUNCTION_EX only sets the oparg to 0 or 1. 1 means there are kwargs to expand, as well as possibly tuple args.
+      # 0 means there are tuple args to expand only. In that case, we still need CALL_FUNCTION_EX to actually consume a
+      # stack entry, which will be the vararg.
+      stack_entry.stack_depth = -1
+
+    stack.append(stack_entry)
+
+    if curr_i == lasti:
+      break
+
+  qj._DEBUG_QJ and [qj.LOG_FN('se: %s' % str(se)) for se in stack] and qj.LOG_FN('\n\n')
+
+  return stack
+
+
+_STACK_EFFECTS3 = {
+    'NOP': 0,
+
+    'EXTENDED_ARG': 0,
+    'RESUME': 0,
+    'CACHE': 0,
+
+    'POP_TOP': -1,
+    'SWAP': 0,
+    'ROT_TWO': 0,
+    'ROT_THREE': 0,
+    'ROT_FOUR': 0,
+    'DUP_TOP': 1,
+    'DUP_TOP_TWO': 2,
+
+    'UNARY_POSITIVE': 0,
+    'UNARY_NEGATIVE': 0,
+    'UNARY_NOT': 0,
+    'UNARY_INVERT': 0,
+
+    'SET_ADD': -1,
+    'LIST_APPEND': -1,
+    'MAP_ADD': -2,
+
+    'BINARY_POWER': -1,
+    'BINARY_MULTIPLY': -1,
+    'BINARY_MATRIX_MULTIPLY': -1,
+    'BINARY_MODULO': -1,
+    'BINARY_ADD': -1,
+    'BINARY_SUBTRACT': -1,
+    'BINARY_SUBSCR': -1,
+    'BINARY_FLOOR_DIVIDE': -1,
+    'BINARY_TRUE_DIVIDE': -1,
+    'BINARY_OP': -1,
+
+    'INPLACE_FLOOR_DIVIDE': -1,
+    'INPLACE_TRUE_DIVIDE': -1,
+    'INPLACE_ADD': -1,
+    'INPLACE_SUBTRACT': -1,
+    'INPLACE_MULTIPLY': -1,
+    'INPLACE_MATRIX_MULTIPLY': -1,
+    'INPLACE_MODULO': -1,
+
+    'STORE_SUBSCR': -3,
+    'DELETE_SUBSCR': -2,
+
+    'BINARY_LSHIFT': -1,
+    'BINARY_RSHIFT': -1,
+    'BINARY_AND': -1,
+    'BINARY_XOR': -1,
+    'BINARY_OR': -1,
+    'INPLACE_POWER': -1,
+    'GET_ITER': 0,
+
+    'ASYNC_GEN_WRAP': 0,
+    'SEND': -1,  # jump > 0 ? -1 : 0;
+
+    'CHECK_EXC_MATCH': 0,
+    'CHECK_EG_MATCH': 0,
+
+    'JUMP_FORWARD': 0,
+    'JUMP_BACKWARD': 0,
+    'JUMP': 0,
+    'JUMP_BACKWARD_NO_INTERRUPT': 0,
+    'JUMP_NO_INTERRUPT': 0,
+
+    'JUMP_IF_TRUE_OR_POP': 0,  # jump ? 0 : -1;
+    'JUMP_IF_FALSE_OR_POP': 0,  # jump ? 0 : -1;
+
+    'POP_JUMP_BACKWARD_IF_NONE': -1,
+    'POP_JUMP_FORWARD_IF_NONE': -1,
+    'POP_JUMP_IF_NONE': -1,
+    'POP_JUMP_BACKWARD_IF_NOT_NONE': -1,
+    'POP_JUMP_FORWARD_IF_NOT_NONE': -1,
+    'POP_JUMP_IF_NOT_NONE': -1,
+    'POP_JUMP_FORWARD_IF_FALSE': -1,
+    'POP_JUMP_BACKWARD_IF_FALSE': -1,
+    'POP_JUMP_IF_FALSE': -1,
+    'POP_JUMP_FORWARD_IF_TRUE': -1,
+    'POP_JUMP_BACKWARD_IF_TRUE': -1,
+    'POP_JUMP_IF_TRUE': -1,
+
+    'RETURN_GENERATOR': 0,
+
+    'KW_NAMES': 0,
+
+    'PRECALL': 0,  # Was -oparg, but needs to be 0 because CALL comes next and needs to have the -oparg.
+
+    'PREP_RERAISE_STAR': -1,
+    'PUSH_EXC_INFO': 1,
+
+    'MAKE_CELL': 0,
+    'COPY_FREE_VARS': 0,
+    'COPY': 1,
+    'PUSH_NULL': 1,
+
+    'BEFORE_WITH': 1,
+
+    'SETUP_CLEANUP': 2,  # jump ? 2 : 0
+
+    'PRINT_EXPR': -1,
+    'LOAD_BUILD_CLASS': 1,
+    'INPLACE_LSHIFT': -1,
+    'INPLACE_RSHIFT': -1,
+    'INPLACE_AND': -1,
+    'INPLACE_XOR': -1,
+    'INPLACE_OR': -1,
+    'BREAK_LOOP': 0,
+    # TODO: in 3.11: jump ? 1 : 0;
+    'SETUP_WITH': 7,
+    'WITH_CLEANUP_START': 1,
+    'WITH_CLEANUP_FINISH': -1,  # Sometimes more
+    'RETURN_VALUE': -1,
+    'IMPORT_STAR': -1,
+    'SETUP_ANNOTATIONS': 0,
+    'YIELD_VALUE': 0,
+    'YIELD_FROM': -1,
+    'POP_BLOCK': 0,
+    # TODO: in 3.11: -1
+    'POP_EXCEPT': 0,  # -3 except if bad bytecode
+    'END_FINALLY': -1,  # or -2 or -3 if exception occurred
+
+    'STORE_NAME': -1,
+    'DELETE_NAME': 0,
+    'FOR_ITER': 1,  # or -1, at end of iterator
+
+    'STORE_ATTR': -2,
+    'DELETE_ATTR': -1,
+    'STORE_GLOBAL': -1,
+    'DELETE_GLOBAL': 0,
+    'LOAD_CONST': 1,
+    'LOAD_NAME': 1,
+    'LOAD_ATTR': 0,
+    'COMPARE_OP': -1,
+    'IS_OP': -1,
+    'CONTAINS_OP': -1,
+
+    'JUMP_IF_NOT_EXC_MATCH': -2,
+    'IMPORT_NAME': -1,
+    'IMPORT_FROM': 1,
+
+    'JUMP_FORWARD': 0,
+    'JUMP_IF_TRUE_OR_POP': 0,  # -1 if jump not taken
+    'JUMP_IF_FALSE_OR_POP': 0,  # -1 if jump not taken
+    'JUMP_ABSOLUTE': 0,
+
+    'POP_JUMP_IF_FALSE': -1,
+    'POP_JUMP_IF_TRUE': -1,
+
+    'LOAD_GLOBAL': 1,
+
+    'CONTINUE_LOOP': 0,
+    'SETUP_LOOP': 0,
+    'SETUP_EXCEPT': 6,
+    # TODO: in 3.11: jump ? 1 : 0;
+    'SETUP_FINALLY': 6,  # can push 3 values for the new exception + 3 others for the previous exception state
+    'RERAISE': -3,  # TODO: -1 in 3.11
+    'WITH_EXCEPT_START': 1,
+
+    'LOAD_FAST': 1,
+    'STORE_FAST': -1,
+    'DELETE_FAST': 0,
+    'STORE_ANNOTATION': -1,
+
+    'LOAD_CLOSURE': 1,
+    'LOAD_DEREF': 1,
+    'LOAD_CLASSDEREF': 1,
+    'STORE_DEREF': -1,
+    'DELETE_DEREF': 0,
+    'GET_AWAITABLE': 0,
+    'SETUP_ASYNC_WITH': 6,
+    'BEFORE_ASYNC_WITH': 1,
+    'GET_AITER': 0,
+    'GET_ANEXT': 1,
+    'GET_YIELD_FROM_ITER': 0,
+    # TODO: in 3.11: -2
+    'END_ASYNC_FOR': -7,
+
+    'LOAD_METHOD': 1,
+    'LOAD_ASSERTION_ERROR': 1,
+
+    'LIST_TO_TUPLE': 0,
+    'GEN_START': -1,
+    'LIST_EXTEND': -1,
+    'SET_UPDATE': -1,
+    'DICT_MERGE': -1,
+    'DICT_UPDATE': -1,
+
+    'COPY_DICT_WITHOUT_KEYS': 0,
+    # TODO: in 3.11: -2
+    'MATCH_CLASS': -1,
+    'GET_LEN': 1,
+    'MATCH_MAPPING': 1,
+    'MATCH_SEQUENCE': 1,
+    # TODO: in 3.11: 1
+    'MATCH_KEYS': 2,
+    'ROT_N': 0,
+}
+
+
+# Stack effects that depend on the oparg.
+_OPARG_STACK_EFFECTS3 = {
+    'UNPACK_SEQUENCE': lambda oparg: oparg - 1,
+    'UNPACK_EX': lambda oparg: (oparg & 0xFF) + (oparg >> 8),
+    'BUILD_TUPLE': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_LIST': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_SET': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_STRING': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_LIST_UNPACK': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_TUPLE_UNPACK': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_TUPLE_UNPACK_WITH_CALL': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_SET_UNPACK': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_MAP_UNPACK': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_MAP_UNPACK_WITH_CALL': lambda oparg: -oparg,  # Was 1 - oparg
+    'BUILD_MAP': lambda oparg: -2 * oparg,  # Was 1 - 2 * oparg
+    'BUILD_CONST_KEY_MAP': lambda oparg: -oparg,
+    'RAISE_VARARGS': lambda oparg: -oparg,
+    'CALL': lambda oparg: -oparg,
+    'CALL_FUNCTION': lambda oparg: -oparg,
+    'CALL_METHOD': lambda oparg: -oparg - 1,
+    'CALL_FUNCTION_KW': lambda oparg: -oparg - 1,
+    'CALL_FUNCTION_EX': lambda oparg: -((oparg & 0x01) != 0) - ((oparg & 0x02) != 0),
+    'MAKE_FUNCTION': lambda oparg: -1 - ((oparg & 0x01) != 0) - ((oparg & 0x02) != 0) - ((oparg & 0x04) != 0) - ((oparg & 0x08) != 0),
+    'BUILD_SLICE': lambda oparg: -2 if (oparg == 3) else -1,
+    # If there's a fmt_spec on the stack we go from 2->1 else 1->1.
+    'FORMAT_VALUE': lambda oparg: -1 if (oparg & 0x4) == 0x4 else 0,
+}
+
+# Marks ops whose source token is the argrepr that dis computes for them.
+_ARGREPR = object()
+
+# Source tokens for ops without arguments.
+_NO_ARG_TOKENS3 = {
+    'UNARY_POSITIVE': '+',
+    'UNARY_NEGATIVE': '-',
+    'UNARY_NOT': '',  # TODO(iansf)
+    'UNARY_INVERT': '~',
+    'BINARY_POWER': '**',
+    'BINARY_MULTIPLY': '*',
+    'BINARY_MODULO': '%',
+    'BINARY_ADD': '+',
+    'BINARY_SUBTRACT': '-',
+    'BINARY_SUBSCR': ']',
+    'BINARY_FLOOR_DIVIDE': '//',
+    'BINARY_TRUE_DIVIDE': '/',
+    'BINARY_LSHIFT': '<<',
+    'BINARY_RSHIFT': '>>',
+    'BINARY_AND': '&',
+    'BINARY_XOR': '^',
+    'BINARY_OR': '|',
+    'GET_ITER': '',
+    'PUSH_NULL': '',
+}
+
+# Source tokens for ops with arguments, when the argument is zero. Other MAKE_
+# and BUILD_ ops have no token of their own.
+_ZERO_ARG_TOKENS3 = {
+    'BUILD_LIST': '[',  # BUILD_LIST 0 occurs at the beginning of list comprehensions
+    'BUILD_TUPLE': '(',
+    'BUILD_SET': '{',
+    'BUILD_MAP': '{',
+    'CALL_FUNCTION': ')',
+    'CALL_FUNCTION_KW': ')',
+    'CALL_FUNCTION_EX': ')',
+    'CALL_METHOD': ')',
+    'CALL': ')',
+    'PRECALL': '',
+    'BINARY_OP': _ARGREPR,
+    'CONTAINS_OP': 'in',
+    'IS_OP': 'is',
+}
+
+# Source tokens for ops with arguments, when the argument is nonzero.
+_ARG_TOKENS3 = dict(_ZERO_ARG_TOKENS3, **{
+    'BUILD_LIST': ']',
+    'BUILD_TUPLE': ')',
+    'BUILD_SET': '}',
+    'BUILD_MAP': '{',  # BUILD_MAP happens at the beginning of the map
+    'LIST_APPEND': ']',
+    'SET_ADD': '',
+    'MAP_ADD': '',
+    'FOR_ITER': '',
+    'LIST_EXTEND': '',
+    'CONTAINS_OP': ['not', 'in'],
+    'IS_OP': ['is', 'not'],
+})
+
+
+def _build_dispatch_tables():
+  """Resolves the tables above into lists indexed by opcode for this interpreter.
+
+  Returns:
+    A tuple of (stack effects, no-arg tokens, zero-arg tokens, arg tokens) lists.
+    Stack effects are ints, or functions of the oparg. Tokens are strings,
+    _ARGREPR, or None for ops whose token comes from their argval.
+  """
+  size = max(max(dis.opmap.values()) + 1, 256)
+  effects = [0] * size
+  no_arg_tokens = [None] * size
+  zero_arg_tokens = [None] * size
+  arg_tokens = [None] * size
+  for name, op in dis.opmap.items():
+    if name in _OPARG_STACK_EFFECTS3:
+      effects[op] = _OPARG_STACK_EFFECTS3[name]
+    elif name in _STACK_EFFECTS3:
+      effects[op] = _STACK_EFFECTS3[name]
+    # Other ops are assumed not to change the stack. Their real effects aren't
+    # checked against the label corpus, and trusting them can unbalance the
+    # stack model around ops this module doesn't understand.
+
+    default = '' if name.startswith('MAKE_') or name.startswith('BUILD_') else None
+    no_arg_tokens[op] = _NO_ARG_TOKENS3.get(name)
+    zero_arg_tokens[op] = _ZERO_ARG_TOKENS3.get(name, default)
+    arg_tokens[op] = _ARG_TOKENS3.get(name, default)
+  return effects, no_arg_tokens, zero_arg_tokens, arg_tokens
+
+
+_STACK_EFFECTS, _NO_ARG_TOKENS, _ZERO_ARG_TOKENS, _ARG_TOKENS = _build_dispatch_tables()
+_CALL_FUNCTION_EX = dis.opmap.get('CALL_FUNCTION_EX', -1)
+
+
+#------------------------------------------------------------------------------
+# Python 2.7 helpers
+#------------------------------------------------------------------------------
+def _disassemble2(co, lasti):
+  """Disassemble a code object."""
+  code = co.co_code
+  linestarts = dict(dis.findlinestarts(co))
+  n = len(code)
+  i = 0
+  extended_arg = 0
+  free = None
+  while i < n:
+    s = ''
+    c = code[i]
+    op = ord(c)
+    if i in linestarts:
+      if i > 0:
+        qj.LOG_FN('')
+      s += '%3d' % linestarts[i]
+    else:
+      s += '   '
+
+    if i == lasti:
+      s += '-->'
+    else:
+      s += '   '
+    s += repr(i).rjust(4) + ' '
+    s += opcode.opname[op].ljust(20)
+    i += 1
+    if op >= opcode.HAVE_ARGUMENT:
+      oparg = ord(code[i]) + ord(code[i + 1]) * 256 + extended_arg
+      extended_arg = 0
+      i += 2
+      if op == opcode.EXTENDED_ARG:
+        extended_arg = oparg * 65536
+      s += repr(oparg).rjust(5)
+      if op in opcode.hasconst:
+        s += '(' + repr(co.co_consts[oparg]) + ')'
+      elif op in opcode.hasname:
+        s += '(' + co.co_names[oparg] + ')'
+      elif op in opcode.hasjrel:
+        s += '(to ' + repr(i + oparg) + ')'
+      elif op in opcode.haslocal:
+        s += '(' + co.co_varnames[oparg] + ')'
+      elif op in opcode.hascompare:
+        s += '(' + opcode.cmp_op[oparg] + ')'
+      elif op in opcode.hasfree:
+        if free is None:
+          free = co.co_cellvars + co.co_freevars
+        s += '(' + free[oparg] + ')'
+    qj.LOG_FN(s)
+
+
+_STACK_EFFECTS2 = {
+    'POP_TOP': -1,
+    'ROT_TWO': 0,
+    'ROT_THREE': 0,
+    'DUP_TOP': 1,
+    'ROT_FOUR': 0,
+
+    'UNARY_POSITIVE': 0,
+    'UNARY_NEGATIVE': 0,
+    'UNARY_NOT': 0,
+    'UNARY_CONVERT': 0,
+    'UNARY_INVERT': 0,
+
+    'SET_ADD': -1,
+    'LIST_APPEND': -1,
+
+    'MAP_ADD': -2,
+
+    'BINARY_POWER': -1,
+    'BINARY_MULTIPLY': -1,
+    'BINARY_DIVIDE': -1,
+    'BINARY_MODULO': -1,
+    'BINARY_ADD': -1,
+    'BINARY_SUBTRACT': -1,
+    'BINARY_SUBSCR': -1,
+    'BINARY_FLOOR_DIVIDE': -1,
+    'BINARY_TRUE_DIVIDE': -1,
+    'INPLACE_FLOOR_DIVIDE': -1,
+    'INPLACE_TRUE_DIVIDE': -1,
+
+    'SLICE+0': 0,
+    'SLICE+1': -1,
+    'SLICE+2': -1,
+    'SLICE+3': -2,
+
+    'STORE_SLICE+0': -2,
+    'STORE_SLICE+1': -3,
+    'STORE_SLICE+2': -3,
+    'STORE_SLICE+3': -4,
+
+    'DELETE_SLICE+0': -1,
+    'DELETE_SLICE+1': -2,
+    'DELETE_SLICE+2': -2,
+    'DELETE_SLICE+3': -3,
+
+    'INPLACE_ADD': -1,
+    'INPLACE_SUBTRACT': -1,
+    'INPLACE_MULTIPLY': -1,
+    'INPLACE_DIVIDE': -1,
+    'INPLACE_MODULO': -1,
+    'STORE_SUBSCR': -3,
+    'STORE_MAP': -2,
+    'DELETE_SUBSCR': -2,
+
+    'BINARY_LSHIFT': -1,
+    'BINARY_RSHIFT': -1,
+    'BINARY_AND': -1,
+    'BINARY_XOR': -1,
+    'BINARY_OR': -1,
+    'INPLACE_POWER': -1,
+    'GET_ITER': 0,
+
+    'PRINT_EXPR': -1,
+    'PRINT_ITEM': -1,
+    'PRINT_NEWLINE': 0,
+    'PRINT_ITEM_TO': -2,
+    'PRINT_NEWLINE_TO': -1,
+    'INPLACE_LSHIFT': -1,
+    'INPLACE_RSHIFT': -1,
+    'INPLACE_AND': -1,
+    'INPLACE_XOR': -1,
+    'INPLACE_OR': -1,
+    'BREAK_LOOP': 0,
+    'SETUP_WITH': 4,
+    # Originally was -1 with note that it's sometimes more.
+    # Better to balance with SETUP_WITH.
+    # TODO(iansf): Still doesn't work.
+    'WITH_CLEANUP': -1,
+    'LOAD_LOCALS': 1,
+    'RETURN_VALUE': -1,
+    'IMPORT_STAR': -1,
+    'EXEC_STMT': -3,
+    'YIELD_VALUE': 0,
+
+    'POP_BLOCK': 0,
+    'END_FINALLY': -3,  # or -1 or -2 if no exception occurred or break/continue
+    'BUILD_CLASS': -2,
+
+    'STORE_NAME': -1,
+    'DELETE_NAME': 0,
+    # 1 at start of iterator, -1 at end of iterator, balances out to 0
+    'FOR_ITER': 0,
+
+    'STORE_ATTR': -2,
+    'DELETE_ATTR': -1,
+    'STORE_GLOBAL': -1,
+    'DELETE_GLOBAL': 0,
+    'LOAD_CONST': 1,
+    'LOAD_NAME': 1,
+    'BUILD_MAP': 1,
+    'LOAD_ATTR': 0,
+    'COMPARE_OP': -1,
+    'IMPORT_NAME': -1,
+    'IMPORT_FROM': 1,
+
+    'JUMP_FORWARD': 0,
+    'JUMP_IF_TRUE_OR_POP': 0,  # -1 if jump not taken
+    'JUMP_IF_FALSE_OR_POP': 0,  # -1 if jump not taken
+    'JUMP_ABSOLUTE': 0,
+
+    'POP_JUMP_IF_FALSE': -1,
+    'POP_JUMP_IF_TRUE': -1,
+
+    'LOAD_GLOBAL': 1,
+
+    'CONTINUE_LOOP': 0,
+    'SETUP_LOOP': 0,
+    'SETUP_EXCEPT': 0,
+    'SETUP_FINALLY': 0,
+
+    'LOAD_FAST': 1,
+    'STORE_FAST': -1,
+    'DELETE_FAST': 0,
+
+    'LOAD_CLOSURE': 1,
+    'LOAD_DEREF': 1,
+    'STORE_DEREF': -1,
+}
+
+
+def _stack_effect2(op_code, oparg):
+  """Compute the effect an op_code and oparg have on the stack.  See python/compile.c."""
+  n_args = lambda o: (o % 256) + 2 * (o // 256)
+
+  if op_code == 'DUP_TOPX':
+    return oparg
+  elif op_code == 'UNPACK_SEQUENCE':
+    return oparg - 1
+  elif op_code == 'BUILD_TUPLE':
+    return -oparg  # Was 1 - oparg
+  elif op_code == 'BUILD_LIST':
+    return -oparg  # Was 1 - oparg
+  elif op_code == 'BUILD_SET':
+    return -oparg  # Was 1 - oparg
+  elif op_code == 'RAISE_VARARGS':
+    return -oparg
+  elif op_code == 'CALL_FUNCTION':
+    return -n_args(oparg)  # args + (#kwargs << 8)
+  elif op_code == 'CALL_FUNCTION_VAR':
+    return -n_args(oparg) - 1  # args + (#kwargs << 8)
+  elif op_code == 'CALL_FUNCTION_KW':
+    return -n_args(oparg) - 1  # args + (#kwargs << 8)
+  elif op_code == 'CALL_FUNCTION_VAR_KW':
+    return -n_args(oparg) - 2  # args + (#kwargs << 8)
+  elif op_code == 'MAKE_FUNCTION':
+    return -oparg
+  elif op_code == 'BUILD_SLICE':
+    if oparg == 3:
+      return -2
+    else:
+      return -1
+  elif op_code == 'MAKE_CLOSURE':
+    return -oparg - 1
+
+  if op_code not in _STACK_EFFECTS2 and not qj._DEBUG_QJ:
+    return 0  # Avoid crashing just because of updated bytecode functionality.
+  return _STACK_EFFECTS2[op_code]
+
+
+def _build_instruction_stack2(co, lasti):
+  code = co.co_code
+
+  linestarts = dict(dis.findlinestarts(co))
+
+  stack = []
+
+  num_instr = len(code)
+
+  if qj._DEBUG_QJ:
+    assert lasti < num_instr
+  if lasti >= num_instr:
+    return []
+
+  instr = 0
+  extended_arg = 0
+  free = None
+  curr_l = 0
+  while instr <= lasti:
+    curr_i = instr
+    if instr in linestarts:
+      curr_l = linestarts[instr]
+
+    op = ord(code[instr])
+    opname = opcode.opname[op]
+
+    oparg = -1
+    oparg_repr = ''
+
+    instr += 1
+
+    if op >= opcode.HAVE_ARGUMENT:
+      oparg = ord(code[instr]) + ord(code[instr + 1]) * 256 + extended_arg
+      extended_arg = 0
+      instr += 2
+      if op == opcode.EXTENDED_ARG:
+        extended_arg = oparg * 65536
+
+      if op in opcode.hasconst:
+        oparg_repr = co.co_consts[oparg]
+        if isinstance(oparg_repr, types.CodeType):
+          qj._DEBUG_QJ and _disassemble2(oparg_repr, -1)
+          if oparg_repr.co_name == '<lambda>':
+            oparg_repr = ['lambda', ':']
+          elif oparg_repr.co_name == '<dictcomp>' or oparg_repr.co_name == '<setcomp>':
+            oparg_repr = ['{', '}']
+          elif oparg_repr.co_name == '<genexpr>':
+            oparg_repr = ['(', ')']
+          else:
+            oparg_repr = ''
+      elif op in opcode.hasname:
+        oparg_repr = co.co_names[oparg]
+      elif op in opcode.hasjrel:
+        oparg_repr = ''  # instr + oparg
+      elif op in opcode.haslocal:
+        oparg_repr = co.co_varnames[oparg]
+        if oparg_repr.startswith('.'):
+          oparg_repr = ''  # Skip unnamed locals like .0
+      elif op in opcode.hascompare:
+        oparg_repr = opcode.cmp_op[oparg]
+      elif op in opcode.hasfree:
+        if free is None:
+          free = co.co_cellvars + co.co_freevars
+        oparg_repr = free[oparg]
+
+      if oparg > 0:
+        if opname == 'BUILD_LIST':
+          oparg_repr = ']'
+        elif opname == 'BUILD_TUPLE':
+          oparg_repr = ')'
+        elif opname == 'BUILD_SET':
+          oparg_repr = '}'
+        elif opname == 'BUILD_MAP':
+          oparg_repr = '{'  # BUILD_MAP happens at the beginning of the map
+        elif opname == 'LIST_APPEND':
+          oparg_repr = ']'
+        elif opname == 'SET_ADD':
+          oparg_repr = ''
+        elif opname.startswith('CALL_FUNCTION'):
+          oparg_repr = ')'
+        elif opname == 'MAP_ADD':
+          oparg_repr = ''
+        elif opname == 'FOR_ITER':
+          oparg_repr = ''
+        else:
+          oparg_repr = ''  # Default representation is empty.
+
+      elif oparg == 0:
+        if opname == 'BUILD_LIST':
+          # BUILD_LIST 0 occurs at the beginning of list comprehensions
+          oparg_repr = '['
+        elif opname == 'BUILD_TUPLE':
+          oparg_repr = '('
+        elif opname == 'BUILD_SET':
+          oparg_repr = '{'
+        elif opname == 'BUILD_MAP':
+          oparg_repr = '{'
+        elif opname.startswith('CALL_FUNCTION'):
+          oparg_repr = ')'
+        elif opname == 'MAKE_CLOSURE':
+          oparg_repr = ''
+        else:
+          oparg_repr = ''  # Default representation is empty.
+
+    else:
+      # Ops without arguments.
+      if opname == 'UNARY_POSITIVE':
+        oparg_repr = '+'
+      elif opname == 'UNARY_NEGATIVE':
+        oparg_repr = '-'
+      elif opname == 'UNARY_NOT':
+        oparg_repr = ''  # TODO(iansf)
+      elif opname == 'UNARY_CONVERT':
+        oparg_repr = ''  # TODO(iansf)
+      elif opname == 'UNARY_INVERT':
+        oparg_repr = '~'
+      elif opname == 'BINARY_POWER':
+        oparg_repr = '**'
+      elif opname == 'BINARY_MULTIPLY':
+        oparg_repr = '*'
+      elif opname == 'BINARY_DIVIDE':
+        oparg_repr = '/'
+      elif opname == 'BINARY_MODULO':
+        oparg_repr = '%'
+      elif opname == 'BINARY_ADD':
+        oparg_repr = '+'
+      elif opname == 'BINARY_SUBTRACT':
+        oparg_repr = '-'
+      elif opname == 'BINARY_SUBSCR':
+        oparg_repr = ']'
+      elif opname == 'BINARY_FLOOR_DIVIDE':
+        oparg_repr = '//'
+      elif opname == 'BINARY_TRUE_DIVIDE':
+        oparg_repr = '/'
+      elif opname == 'BINARY_LSHIFT':
+        oparg_repr = '<<'
+      elif opname == 'BINARY_RSHIFT':
+        oparg_repr = '>>'
+      elif opname == 'BINARY_AND':
+        oparg_repr = '&'
+      elif opname == 'BINARY_XOR':
+        oparg_repr = '^'
+      elif opname == 'BINARY_OR':
+        oparg_repr = '|'
+      elif opname == 'GET_ITER':
+        oparg_repr = ''
+      elif opname.startswith('SLICE+'):
+        oparg_repr = ':'
+      else:
+        oparg_repr = ''  # Default representation is empty.
+
+    stack_entry = _StackEntry(
+        _stack_effect2(opname, oparg),
+        curr_i,
+        curr_l,
+        opname,
+        oparg,
+        oparg_repr if isinstance(oparg_repr, list) else [str(oparg_repr)],
+        [],  # children
+    )
+
+    stack.append(stack_entry)
+
+  qj._DEBUG_QJ and [qj.LOG_FN('se: %s' % str(se)) for se in stack] and qj.LOG_FN('\n\n')
+
+  return stack
+
+
+_disassemble = _disassemble2 if sys.version_info[0] < 3 else _disassemble3
+
+
+class _StackEntry(object):
+  """An entry in the decompilation stack."""
+
+  def __init__(self,
+               stack_depth,
+               curr_i,
+               curr_l,  # According to python, but can be inaccurate
+               opname,
+               oparg,
+               oparg_repr,
+               children,  # Array of StackEntries
+              ):
+    self.stack_depth = stack_depth
+    self.curr_i = curr_i
+    self.curr_l = curr_l
+    self.opname = opname
+    self.oparg = oparg
+    self.oparg_repr = oparg_repr
+    self.children = children
+
+  def __str__(self):
+    # pylint: disable=bad-continuation
+    return ('_StackEntry(stack_depth: {stack_depth}, '
+                        'curr_i: {curr_i}, '
+                        'opname: \'{opname}\', '
+                        'oparg: {oparg}, '
+                        'oparg_repr: {oparg_repr}, '
+                        'children: {children}'
+                        ')'.format(
+                            **self.__dict__))
+# pylint: enable=bad-continuation
+
+  __repr__ = __str__
+
+
+def _match_tokens(target, tokens, search_start, search_end):
+  """Find the tokens in order in target[search_start:search_end].
+
+  Each token is placed at its earliest occurrence after the previous one, which
+  finds a match whenever one exists, and the same match as the regex
+  'token0.*?token1.*?...', in one pass over the search area.
+
+  Returns:
+    The (start, end) of the match, or None.
+  """
+  start = -1
+  pos = search_start
+  for token in tokens:
+    pos = target.find(token, pos, search_end)
+    if pos < 0:
+      return None
+    if start < 0:
+      start = pos
+    pos += len(token)
+  return start, pos
+
+
+def _find_earliest_shortest_match(target, tokens, num_attempts=10):
+  """Find the shortest match of tokens that ends where the earliest match ends.
+
+  Returns:
+    The (start, end) of the match, or None.
+  """
+  match = _match_tokens(target, tokens, 0, len(target))
+  qj._DEBUG_QJ and qj.LOG_FN('found match: %r' % (match and target[match[0]:match[1]],))
+  for _ in range(num_attempts - 1):
+    if match is None:
+      break
+    # Later starts can only end at the same place or later, so only matches that
+    # end at the same place are shorter.
+    shorter = _match_tokens(target, tokens, match[0] + 1, match[1])
+    if shorter is None:
+      break
+    match = shorter
+    qj._DEBUG_QJ and qj.LOG_FN('found new shortest match: %r' % target[match[0]:match[1]])
+  return match
+
+
+def _annotate_fn_args(stack, fn_opname, nargs, nkw=-1, consume_fn_name=True):
+  """Add commas and equals as appropriate to function argument lists in the stack."""
+  kwarg_names = []
+  if nkw == -1:
+    if sys.version_info[0] < 3:
+      # Compute nkw and nargs from nargs for python 2.7
+      nargs, nkw = (nargs % 256, 2 * nargs // 256)
+    elif fn_opname == 'CALL_FUNCTION_KW':
+      if qj._DEBUG_QJ:
+        assert len(stack) and stack[-1].opname == 'LOAD_CONST'
+      if not len(stack) or stack[-1].opname != 'LOAD_CONST':
+        return
+      se = stack.pop()
+      kwarg_names = se.oparg_repr[::-1]
+      se.oparg_repr = ['']
+      nkw = len(kwarg_names)
+      nargs -= nkw
+      if qj._DEBUG_QJ:
+        assert nargs >= 0 and nkw > 0
+    else:
+      nkw = 0
+
+  for i in range(nkw):
+    se = stack.pop()
+    if se.stack_depth == 0 and (len(se.oparg_repr) == 0 or se.oparg_repr[0] == ''):
+      # Skip stack entries that don't have any effect on the stack
+      continue
+    if i % 2 == 1 and sys.version_info[0] < 3:
+      if qj._DEBUG_QJ:
+        assert se.opname == 'LOAD_CONST'
+      if se.opname == 'LOAD_CONST':
+        # kwargs are pairs of key=value in code
+        se.oparg_repr += ['=']
+      continue
+    if se.opname.startswith('CALL_FUNCTION'):
+      _annotate_fn_args(stack[:], se.opname, se.oparg, -1, True)
+    pops = _collect_pops(stack, se.stack_depth - 1 if se.opname.startswith('CALL_FUNCTION') else 0, [], False)
+    if i > 1 and len(pops):
+      pops[-1].oparg_repr += [',']
+    if sys.version_info[0] >= 3:
+      target_se = pops[-1] if len(pops) else se
+      target_se.oparg_repr = [kwarg_names[i], '='] + target_se.oparg_repr
+
+  for i in range(nargs):
+    se = stack.pop()
+    if se.opname.startswith('CALL_FUNCTION'):
+      _annotate_fn_args(stack, se.opname, se.oparg, -1, True)
+    elif len(se.oparg_repr) and se.oparg_repr[0] in {']', '}', ')'}:
+      if (i > 0 or nkw > 0):
+        se.oparg_repr += [',']
+    else:
+      pops = _collect_pops(stack, se.stack_depth, [], False)
+      if (i > 0 or nkw > 0) and len(pops):
+        pops[-1].oparg_repr += [',']
+
+  if consume_fn_name:
+    _collect_pops(stack, -1, [], False)
+
+
+def _collect_pops(stack, depth, pops, skip):
+  """Recursively collects stack entries off the top of the stack according to the stack entry's depth."""
+  if depth >= 0:
+    return pops
+
+  set_current_depth_after_recursion = False
+  set_skip_for_current_entry_children = False
+  set_skip_after_current_entry = False
+  extract_next_tokens = False
+  expect_extracted_tokens = []
+
+  se = stack.pop()
+  pops_len = len(pops)
+  if (pops_len > 1
+      and se.opname == 'BUILD_TUPLE'
+      and pops[-1].opname == 'LOAD_CONST'
+      and pops[-1].oparg_repr[0] in ['lambda', '{', '(', '[']
+      and pops[-2].opname in ['MAKE_CLOSURE', 'MAKE_FUNCTION']):
+    # Skip BUILD_TUPLE and its children if they are storing arguments for a closure, since those don't show up in the code.
+    skip = -se.stack_depth + 1
+
+  if (pops_len > 2
+      and sys.version_info[0] >= 3
+      and se.opname == 'BUILD_TUPLE'
+      and pops[-1].opname == 'LOAD_CONST'
+      and pops[-1].oparg_repr[0] in ['lambda', '{', '(', '[']
+      and pops[-2].opname == 'LOAD_CONST'
+      and pops[-3].opname in ['MAKE_CLOSURE', 'MAKE_FUNCTION']):
+    # Skip BUILD_TUPLE and its children if they are storing arguments for a closure, since those don't show up in the code.
+    skip = -se.stack_depth + 1
+
+  if (pops_len > 0
+      and se.opname == 'GET_ITER'
+      and pops[-1].opname in ('CALL_FUNCTION', 'PRECALL')):
+    # CALL_FUNCTION or PRECALL followed by GET_ITER means we are calling one of the comprehensions and we are about to load its arguments.
+    # The CALL_FUNCTION or PRECALL at the top of the stack should be invisible, since it expects a ')' which won't appear in the code.
+    if pops[-1].opname == 'PRECALL' and len(pops) > 2 and pops[-2].opname == 'CALL':
+      # In the case of the PRECALL CALL patter, the CALL has the expected ')' that shouldn't appear.
+      pops[-2].oparg_repr = ['']
+    else:
+      # Otherwise it's the CALL_FUNCTION that needs modification
+      pops[-1].oparg_repr = ['']
+    # We need to extract the arguments that we're about to load so that we can store their tokens inside of the upcoming comprehension.
+    extract_next_tokens = -1
+    expect_extracted_tokens = [
+        # Expect BUILD_TUPLE as the last stack token extracted (required=False) and replace its oparg_repr with ''.
+        (0, 'BUILD_TUPLE', False, 'replace', [''])
+    ]
+
+  if (pops_len > 1
+      and len(stack) > 0
+      and stack[-1].opname == 'BUILD_LIST'
+      and se.opname == 'LOAD_FAST'
+      and pops[-1].opname == 'LIST_EXTEND'
+      and pops[-2].opname == 'LIST_TO_TUPLE'):
+    # BUILD_LIST followed by LOAD_FAST followed LIST_EXTEND followed by LIST_TO_TUPLE probably means we are calling a function with *args.
+    # Prepend the LOAD_FAST repr with '*' and remove the other reprs.
+    se.oparg_repr = ['*'] + se.oparg_repr
+    stack[-1].oparg_repr = ['']
+    pops[-1].oparg_repr = ['']
+    pops[-2].oparg_repr = ['']
+
+  if (pops_len > 0
+      and len(stack) > 1
+      and stack[-2].opname == 'BUILD_TUPLE'
+      and stack[-1].opname == 'BUILD_MAP'
+      and se.opname == 'LOAD_FAST'
+      and pops[-1].opname == 'DICT_MERGE'):
+    # BUILD_TUPLE followed by BUILD_MAP followed by LOAD_FAST followed DICT_MERGE probably means we are calling a function with **kwargs.
+    # Remove the BUILD_TUPLE repr but leave the others alone, as they will be handled further below.
+    stack[-2].oparg_repr = ['']
+
+  if (pops_len > 0
+      and len(stack) > 0
+      and stack[-1].opname == 'BUILD_MAP'
+      and se.opname == 'LOAD_FAST'
+      and pops[-1].opname == 'DICT_MERGE'):
+    # BUILD_MAP followed by LOAD_FAST followed DICT_MERGE probably means we are calling a function with **kwargs.
+    # Prepend the LOAD_FAST repr with '**' and remove the BUILD_MAP and DICT_MERGE reprs.
+    se.oparg_repr = ['**'] + se.oparg_repr
+    stack[-1].oparg_repr = ['']
+    pops[-1].oparg_repr = ['']
+
+  if (len(stack)
+      and se.opname == 'BUILD_TUPLE_UNPACK_WITH_CALL'):
+    extract_next_tokens = se.stack_depth
+    expect_extracted_tokens = [
+        # Expect LOAD_FAST as the first element (required=True), and prepend its oparg_repr with '*'.
+        (0, 'LOAD_FAST', True, 'prepend', ['*']),
+        # Expect BUILD_TUPLE as the last stack token extracted (required=False) and replace its oparg_repr with ''.
+        (abs(extract_next_tokens) - 1, 'BUILD_TUPLE', False, 'replace', [''])
+    ]
+    set_current_depth_after_recursion = se.stack_depth
+    se.stack_depth = 0
+
+  if (pops_len > 0
+      and sys.version_info[0] >= 3
+      and se.opname == 'LOAD_CONST'
+      and pops[-1].opname == 'MAKE_FUNCTION'):
+    # In python 3, MAKE_FUNCTION followed by LOAD_CONST is loading the name of the function, which won't appear in the code.
+    se.oparg_repr = ['']
+    # Additionally, this entry shouldn't impact future stack computations, as MAKE_FUNCTION will be removed.
+    set_current_depth_after_recursion = 0
+
+  if pops_len and pops[-1].opname == 'LIST_APPEND':
+    # Skip all but the first stack entry of list comprehensions. Sets the skip value to be all remaining stack entries.
+    # The BUILD_LIST check below will disable skip at the right time.
+    set_skip_after_current_entry = len(stack)
+
+  if skip > 0 and se.opname == 'BUILD_LIST' and se.stack_depth == 0:
+    # If we're in skip mode and we just hit what might be the beginning of a list comprehension, check for a LIST_APPEND in the current pops.
+    for popped_se in pops[::-1]:
+      if popped_se.opname == 'LIST_APPEND':
+        skip = 0
+        break
+
+  children_skip = skip
+  if (se.opname.startswith('UNARY_')
+      or (se.opname.startswith('BINARY_') and se.opname != 'BINARY_SUBSCR')
+      or se.opname == 'SLICE+2'
+      or se.opname == 'SLICE+3'
+      or se.opname in ('COMPARE_OP', 'CONTAINS_OP', 'IS_OP')):
+    # Unary and binary ops come after their operand(s) on the stack, but before (or between) their operand(s) in code, so we need to reverse that.
+
+    if set_skip_for_current_entry_children or skip > 0:
+      children_skip = 1
+    pops = _collect_pops(stack, -1, pops, children_skip)
+
+    if skip <= 0:
+      pops.append(se)
+      qj._DEBUG_QJ and qj.LOG_FN('added se: %r' % se)
+    else:
+      qj._DEBUG_QJ and qj.LOG_FN('(skipping se: %r %r)' % (se.opname, se.oparg_repr))
+
+    popped_depth = se.stack_depth + 1
+  else:
+    # Non prefix/infix ops -- their representations come after their children in code, or they don't have children.
+    if skip <= 0:
+      pops.append(se)
+      qj._DEBUG_QJ and qj.LOG_FN('added se: %r' % se)
+    else:
+      qj._DEBUG_QJ and qj.LOG_FN('(skipping se: %r %r)' % (se.opname, se.oparg_repr))
+
+    if ((se.stack_depth < 0
+         and se.opname != 'BUILD_SLICE'
+         and se.opname.startswith('BUILD_'))
+        or se.stack_depth >= 0):
+      next_depth = se.stack_depth
+    elif (se.stack_depth < 0
+          and se.opname == 'DICT_MERGE'):
+      next_depth = se.stack_depth
+    else:
+      next_depth = se.stack_depth - 1
+
+    if set_skip_for_current_entry_children or skip > 0:
+      children_skip = abs(next_depth)
+    if se.opname == 'BUILD_SLICE':
+      # BUILD_SLICE's arguments need to be collected, as missing args are replaced with Nones which don't appear in the code.
+      slice_pops = _collect_pops(stack, next_depth, [], children_skip)
+      added_colon = 0
+      for slice_se in slice_pops:
+        if slice_se.opname == 'LOAD_CONST' and slice_se.oparg_repr[0] == 'None':
+          if added_colon >= 1:
+            slice_se.oparg_repr = ['']
+          else:
+            slice_se.oparg_repr = [':']
+            added_colon += 1
+        pops.append(slice_se)
+    else:
+      pops = _collect_pops(stack, next_depth, pops, children_skip)
+
+    # BUILD_LIST 0 marks the start of a list comprehension, but we need it to consume a slot on the stack.
+    if se.stack_depth == 0 and se.opname != 'BUILD_LIST':
+      popped_depth = 0
+    else:
+      popped_depth = 1
+
+  tokens = []
+  if extract_next_tokens < 0:
+    tokens = _collect_pops(stack, extract_next_tokens, [], skip)
+    for index, expected_token, required, fixup_type, fixup_value in expect_extracted_tokens:
+      if qj._DEBUG_QJ:
+        assert (index < 0 and index + len(tokens) > 0) or 0 <= index < len(tokens)
+        if required:
+          assert tokens[index].opname == expected_token
+      if (index < 0 and index + len(tokens) > 0) or 0 <= index < len(tokens) and tokens[index].opname == expected_token:
+        if fixup_type == 'prepend':
+          tokens[index].oparg_repr = fixup_value + tokens[index].oparg_repr
+        elif fixup_type == 'replace':
+          tokens[index].oparg_repr = fixup_value
+    tokens.reverse()
+    popped_depth -= extract_next_tokens
+
+  if children_skip > 0:
+    skip -= popped_depth
+
+  if set_skip_after_current_entry > 0:
+    skip = set_skip_after_current_entry + max(0, skip)
+
+  pops = _collect_pops(stack, depth + popped_depth, pops, skip)
+
+  if len(tokens):  # pylint: disable=g-explicit-length-test
+    target_se = pops[-1]
+    target_se.children.append(tokens)
+    target_se.oparg_repr = target_se.oparg_repr[:1] + [t for token in tokens for t in token.oparg_repr] + target_se.oparg_repr[1:]
+
+  if set_current_depth_after_recursion is not False:
+    se.stack_depth = set_current_depth_after_recursion
+
+  return pops
+
+
+class _SourceIndex(object):
+  """The stripped source lines of a file, shared by every call site in it.
+
+  Blank lines and comments never appear in labels, so the remaining code lines
+  are joined into a single string once, and a range of lines is a slice of it.
+  """
+
+  __slots__ = ('stamp', 'lines', 'is_comment', 'code_lines', 'text', 'starts',
+               'ends', 'block_ends')
+
+  def __init__(self, stamp, lines):
+    self.stamp = stamp
+    # Last lines of the blocks starting at each line, computed as needed.
+    self.block_ends = {}
+    self.lines = [l.strip() for l in lines]
+    self.is_comment = [not l or l.startswith('#') for l in self.lines]
+    # Line numbers of the lines that are neither blank nor comments.
+    self.code_lines = [i + 1 for i, skip in enumerate(self.is_comment) if not skip]
+    self.starts = []
+    self.ends = []
+    offset = 0
+    for line in self.code_lines:
+      self.starts.append(offset)
+      offset += len(self.lines[line - 1])
+      self.ends.append(offset)
+      offset += 1
+    self.text = ' '.join(self.lines[line - 1] for line in self.code_lines)
+
+  def chunk(self, first, last):
+    """Returns code lines first through last (indices into code_lines), joined."""
+    if first > last:
+      return ''
+    return self.text[self.starts[first]:self.ends[last]]
+
+
+def _source_index(filename, module_globals=None):
+  """Returns the _SourceIndex of filename, rebuilding it if the file changed."""
+  try:
+    st = os.stat(filename)
+    stamp = (st.st_mtime, st.st_size)
+  except OSError:
+    # Not a file on disk, e.g., an ipython cell, so only linecache has its lines.
+    stamp = None
+  index = qj._source_indexes.get(filename)
+  if index is not None and (index.stamp == stamp if stamp is not None
+                            else linecache.cache.get(filename, (0, 0, None))[2] is index.stamp):
+    return index
+
+  linecache.checkcache(filename)
+  lines = linecache.getlines(filename, module_globals)
+  if not lines:
+    raise IOError('could not get source code for %s' % filename)
+  if stamp is None:
+    stamp = linecache.cache.get(filename, (0, 0, None))[2]
+  index = qj._source_indexes[filename] = _SourceIndex(stamp, lines)
+  return index
+
+
+# Number of times a search for a call's source can widen by a line on each side.
+_MAX_EXPANSIONS = 9
+
+
+def _last_line(co, index, module_globals=None):
+  """Returns the last source line of code object co."""
+  if hasattr(co, 'co_positions'):
+    # Positions include the end of multiline expressions, like a call's ')'.
+    return max([end for _, end, _, _ in co.co_positions() if end is not None]
+               or [co.co_firstlineno])
+  # Before Python 3.11, line numbers only cover lines that start instructions,
+  # which misses the end of multiline calls, so co is bounded by the end of the
+  # block it starts, as in inspect.getsourcelines.
+  if co.co_name == '<module>':
+    return len(index.lines)
+  end = index.block_ends.get(co.co_firstlineno)
+  if end is None:
+    import inspect  # pylint: disable=g-import-not-at-top
+    lines = linecache.getlines(co.co_filename, module_globals)
+    try:
+      block = inspect.getblock(lines[co.co_firstlineno - 1:])
+      end = co.co_firstlineno + len(block) - 1
+    except Exception:  # pylint: disable=broad-except
+      # The block couldn't be tokenized, so don't bound the search.
+      end = len(index.lines)
+    index.block_ends[co.co_firstlineno] = end
+  return end
+
+
+def _find_current_fn_call(co, lasti, module_globals=None):
+  """Find current function call in the byte code."""
+  qj._DEBUG_QJ and qj.LOG_FN('co = {}'.format(co))
+
+  if sys.version_info[0] < 3:
+    stack = _build_instruction_stack2(co, lasti)
+  else:
+    stack = _build_instruction_stack3(co, lasti)
+
+  index = _source_index(co.co_filename, module_globals)
+
+  # Apply stack effects backwards until we arrive at the stack entries for a complete function call
+  fn_stack = _collect_pops(stack[:-1], stack[-1].stack_depth, [], 0)
+
+  if not fn_stack and stack[-1].stack_depth == 0:
+    # The function call took 0 arguments, so return early with a special string.
+    return '<empty log>'
+
+  qj._DEBUG_QJ and qj.LOG_FN('collected fn_stack:\n%s\n\n' % '\n'.join(str(se) for se in fn_stack))
+
+  # Prepare to annotate the stack with extra symbols, and filter out MAKE_FUNCTION and MAKE_CLOSURE calls, which are no longer needed.
+  annotate_stack = [se for se in fn_stack if not se.opname.startswith('MAKE_')]
+  annotate_stack.reverse()
+  _annotate_fn_args(annotate_stack, stack[-1].opname, stack[-1].oparg, -1, False)
+
+  qj._DEBUG_QJ and qj.LOG_FN('annotated fn_stack:\n%s\n\n' % '\n'.join(str(se) for se in fn_stack))
+
+  # Find the range of lines to search over.
+  min_l = stack[-1].curr_l
+  max_l = stack[0].curr_l
+  for se in fn_stack:
+    min_l = min(min_l, se.curr_l)
+    max_l = max(max_l, se.curr_l)
+
+  # Searches may widen to nearby code lines, but not outside the code object.
+  lowest = bisect.bisect_left(index.code_lines, co.co_firstlineno)
+  highest = max(bisect.bisect_right(index.code_lines, _last_line(co, index, module_globals)) - 1,
+                lowest)
+  first = bisect.bisect_left(index.code_lines, min_l)
+  last = bisect.bisect_right(index.code_lines, max_l) - 1
+  qj._DEBUG_QJ and qj.LOG_FN('source lines range: %d -> %d (code lines: %d, %d)' % (min_l, max_l, first, last))
+  source_chunk = index.chunk(first, last)
+
+  qj._DEBUG_QJ and qj.LOG_FN('source_chunk: %r' % source_chunk)
+
+  # Build up all of the tokens for the function call.
+  tokens = []
+  for se in fn_stack:
+    opname = se.opname
+    for oparg_repr in se.oparg_repr[::-1]:
+      # Clean up the tokens
+      if not oparg_repr:
+        continue
+      oparg_repr = oparg_repr.replace('\n', '\\n')
+      tokens.append(oparg_repr)
+
+  tokens.reverse()
+  qj._DEBUG_QJ and qj.LOG_FN('extracted tokens: {}'.format(tokens))
+  if qj._DEBUG_QJ:
+    assert tokens
+
+  # Add tokens for the function call we're extracting.
+  tokens = ['('] + tokens + [')']
+
+  # Search for the function call using the full set of tokens.
+  # Expand the search with source lines before and after the current set if we
+  # don't find a match, at most _MAX_EXPANSIONS times.
+  shortest_match = _find_earliest_shortest_match(source_chunk, tokens)
+  expansions = 0
+  while (shortest_match is None and expansions < _MAX_EXPANSIONS
+         and (first > lowest or last < highest)):
+    expansions += 1
+    if first > lowest:
+      first -= 1
+    if last < highest:
+      last += 1
+    source_chunk = index.chunk(first, last)
+    shortest_match = _find_earliest_shortest_match(source_chunk, tokens)
+
+  # Return the string for the function call
+  if qj._DEBUG_QJ:
+    assert shortest_match
+  if shortest_match is not None:
+    match = source_chunk[shortest_match[0]:shortest_match[1]]
+    if qj._DEBUG_QJ:
+      assert match.startswith('(') and match.endswith(')')
+    # Do some parentheses cleanup.
+    if match.startswith('('):
+      match = match[1:]
+    lparens = match.count('(')
+    rparens = match.count(')')
+    if lparens > rparens:
+      match += ')' * (lparens - rparens)
+    elif lparens < rparens:
+      rparens_to_remove = rparens - lparens
+      while len(match) and match[-1] == ')' and rparens_to_remove > 0:
+        match = match[:-1]
+        rparens_to_remove -= 1
+    match = match.strip()
+    return match
+  else:
+    return ''
+
+# pylint: enable=protected-access, expression-not-assigned, line-too-long
@@ -22,17 +22,26 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import collections
-import dis
 import functools
-import inspect
-import logging
-import opcode
+import math
 import os
-import re
 import sys
 import time as _time
 import types
+import weakref
+
+try:
+  import _thread
+except ImportError:  # Python 2
+  import thread as _thread  # pylint: disable=g-import-not-at-top
+try:
+  import reprlib
+except ImportError:  # Python 2
+  import repr as reprlib  # pylint: disable=g-import-not-at-top
+
+# Intervals are measured with a monotonic clock where there is one (Python 3),
+# so that wall clock steps don't stretch or shrink them.
+_monotonic = getattr(_time, 'monotonic', _time.time)
 
 
 _QJ_R_MAGIC = 0x93218231
@@ -56,6 +65,11 @@ def qj(x='',  # pylint: disable=invalid-name
        time=False,
        catch=False,
        log_all_calls=False,
+       it=False,
+       rate_meter=False,
+       agg=False,
+       changed=False,
+       diff=False,
        _depth=1):
   """A combined logging and debugging function.
 
@@ -80,8 +94,10 @@ def qj(x='',  # pylint: disable=invalid-name
        it isn't too spammy when running the graph. The call attempts to validate
        that tensorflow is available and that x can be passed to tensorflow.Print
        before calling tensorflow.Print.
-    n: Optional bool to log the shape, min, mean, and max values of x if numpy
-       is available.
+    n: Optional bool to log the shape, dtype, min, mean, std, max, histogram
+       and nan/inf counts of x if numpy is available. ndarrays are summarized
+       without being copied. Integers greater than 5 set the number of
+       histogram buckets.
     r: Optional alternate return value to use instead of x if x is logged. Any
        value passed to r will be returned (even None). Only the private value
        _QJ_R_MAGIC is ignored.
@@ -105,9 +121,29 @@ def qj(x='',  # pylint: disable=invalid-name
        decorator.  E.g., `@qj(time=100) def foo()...` will print timing stats
        every 100 calls to foo.
     catch: Optional bool to decorate a function with exception catching that
-       drops into the debugger.
-    log_all_calls: Optional bool to wrap x in a new object that logs every call
-       to x.  Experimental.
+       drops into the debugger, or, if qj.DUMP_DIR is set, writes a post-mortem
+       dump there instead.
+    log_all_calls: Optional bool to wrap x in a proxy that logs every call to
+       x's public methods.  Experimental.
+    it: Optional int to wrap the iterable x in a lazy iterator that logs the
+       first `it` items it yields, along with the running count and items per
+       second, and a summary when it is exhausted or closed. If `n` is also
+       set, the summary includes running stats of the numeric items.
+    rate_meter: Optional number of seconds. Instead of logging x, counts how
+       often this call site runs, and at most once every `rate_meter` seconds
+       logs the rate in events per second over the last 1, 10 and 60 seconds.
+    agg: Optional number of values. Instead of logging x, folds it into a
+       fixed-size summary for this call site (count, min, max, mean, std and a
+       power-of-two histogram), and logs and resets the summary every `agg`
+       values or every qj.AGG_SECONDS seconds (10 by default), whichever comes
+       first. `agg=1` reports every 1000 values.
+    changed: Optional bool. If set, only logs x when it differs from the value
+       last logged at this call site, and notes how many times the previous
+       value was repeated.
+    diff: Optional bool. If set, logs only what changed in x since the last log
+       at this call site: added, removed and changed keys for dicts, changed
+       index ranges for lists and tuples, added and removed items for sets, and
+       the number and range of changed elements for numpy arrays.
     _depth: Private parameter used to specify which stack frame should be used
             for both logging and debugging operations. If you're not wrapping
             qj or adding features to qj, you should leave this at it's default.
@@ -115,111 +151,104 @@ def qj(x='',  # pylint: disable=invalid-name
   Returns:
     x, which allows you to insert a call to qj just about anywhere.
   """
-  if qj.LOG and b:
+  # If qj's logger wouldn't let the log through, skip all the work for it.
+  if qj.LOG and b and ((qj.LOG_FN is not _log and qj.LOG_FN is not _notebook_log)
+                       or _logger_enabled()):
     try:
       # Compute and collect values needed for logging.
       # We need the caller's stack frame both for logging the function name and
       # line number qj was called from, and to store some state that makes the
       # more magical features work.
-      f = inspect.currentframe()
-      for _ in range(_depth):
-        f = f.f_back
-
-      # This is the magic dictionary where we write state that gives log output
-      # that can represent the underlying function's code structure, as well as
-      # tracking how many times we logged from the stack frame, which allows us
-      # to minimize log spam from logs in loops and comprehensions.
-      qj_dict = f.f_locals.get('__qj_magic_wocha_doin__', {})
-      qj_dict = {} if z else qj_dict
-      log_count_key = 'frame_log_count_%d' % f.f_lasti
-      qj_dict[log_count_key] = qj_dict.get(log_count_key, 0) + 1
-
-      if qj_dict[log_count_key] > qj.MAX_FRAME_LOGS:
+      f = sys._getframe(_depth)
+
+      # Rate meters only count events at this call site and log a report every
+      # so often, so most calls should return before doing anything else.
+      if rate_meter:
+        now = _monotonic()
+        site = (f.f_code, f.f_lasti)
+        with _site_lock(site):
+          meter = qj._rate_meters.get(site)
+          if meter is None:
+            meter = qj._rate_meters[site] = _RateMeter(now)
+          meter.add(now)
+          if now - meter.last_report < float(rate_meter):
+            return x
+          meter.last_report = now
+          rate_log = meter.report(now)
+
+      if agg:
+        now = _monotonic()
+        site = (f.f_code, f.f_lasti)
+        with _site_lock(site):
+          summary = qj._aggregates.get(site)
+          if summary is None:
+            summary = qj._aggregates[site] = _Aggregate(now)
+          summary.add(x)
+          if (summary.values < (int(agg) if agg > 1 else _AGG_COUNT)
+              and now - summary.start < qj.AGG_SECONDS):
+            return x
+          agg_log = summary.report()
+          summary.reset(now)
+
+      # Repeated values are detected with a fingerprint, so they cost neither
+      # formatting nor a log.
+      if changed:
+        site = (f.f_code, f.f_lasti)
+        fingerprint = _fingerprint(x)
+        with _site_lock(site):
+          last = qj._last_values.get(site)
+          if last is not None and last[0] == fingerprint:
+            last[1] += 1
+            return x
+          qj._last_values[site] = [fingerprint, 0]
+        repeats = last[1] if last is not None else 0
+
+      # Count the log against this frame and compute the log's function name and
+      # indentation, unless we've already logged too much from here.
+      frame_state = _frame_log_state(f, z)
+      if frame_state is None:
         return x
-
-      # We're going to log things, so go ahead and collect information about the
-      # caller's stack frame.
-      func_name = qj_dict.get('func_name')
-      if func_name is None:
-        func_name = inspect.getframeinfo(f).function
-        if func_name == '<dictcomp>':
-          func_name = inspect.getframeinfo(f.f_back).function
-        if func_name == '<genexpr>':
-          func_name = inspect.getframeinfo(f.f_back).function
-        if func_name == '<listcomp>':
-          func_name = inspect.getframeinfo(f.f_back).function
-        elif func_name == '<setcomp>':
-          func_name = inspect.getframeinfo(f.f_back).function
-        elif func_name == '<lambda>':
-          func_name = inspect.getframeinfo(f.f_back).function + '.lambda'
-        if func_name.startswith('<module>'):
-          func_name = func_name.replace('<module>', 'module_level_code')
-
-        filename = os.path.basename(f.f_code.co_filename)
-        # Don't include the filename when logging in ipython contexts.
-        if filename[0] != '<':
-          filename = filename.replace('.py', '')
-          func_name = '<{}> {}'.format(filename, func_name)
-        qj_dict['func_name'] = func_name
-
-      # If we are dealing with module-level code, don't limit logging, since
-      # large amounts of module-level logs generally means we're running in a
-      # colab, and it's annoying to have your logs suddenly stop after k runs.
-      if 'module_level_code' in func_name:
-        qj_dict[log_count_key] = 1
-
-      # This is the magic that allows us to indent the logs in a sensible
-      # manner. f_lasti is the last instruction index executed in the frame
-      # (i.e., the instruction that executed the call to qj). We add each
-      # instruction index into the dictionary, setting the value to the length
-      # of the dictionary after that addition, so the first instruction we see
-      # gets a value of 1, the second a value of 2, etc.
-      qj_instructions_dict = qj_dict.get('instructions', {})
-      qj_dict['instructions'] = qj_instructions_dict
-      qj_instructions_dict[f.f_lasti] = qj_instructions_dict.get(
-          f.f_lasti, len(qj_instructions_dict) + 1)
-      # Here, we use that value to determine how many spaces we need after the
-      # log prefix.
-      spaces = ' ' * qj_instructions_dict[f.f_lasti]
-      # And we store the dictionary back in the caller's frame.
-      f.f_locals['__qj_magic_wocha_doin__'] = qj_dict
+      qj_dict, log_count_key, func_name, spaces = frame_state
 
       # Try to extract the source code of this call if a string wasn't specified.
       if not s:
-        try:
-          code_key = '%s:%r:%s' % (f.f_code.co_filename, f.f_code.co_firstlineno, f.f_code.co_code)
-          fn_calls = qj._FN_MAPS.get(code_key, {})
-          if f.f_lasti not in fn_calls:
-            qj._DEBUG_QJ and qj._DISASSEMBLE_FN(f.f_code, f.f_lasti)
-            fn_calls[f.f_lasti] = _find_current_fn_call(f.f_code, f.f_lasti)
-            qj._FN_MAPS[f.f_code.co_code] = fn_calls
-          s = fn_calls.setdefault(f.f_lasti, '').strip()
-        except IOError:
-          # Couldn't get the source code, fall back to showing the type.
-          s = ''
+        s = _site_label(f)
 
       # Now that we've computed the call count and the indentation, we can log.
-      prefix = '%s:%s%s <%d>:' % (func_name, spaces, s or type(x), f.f_lineno)
+      prefix, head = _site_format(f, func_name, spaces, s or type(x))
       log = ''
 
       # First handle parameters that might change how x is logged.
-      if n and 'numpy' in sys.modules:
+      if n and not it and 'numpy' in sys.modules:
         try:
-          np = sys.modules['numpy']
-          np_x = np.array(x)
-          log = str((np_x.shape, (np.min(np_x),
-                                  (np.mean(np_x), np.std(np_x)),
-                                  np.max(np_x)),
-                     np.histogram(np_x,
-                                  bins=max(int(n),
-                                           min(np.prod(np_x.shape), 5)))[0]
-                    ))
+          log, key = _numeric_summary(sys.modules['numpy'], x, n)
           s = s or str(type(x))
-          s += ' (shape (min (mean std) max) hist)'
+          s += key
           prefix = '%s:%s%s <%d>:' % (func_name, spaces, s, f.f_lineno)
+          head = '%s%s %s' % (qj.PREFIX, prefix, qj._COLOR_LOG())
         except:  # pylint: disable=bare-except
           pass
 
+      if diff:
+        site = (f.f_code, f.f_lasti)
+        snapshot = _diff_snapshot(x)
+        with _site_lock(site):
+          before = qj._snapshots.get(site)
+          qj._snapshots[site] = snapshot
+        log = _diff_log(before, snapshot, x)
+
+      if changed and repeats:
+        s = s or str(type(x))
+        s += ' (previous value repeated %d time%s)' % (repeats, 's' if repeats > 1 else '')
+        prefix = '%s:%s%s <%d>:' % (func_name, spaces, s, f.f_lineno)
+        head = '%s%s %s' % (qj.PREFIX, prefix, qj._COLOR_LOG())
+
+      if rate_meter:
+        log = rate_log
+
+      if agg:
+        log = agg_log
+
       if tic and x == '':
         log = 'Adding tic.'
 
@@ -261,7 +290,7 @@ def qj(x='',  # pylint: disable=invalid-name
         qj.LOG_FN(padding_string)
 
       # Log the primary log message.
-      qj.LOG_FN('%s%s %s%s' % (qj.PREFIX, prefix, qj._COLOR_LOG(), log))
+      qj.LOG_FN(head + log)
 
       # If there's a lambda, run it and log it.
       if l:
@@ -273,18 +302,7 @@ def qj(x='',  # pylint: disable=invalid-name
       # If we requested x's properties, compute them and log them.
       if p:
         try:
-          if hasattr(inspect, 'signature'):
-            argspec_func = lambda f: str(inspect.signature(f))
-          else:
-            argspec_func = lambda f: inspect.formatargspec(*inspect.getargspec(f))
-          docs = [
-              '%s%s' % (n,
-                        argspec_func(v)
-                        if inspect.isroutine(v) and not inspect.isbuiltin(v)
-                        else '')
-              for n, v in inspect.getmembers(x)
-              if n == '__init__' or not n.startswith('_')
-          ]
+          docs = _public_members(x)
         except:  # pylint: disable=bare-except
           docs = [n for n in dir(x) if not n.startswith('_')]
         prefix_spaces = ' ' * len(prefix)
@@ -368,15 +386,19 @@ def qj(x='',  # pylint: disable=invalid-name
 
       # toc needs to be processed before tic, so that single call tic/toc works in loops.
       if toc:
-        if len(qj._tics):  # pylint: disable=g-explicit-length-test
-          prefix_spaces = ' ' * len(prefix)
+        # The tic stack is shared by all threads, so take the tics to pop
+        # under its lock.
+        with qj._tics_lock:
+          tics = qj._tics
           toc = int(toc)
           if toc < 0:
-            toc = len(qj._tics)
-          toc = min(toc, len(qj._tics))
+            toc = len(tics)
+          toc = min(toc, len(tics))
+          popped = [tics.pop() for _ in range(toc)]
+        if popped:
+          prefix_spaces = ' ' * len(prefix)
           toc_time = _time.time()
-          for _ in range(toc):
-            tic_ = qj._tics.pop()
+          for tic_ in popped:
             qj.LOG_FN('%s%s %s%.4f seconds since %s.' %
                       (qj.PREFIX, qj._COLOR_LOG(), prefix_spaces, toc_time - tic_[1], tic_[0]))
 
@@ -391,11 +413,13 @@ def qj(x='',  # pylint: disable=invalid-name
       if time:
         prefix_spaces = ' ' * len(prefix)
         if isinstance(x, types.FunctionType):
-          qj.LOG_FN('%s%s %sWrapping return value in timing function.' %
-                    (qj.PREFIX, qj._COLOR_LOG(), prefix_spaces))
-          # pylint: disable=no-value-for-parameter
-          x = _timing(logs_every=int(time))(x)
-          # pylint: enable=no-value-for-parameter
+          if _use_monitoring(x):
+            qj.LOG_FN('%s%s %sTiming calls with sys.monitoring.' %
+                      (qj.PREFIX, qj._COLOR_LOG(), prefix_spaces))
+          else:
+            qj.LOG_FN('%s%s %sWrapping return value in timing function.' %
+                      (qj.PREFIX, qj._COLOR_LOG(), prefix_spaces))
+          x = _timed(x, int(time))
         elif x == '':
           # x is '', so we'll assume it's the default value and we're decorating
           # a function
@@ -403,9 +427,13 @@ def qj(x='',  # pylint: disable=invalid-name
               (qj.LOG_FN('%s%s %sDecorating %s with timing function.' %
                          (qj.PREFIX, qj._COLOR_LOG(), prefix_spaces, str(f)))
                and False)
-              # pylint: disable=no-value-for-parameter
-              or _timing(logs_every=int(time))(f))
-          # pylint: enable=no-value-for-parameter
+              or _timed(f, int(time)))
+
+      if it and hasattr(x, '__iter__'):
+        prefix_spaces = ' ' * len(prefix)
+        qj.LOG_FN('%s%s %sWrapping return value in iterator logger.' %
+                  (qj.PREFIX, prefix_spaces, qj._COLOR_LOG()))
+        x = _LoggedIterator(x, s or str(type(x)), int(it), bool(n))
 
       if catch:
         prefix_spaces = ' ' * len(prefix)
@@ -431,41 +459,7 @@ def qj(x='',  # pylint: disable=invalid-name
         qj.LOG_FN('%s%s %sWrapping all public method calls for object.' %
                   (qj.PREFIX, qj._COLOR_LOG(), prefix_spaces))
 
-        def wrap(member_name, member_fn):
-          """Wrap member_fn in a lambda that logs."""
-          wrapped = (lambda *a, **kw:
-                     qj('%s(%s)' % (member_name,
-                                    ', '.join(['%r' % a_ for a_ in a]
-                                              + ['%s=%r' % (k, v) for k, v in kw.items()])),
-                        'calling %s' % member_name, _depth=2)
-                     and qj(member_fn(*a, **kw),
-                            'returning from %s' % member_name, _depth=2))
-          if hasattr(member_fn, '__doc__'):
-            wrapped.__doc__ = member_fn.__doc__
-          return wrapped
-
-        class Wrapper(type(x)):
-
-          def __init__(self, x):
-            method_types = (
-                types.BuiltinFunctionType, types.BuiltinMethodType,
-                types.FunctionType, types.LambdaType, types.MethodType
-            )
-            for m in inspect.getmembers(x):
-              name = m[0]
-              if not name.startswith('_'):
-                member = m[1]
-                if isinstance(member, method_types):
-                  wrapped_fn = wrap(name, member)
-                  setattr(self, name, wrapped_fn)
-                else:
-                  # pylint: disable=line-too-long
-                  # TODO(iansf): This may be wrong. See
-                  #              https://stackoverflow.com/questions/1325673/how-to-add-property-to-a-class-dynamically
-                  # pylint: enable=line-too-long
-                  setattr(self.__class__, name, member)
-
-        x = Wrapper(x)
+        x = _call_logger_type(type(x))(x)
 
       # If we requested an alternative return value, log it.
       if r != _QJ_R_MAGIC:
@@ -481,12 +475,7 @@ def qj(x='',  # pylint: disable=invalid-name
 
       # vvvvvvvv NO LOGS PERMITTED AFTER THIS BLOCK vvvvvvvv
       if qj_dict[log_count_key] == qj.MAX_FRAME_LOGS:
-        qj.LOG_FN('%s%s:%s%sMaximum per-frame logging hit (%d). '
-                  'No more logs will print at this call within this stack frame. '
-                  'Set qj.MAX_FRAME_LOGS to change the limit or pass z=1 to this qj call '
-                  'to zero out the frame log count.' %
-                  (qj.PREFIX, func_name, spaces, qj._COLOR_LOG(),
-                   qj.MAX_FRAME_LOGS))
+        _log_frame_limit(func_name, spaces)
       # ^^^^^^^^ NO LOGS PERMITTED AFTER THIS BLOCK ^^^^^^^^
 
       # If we requested debugging, drop into the debugger.
@@ -503,6 +492,8 @@ def qj(x='',  # pylint: disable=invalid-name
             except ImportError:
               import pdb  # pylint: disable=g-import-not-at-top
               qj.DEBUG_FN = lambda frame: pdb.Pdb().set_trace(frame=frame)
+        # Write out buffered logs, so they show up before the debugger does.
+        _flush_log()
         qj.DEBUG_FN(frame=f)
 
       # If we requested an alternative return value, return it now that
@@ -519,23 +510,178 @@ def qj(x='',  # pylint: disable=invalid-name
   return x
 
 
+def _iter_chunks(np_x, chunk_size, step):
+  """Yield flat chunks of np_x, keeping every step'th element.
+
+  Contiguous arrays are only ever sliced, so no chunk is a copy. Other arrays
+  are walked along their first axis, so at most one chunk at a time is copied.
+  """
+  if np_x.ndim <= 1 or np_x.flags.c_contiguous or np_x.flags.f_contiguous:
+    flat = np_x.ravel(order='K') if np_x.ndim > 1 else np_x.reshape(-1)
+    flat = flat[::step]
+    for i in range(0, flat.shape[0], chunk_size):
+      yield flat[i:i + chunk_size]
+  else:
+    row_size = np_x.size // np_x.shape[0]
+    rows = max(1, chunk_size // max(1, row_size))
+    offset = 0
+    for i in range(0, np_x.shape[0], rows):
+      chunk = np_x[i:i + rows].ravel()
+      yield chunk[(-offset) % step::step]
+      offset += chunk.shape[0]
+
+
+def _as_ndarray(np, x):
+  """View x as an ndarray, without copying it when possible.
+
+  ndarrays are returned as is. Objects that expose the buffer protocol but not
+  numpy's array interface (array.array, memoryview, bytes, bytearray, mmap,
+  ...) are wrapped through a memoryview, so numpy uses their memory directly
+  and interprets it with the buffer's own format rather than converting them
+  element by element (or, for bytes, into a single string scalar).
+  """
+  if isinstance(x, np.ndarray):
+    return x
+  if not (hasattr(x, '__array_interface__')
+          or hasattr(x, '__array_struct__')
+          or hasattr(x, '__array__')
+          or isinstance(x, (list, tuple))):
+    try:
+      view = memoryview(x)
+    except TypeError:
+      pass
+    else:
+      return np.asarray(view)
+  return np.asarray(x)
+
+
+def _numeric_summary(np, x, n):
+  """Summarize a numeric array-like for `n`.
+
+  Computes the shape, dtype, min, mean, std, max, histogram and nan/inf counts
+  of x. ndarrays, and anything exposing the buffer protocol or numpy's array
+  interface, are used in place rather than copied, and the statistics are
+  accumulated over fixed-size chunks (merging means and variances with Chan et
+  al.'s parallel update), so memory is streamed through once for the moments
+  and once more for the histogram. Setting qj.N_SAMPLE_SIZE bounds the work on
+  large arrays by summarizing an evenly strided sample instead.
+
+  Arguments:
+    np: The numpy module.
+    x: The value to summarize.
+    n: The value passed to qj's `n` argument, used for the number of histogram
+       buckets.
+
+  Returns:
+    A tuple of (log string, key describing the log string).
+
+  Raises:
+    TypeError: x isn't numeric.
+    ValueError: x is empty.
+  """
+  np_x = _as_ndarray(np, x)
+  if np_x.dtype.kind not in 'biuf':
+    raise TypeError('Not a numeric array: %s' % np_x.dtype)
+  if not np_x.size:
+    raise ValueError('Empty array.')
+  dtype = str(np_x.dtype)
+  if np_x.dtype.kind == 'b':
+    np_x = np_x.view(np.uint8)
+
+  step = 1
+  if qj.N_SAMPLE_SIZE and np_x.size > qj.N_SAMPLE_SIZE:
+    step = -(-np_x.size // int(qj.N_SAMPLE_SIZE))
+
+  is_float = np_x.dtype.kind == 'f'
+  count = 0
+  mean = 0.0
+  m2 = 0.0
+  lo = hi = None
+  nans = infs = 0
+  for chunk in _iter_chunks(np_x, _N_CHUNK_SIZE, step):
+    chunk_lo = chunk.min()
+    chunk_hi = chunk.max()
+    # nan propagates through min and max, and inf would be one of them, so the
+    # mask is only needed for chunks that actually have non-finite values.
+    if is_float and not (np.isfinite(chunk_lo) and np.isfinite(chunk_hi)):
+      finite = np.isfinite(chunk)
+      chunk_nans = int(np.count_nonzero(np.isnan(chunk)))
+      nans += chunk_nans
+      infs += chunk.shape[0] - int(np.count_nonzero(finite)) - chunk_nans
+      chunk = chunk[finite]
+      if not chunk.shape[0]:
+        continue
+      chunk_lo = chunk.min()
+      chunk_hi = chunk.max()
+    lo = chunk_lo if lo is None else min(lo, chunk_lo)
+    hi = chunk_hi if hi is None else max(hi, chunk_hi)
+    chunk = chunk.astype(np.float64, copy=False)
+    chunk_count = chunk.shape[0]
+    chunk_mean = float(chunk.mean())
+    centered = chunk - chunk_mean
+    chunk_m2 = float(np.dot(centered, centered))
+    delta = chunk_mean - mean
+    total = count + chunk_count
+    mean += delta * chunk_count / total
+    m2 += chunk_m2 + delta * delta * count * chunk_count / total
+    count = total
+
+  bins = max(int(n), min(np_x.size, 5))
+  hist = np.zeros(bins, dtype=np.int64)
+  if count:
+    for chunk in _iter_chunks(np_x, _N_CHUNK_SIZE, step):
+      if nans or infs:
+        chunk = chunk[np.isfinite(chunk)]
+      hist += np.histogram(chunk, bins=bins, range=(float(lo), float(hi)))[0]
+    stats = (lo.item(), (mean, (m2 / count) ** 0.5), hi.item())
+  else:
+    stats = (float('nan'), (float('nan'), float('nan')), float('nan'))
+
+  key = ' (shape dtype (min (mean std) max) hist (nan inf))'
+  if step > 1:
+    key = key[:-1] + ', sampled every %d)' % step
+  return str((np_x.shape, dtype, stats, hist, (nans, infs))), key
+
+
 def _standard_print(*args):
-  writer = lambda: ''
-  writer.s = ''
-  def w(s):
-    writer.s += s
-  writer.write = w
-  print(*args, file=writer, end='')
-  return writer.s
-
-
-# Set up basic logging handler.
-logging.basicConfig(
-    format='%(asctime)s: %(message)s',
-    level=(
-        logging.getLogger().getEffectiveLevel()
-        if logging.getLogger().getEffectiveLevel() <= logging.INFO
-        else logging.INFO))
+  """Returns the string print would write for args."""
+  return ' '.join([a if isinstance(a, str) else str(a) for a in args])
+
+
+def _configure_logger():
+  """Returns qj's logger, setting up logging the first time it's needed."""
+  import logging  # pylint: disable=g-import-not-at-top
+  # Set up a basic logging handler the first time qj needs its logger rather
+  # than when it is imported, so that importing qj has no side effects.
+  logging.basicConfig(
+      format='%(asctime)s: %(message)s',
+      level=(
+          logging.getLogger().getEffectiveLevel()
+          if logging.getLogger().getEffectiveLevel() <= logging.INFO
+          else logging.INFO))
+  qj._logger = logging.getLogger('qj')
+  return qj._logger
+
+
+def _log(*args):
+  """The default qj.LOG_FN, which logs to the 'qj' logger."""
+  (qj._logger or _configure_logger()).info(qj._COLOR_FN(*args))
+
+
+def _logger_enabled():
+  """Returns whether the 'qj' logger would log a message from qj.LOG_FN.
+
+  Logger.isEnabledFor caches its answer until a logging level changes, so this
+  is cheap enough to check before qj does anything else.
+  """
+  return (qj._logger or _configure_logger()).isEnabledFor(_INFO)
+
+
+def _logger_disabled():
+  """Returns whether qj.LOG_FN writes to the 'qj' logger, and it is disabled."""
+  return ((qj.LOG_FN is _log or qj.LOG_FN is _notebook_log)
+          and not _logger_enabled())
+
 
 qj.LOG = True
 qj.DEBUG_FN = None
@@ -549,21 +695,79 @@ qj._LOG_COLOR_NOTEBOOK = '\033[32m'
 qj._COLOR_PREFIX = lambda: (qj.COLOR and qj.PREFIX_COLOR) or ''
 qj._COLOR_LOG = lambda: (qj.COLOR and qj.LOG_COLOR) or ''
 qj._COLOR_END = lambda: (qj.COLOR and '\033[0m') or ''
-qj._COLOR_FN = lambda *args: (qj._COLOR_PREFIX() +
-                              _standard_print(*args) + qj._COLOR_END())
-qj.LOG_FN = lambda *args: logging.info(qj._COLOR_FN(*args))
+
+
+def _color_fn(*args):
+  """Returns args as printed, wrapped in the prefix color."""
+  text = args[0] if len(args) == 1 and isinstance(args[0], str) else _standard_print(*args)
+  if not qj.COLOR:
+    return text
+  return ''.join((qj.PREFIX_COLOR or '', text, '\033[0m'))
+
+
+qj._COLOR_FN = _color_fn
+qj.LOG_FN = _log
+qj._logger = None
+_INFO = 20  # logging.INFO
+# The notebook qj.LOG_FN, which also writes to the 'qj' logger.
+_notebook_log = None
 qj.MAX_FRAME_LOGS = 200
 qj.PREFIX = 'qj: '
 
 qj.STR_FN = str
 
+qj.N_SAMPLE_SIZE = 0
+_N_CHUNK_SIZE = 1 << 18
+
 qj._FN_MAPS = {}
+qj._source_indexes = {}
+qj._site_formats = {}
 qj._DEBUG_QJ = False
 
+qj.BACKGROUND_LABELS = False
+qj._label_queue = None
+qj._label_thread = None
+qj._label_lock = _thread.allocate_lock()
+
+
+def _queue_label(fn_calls, co, lasti, module_globals):
+  """Queues extraction of the label at co and lasti on the background thread."""
+  with qj._label_lock:
+    if qj._label_thread is None or not qj._label_thread.is_alive():
+      # Also restarts the thread in a child process after a fork.
+      try:
+        import queue  # pylint: disable=g-import-not-at-top
+      except ImportError:  # Python 2
+        import Queue as queue  # pylint: disable=g-import-not-at-top
+      import threading  # pylint: disable=g-import-not-at-top
+      qj._label_queue = queue.Queue()
+      qj._label_thread = threading.Thread(
+          target=_extract_labels, args=(qj._label_queue,), name='qj-labels')
+      qj._label_thread.daemon = True
+      qj._label_thread.start()
+    label_queue = qj._label_queue
+  label_queue.put((fn_calls, co, lasti, module_globals))
+
+
+def _extract_labels(label_queue):
+  """Body of the background label thread."""
+  from qj import labels  # pylint: disable=g-import-not-at-top
+  while True:
+    fn_calls, co, lasti, module_globals = label_queue.get()
+    try:
+      fn_calls[lasti] = labels._find_current_fn_call(co, lasti, module_globals)
+    except Exception:  # pylint: disable=broad-except
+      # Fall back to showing the type, as when the source can't be found.
+      fn_calls[lasti] = ''
+    finally:
+      label_queue.task_done()
+
+
 qj.__version__ = '0.2.2'
 
-# Stack of tic/toc tuples.
+# Stack of tic/toc tuples, shared by all threads.
 qj._tics = []
+qj._tics_lock = _thread.allocate_lock()
 
 # Make qj globally available in any python code you load (not always the case in
 # colabs due to the ways modules are loaded) by running qj.make_global(). This is
@@ -582,47 +786,150 @@ qj.make_global = lambda sym=qj, name='qj', mod=sys.modules[_builtin_module_name]
 # When running qj interactively (e.g., from a colab), automatically call
 # qj.make_global(), and also add a general print function, pr, to the interactive
 # module and set it as qj.LOG_FN. Also make sure to capture logs and format the
-# output cell appropriately if running in colab specifically.
+# output cell appropriately if running in colab specifically. colabtools is only
+# imported the first time pr logs, and scripts that merely lack a __main__ file
+# when qj is imported (e.g., from sitecustomize or python -c) aren't treated as
+# interactive.
 # TODO(iansf):Annoyingly slow for high frequency logging in colab.
-if not hasattr(sys.modules['__main__'], '__file__'):
-  try:
-    from colabtools import googlelog  # pylint: disable=g-import-not-at-top
-    from colabtools import outputformat  # pylint: disable=g-import-not-at-top
+def _interactive():
+  """Returns whether qj is being imported into an interactive session."""
+  return (not hasattr(sys.modules['__main__'], '__file__')
+          and (hasattr(sys, 'ps1') or bool(sys.flags.interactive)
+               or 'IPython' in sys.modules))
+
+
+class _NullCapture(object):
+  """Notebook capture for frontends that show logs in the running cell anyway.
+
+  A notebook capture has a `start()` method, which starts sending logs to the
+  running cell and returns whether it did, and an `end()` method, which stops
+  after a successful `start()`. This one is for IPython and Jupyter, which
+  already show logs in the cell, so it does nothing.
+  """
+
+  def start(self):
+    return False
+
+  def end(self):
+    pass
+
+
+class _ColabCapture(object):
+  """Notebook capture that sends logs to the running colab cell."""
+
+  def __init__(self, googlelog, outputformat):
+    self._capture = googlelog.Capture()
+    self._outputformat = outputformat
+    self._last_output_format = _time.time()
+
+  def start(self):
     import multiprocessing  # pylint: disable=g-import-not-at-top
-    qj._last_output_format = _time.time()
-    _capture = googlelog.Capture()
-
-    def _start_capture():
-      if multiprocessing.current_process().name != 'MainProcess':
-        return False
-      if _capture._global_mode:
-        return False
-      _capture.enter_global_mode()
-      return True
-
-    def _end_capture():
-      if multiprocessing.current_process().name != 'MainProcess':
+    if multiprocessing.current_process().name != 'MainProcess':
+      return False
+    if self._capture._global_mode:
+      return False
+    self._capture.enter_global_mode()
+    return True
+
+  def end(self):
+    self._capture.exit_global_mode()
+    cur_time = _time.time()
+    if self._last_output_format + 3 < cur_time:
+      self._last_output_format = cur_time
+      self._outputformat.word_wrap('1')
+      self._outputformat.max_output_height('1400')
+
+
+def _notebook_capture():
+  """Returns qj.NOTEBOOK_CAPTURE, defaulting it to a capture for this notebook."""
+  if qj.NOTEBOOK_CAPTURE is None:
+    try:
+      # pylint: disable=g-import-not-at-top
+      from colabtools import googlelog
+      from colabtools import outputformat
+      # pylint: enable=g-import-not-at-top
+      qj.NOTEBOOK_CAPTURE = _ColabCapture(googlelog, outputformat)
+    except ImportError:
+      qj.NOTEBOOK_CAPTURE = _NullCapture()
+  return qj.NOTEBOOK_CAPTURE
+
+
+class _NotebookLog(object):
+  """The qj.LOG_FN for notebooks, which writes logs to the running cell in chunks.
+
+  Starting and ending a capture for every log is slow when logging at high
+  frequency, so logs are buffered, and written under a single capture
+  qj.NOTEBOOK_FLUSH_SECONDS after the first of them, when the buffer fills, or
+  when the cell finishes running.
+  """
+
+  def __init__(self, write=None):
+    self._write = write or _log
+    self._lock = _thread.allocate_lock()
+    self._flush_lock = _thread.allocate_lock()
+    self._buffer = []
+    self._timer = None
+    self._hooked = False
+
+  def __call__(self, *args):
+    if not self._hooked:
+      self._hook()
+    with self._lock:
+      self._buffer.append(args)
+      flush_now = (len(self._buffer) >= _NOTEBOOK_MAX_BUFFERED
+                   or qj.NOTEBOOK_FLUSH_SECONDS <= 0)
+      if not flush_now and self._timer is None:
+        import threading  # pylint: disable=g-import-not-at-top
+        self._timer = threading.Timer(qj.NOTEBOOK_FLUSH_SECONDS, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+    if flush_now:
+      self.flush()
+
+  def flush(self):
+    """Writes out the buffered logs."""
+    with self._flush_lock:
+      with self._lock:
+        buffered, self._buffer = self._buffer, []
+        timer, self._timer = self._timer, None
+      if timer is not None:
+        timer.cancel()
+      if not buffered:
         return
-      _capture.exit_global_mode()
-      cur_time = _time.time()
-      if qj._last_output_format + 3 < cur_time:
-        qj._last_output_format = cur_time
-        outputformat.word_wrap('1')
-        outputformat.max_output_height('1400')
-
-  except ImportError:
-    _start_capture = lambda: None
-    _end_capture = lambda: None
+      capture = _notebook_capture()
+      started = capture.start()
+      try:
+        for args in buffered:
+          self._write(*args)
+      finally:
+        if started:
+          capture.end()
+
+  def _hook(self):
+    """Flushes when each IPython cell finishes running, and at exit."""
+    self._hooked = True
+    import atexit  # pylint: disable=g-import-not-at-top
+    atexit.register(self.flush)
+    ipython = sys.modules.get('IPython')
+    shell = ipython and ipython.get_ipython()
+    if shell is not None:
+      shell.events.register('post_run_cell', lambda *_: self.flush())
+
+
+def _flush_log():
+  """Writes out any logs qj.LOG_FN is buffering, if it has a flush method."""
+  if callable(getattr(type(qj.LOG_FN), 'flush', None)):
+    qj.LOG_FN.flush()
+
+
+qj.NOTEBOOK_CAPTURE = None
+qj.NOTEBOOK_FLUSH_SECONDS = 0.1
+_NOTEBOOK_MAX_BUFFERED = 1000
+
+if _interactive():
   qj.make_global()
-
-  def _colab_log_fn(*args):
-    captured = _start_capture()
-    logging.info(qj._COLOR_FN(*args))
-    if captured:
-      _end_capture()
-
-  qj.LOG_FN = qj.make_global(
-      _colab_log_fn,
+  _notebook_log = qj.LOG_FN = qj.make_global(
+      _NotebookLog(),
       'pr', sys.modules['__main__'])
   qj.PREFIX_COLOR = qj._PREFIX_COLOR_NOTEBOOK
   qj.LOG_COLOR = qj._LOG_COLOR_NOTEBOOK
@@ -637,8 +944,51 @@ def _parametrized(decorator):
   return layer
 
 
-qj._call_counts = collections.Counter()
-qj._timings = collections.Counter()
+qj._rate_meters = {}
+qj._aggregates = {}
+qj._last_values = {}
+qj._snapshots = {}
+_AGG_COUNT = 1000
+qj.AGG_SECONDS = 10.0
+# Caches keyed by class or function hold them weakly, so that classes and
+# functions created at runtime can still be collected.
+qj._call_logger_types = weakref.WeakKeyDictionary()
+qj._member_tables = weakref.WeakKeyDictionary()
+qj._signatures = weakref.WeakKeyDictionary()
+
+
+# Striped locks for per-site state, such as rate meters and timing stats, so
+# that threads logging from different sites rarely contend.
+_SITE_LOCKS = tuple(_thread.allocate_lock() for _ in range(64))
+
+
+class _Timings(object):
+  """Call counts and total times of timed functions, shared by all threads."""
+
+  def __init__(self):
+    self._stats = {}
+
+  def add(self, f, elapsed):
+    """Records a call of f and returns its (count, total time) so far."""
+    with _SITE_LOCKS[hash(f) % len(_SITE_LOCKS)]:
+      stat = self._stats.get(f)
+      if stat is None:
+        stat = self._stats[f] = [0, 0.0]
+      stat[0] += 1
+      stat[1] += elapsed
+      return stat[0], stat[1]
+
+  def get(self, f):
+    """Returns the (count, total time) of calls of f."""
+    stat = self._stats.get(f, (0, 0.0))
+    return stat[0], stat[1]
+
+
+qj._timings = _Timings()
+
+
+def _site_lock(site):
+  return _SITE_LOCKS[(id(site[0]) >> 4 ^ site[1]) % len(_SITE_LOCKS)]
 
 
 @_parametrized
@@ -649,21 +999,35 @@ def _timing(f, logs_every=100):
     """The timer function."""
     ts = _time.time()
     result = f(*args, **kw)
-    te = _time.time()
-    qj._call_counts[f] += 1
-    qj._timings[f] += (te - ts)
-    count = qj._call_counts[f]
-    if count % logs_every == 0:
-      qj(x='%2.4f seconds' % (qj._timings[f] / count),
-         s='Average timing for %s across %d call%s' % (f, count, '' if count == 1 else 's'), _depth=2)
+    _record_timing(f, _time.time() - ts, logs_every)
     return result
   return wrap
 
 
+def _record_timing(f, elapsed, logs_every, _depth=3):
+  """Adds a call of f to its timing stats, logging them every logs_every calls.
+
+  Calls are counted across all threads. By default, the log is attributed to
+  the caller of the function that called this one.
+  """
+  count, total = qj._timings.add(f, elapsed)
+  if count % logs_every == 0:
+    qj(x='%2.4f seconds' % (total / count),
+       s='Average timing for %s across %d call%s' % (f, count, '' if count == 1 else 's'), _depth=_depth)
+
+
+def _timed(f, logs_every):
+  """Adds timing to f, either in place with sys.monitoring or by wrapping it."""
+  if _use_monitoring(f):
+    _monitor(f, f.__name__, logs_every, False)
+    return f
+  return _timing(logs_every=logs_every)(f)  # pylint: disable=no-value-for-parameter
+
+
 @_parametrized
 def _catch(f, exception_type):
   """Decorator to drop into the debugger if a function throws an exception."""
-  if not (inspect.isclass(exception_type)
+  if not (isinstance(exception_type, type)
           and issubclass(exception_type, Exception)):
     exception_type = Exception
 
@@ -672,1374 +1036,1132 @@ def _catch(f, exception_type):
     try:
       return f(*args, **kw)
     except exception_type as e:  # pylint: disable=broad-except
-      qj(e, 'Caught an exception in %s' % f, d=1, _depth=2)
+      if not qj.DUMP_DIR:
+        qj(e, 'Caught an exception in %s' % f, d=1, _depth=2)
+        return None
+      # Headless code can't use the debugger, so record a post-mortem dump.
+      from qj import dumps  # pylint: disable=g-import-not-at-top
+      try:
+        dump = 'post-mortem dump: %s' % dumps.write(e, qj.DUMP_DIR, str(f))
+      except (IOError, OSError, TypeError, ValueError) as dump_error:
+        dump = 'unable to write post-mortem dump: %s' % dump_error
+      qj(e, 'Caught an exception in %s (%s)' % (f, dump), _depth=2)
+      if qj.DUMP_RERAISE:
+        _flush_log()
+        raise
   return wrap
 
 
-###############################################################################
-# Code Correlation Code
-###############################################################################
+qj.DUMP_DIR = None
+qj.DUMP_RERAISE = True
 
-#------------------------------------------------------------------------------
-# Python 3 Helpers
-#------------------------------------------------------------------------------
-def _disassemble3(co, lasti):
-  """Disassemble a code object."""
-  linestarts = dict(dis.findlinestarts(co))
-  _disassemble_bytes(co, lasti, linestarts)
-
-def _get_instruction_bytes(code, co, linestarts):
-  if sys.version_info[1] < 11:
-    return dis._get_instructions_bytes(code, co.co_varnames, co.co_names,
-                                       co.co_consts, co.co_cellvars + co.co_freevars,
-                                       linestarts)
-  else:
-    return dis._get_instructions_bytes(
-      code,
-      varname_from_oparg=co._varname_from_oparg,
-      names=co.co_names,
-      co_consts=co.co_consts,
-      linestarts=linestarts,
-      line_offset=0,
-      exception_entries=(),
-      co_positions=None,
-      show_caches=False)
-
-
-def _disassemble_bytes(co, lasti=-1, linestarts=None):
-  # Omit the line number column entirely if we have no line number info
-  show_lineno = linestarts is not None
-  lineno_width = 3 if show_lineno else 0
-  for instr in _get_instruction_bytes(co.co_code, co, linestarts):
-    new_source_line = (show_lineno and
-                       instr.starts_line is not None and
-                       instr.offset > 0)
-    if new_source_line:
-      qj.LOG_FN('')
-    is_current_instr = instr.offset == lasti
-    qj.LOG_FN(instr._disassemble(lineno_width, is_current_instr))
-
-
-def _build_instruction_stack3(co, lasti):
-  code = co.co_code
-
-  linestarts = dict(dis.findlinestarts(co))
-
-  stack = []
-
-  num_instr = len(code)
-
-  if qj._DEBUG_QJ:
-    qj.LOG_FN('lasti = %r\nnum_instr = %r' % (lasti, num_instr))
-    assert lasti < num_instr
-  if lasti >= num_instr:
-    return []
-
-  curr_l = 0
-  for instr in _get_instruction_bytes(code, co, linestarts):
-    # instr.{opname opcode arg argval argrepr offset starts_line is_jump_target}
-    curr_i = instr.offset
-    curr_l = instr.starts_line or curr_l
-
-    if curr_i > lasti:
-      # In 3.11 the lasti value falls between instruction numbers for some reason, so we have to break both here and at the end of the loop.
-      break
 
-    op = instr.opcode
-    opname = instr.opname
-    oparg = instr.arg
-    oparg_repr = instr.argval
-    if op >= opcode.HAVE_ARGUMENT:
-
-      if opname.startswith('MAKE_') or opname.startswith('BUILD_'):
-        oparg_repr = ''
-
-      if isinstance(oparg_repr, str) and oparg_repr.startswith('.'):
-        oparg_repr = ''  # Skip unnamed locals like .0
-      elif isinstance(oparg_repr, types.CodeType):
-        qj._DEBUG_QJ and qj._DISASSEMBLE_FN(oparg_repr, -1)
-        if oparg_repr.co_name == '<lambda>':
-          oparg_repr = ['lambda', ':']
-        elif oparg_repr.co_name == '<dictcomp>' or oparg_repr.co_name == '<setcomp>':
-          oparg_repr = ['{', '}']
-        elif oparg_repr.co_name == '<genexpr>':
-          oparg_repr = ['(', ')']
-        elif oparg_repr.co_name == '<listcomp>':
-          oparg_repr = ['[', ']']
-        else:
-          oparg_repr = ''
-      elif hasattr(dis, '_Unknown') and isinstance(oparg_repr, dis._Unknown):
-        oparg_repr = ''
-
-      if oparg > 0:
-        if opname == 'BUILD_LIST':
-          oparg_repr = ']'
-        elif opname == 'BUILD_TUPLE':
-          oparg_repr = ')'
-        elif opname == 'BUILD_SET':
-          oparg_repr = '}'
-        elif opname == 'BUILD_MAP':
-          oparg_repr = '{'  # BUILD_MAP happens at the beginning of the map
-        elif opname == 'LIST_APPEND':
-          oparg_repr = ']'
-        elif opname == 'SET_ADD':
-          oparg_repr = ''
-        elif opname.startswith('CALL_FUNCTION'):
-          oparg_repr = ')'
-        elif opname == 'CALL_METHOD':
-          oparg_repr = ')'
-        elif opname == 'CALL':
-          oparg_repr = ')'
-        elif opname == 'PRECALL':
-          oparg_repr = ''
-        elif opname == 'MAP_ADD':
-          oparg_repr = ''
-        elif opname == 'FOR_ITER':
-          oparg_repr = ''
-        elif opname == 'BINARY_OP':
-          oparg_repr = instr.argrepr
-        elif opname == 'LIST_EXTEND':
-          oparg_repr = ''
-      elif oparg == 0:
-        if opname == 'BUILD_LIST':
-          # BUILD_LIST 0 occurs at the beginning of list comprehensions
-          oparg_repr = '['
-        elif opname == 'BUILD_TUPLE':
-          oparg_repr = '('
-        elif opname == 'BUILD_SET':
-          oparg_repr = '{'
-        elif opname == 'BUILD_MAP':
-          oparg_repr = '{'
-        elif opname.startswith('CALL_FUNCTION'):
-          oparg_repr = ')'
-        elif opname == 'CALL_METHOD':
-          oparg_repr = ')'
-        elif opname == 'CALL':
-          oparg_repr = ')'
-        elif opname == 'PRECALL':
-          oparg_repr = ''
-        elif opname == 'BINARY_OP':
-          oparg_repr = instr.argrepr
+def _instrumented(f, name, time, log_calls):
+  """Wraps f with timing and sampled call logging for qj.instrument."""
+  logs_every = int(time)
+  log_every = max(1, int(round(1.0 / float(log_calls)))) if log_calls else 0
+  calls = [0]
+
+  @functools.wraps(f)
+  def wrap(*args, **kw):
+    calls[0] += 1
+    log = (qj.LOG and log_every and (calls[0] - 1) % log_every == 0
+           and not _logger_disabled())
+    if log:
+      _log_at_frame(sys._getframe(1), 'calling %s' % name,
+                    _format_call(name, args, kw))
+    if logs_every:
+      ts = _time.time()
+      result = f(*args, **kw)
+      _record_timing(f, _time.time() - ts, logs_every)
     else:
-      # Ops without arguments.
-      if opname == 'UNARY_POSITIVE':
-        oparg_repr = '+'
-      elif opname == 'UNARY_NEGATIVE':
-        oparg_repr = '-'
-      elif opname == 'UNARY_NOT':
-        oparg_repr = ''  # TODO(iansf)
-      elif opname == 'UNARY_CONVERT':
-        oparg_repr = ''  # TODO(iansf)
-      elif opname == 'UNARY_INVERT':
-        oparg_repr = '~'
-      elif opname == 'BINARY_POWER':
-        oparg_repr = '**'
-      elif opname == 'BINARY_MULTIPLY':
-        oparg_repr = '*'
-      elif opname == 'BINARY_DIVIDE':
-        oparg_repr = '/'
-      elif opname == 'BINARY_MODULO':
-        oparg_repr = '%'
-      elif opname == 'BINARY_ADD':
-        oparg_repr = '+'
-      elif opname == 'BINARY_SUBTRACT':
-        oparg_repr = '-'
-      elif opname == 'BINARY_SUBSCR':
-        oparg_repr = ']'
-      elif opname == 'BINARY_FLOOR_DIVIDE':
-        oparg_repr = '//'
-      elif opname == 'BINARY_TRUE_DIVIDE':
-        oparg_repr = '/'
-      elif opname == 'BINARY_LSHIFT':
-        oparg_repr = '<<'
-      elif opname == 'BINARY_RSHIFT':
-        oparg_repr = '>>'
-      elif opname == 'BINARY_AND':
-        oparg_repr = '&'
-      elif opname == 'BINARY_XOR':
-        oparg_repr = '^'
-      elif opname == 'BINARY_OR':
-        oparg_repr = '|'
-      elif opname == 'GET_ITER':
-        oparg_repr = ''
-      elif opname.startswith('SLICE+'):
-        oparg_repr = ':'
-      elif opname == 'PUSH_NULL':
-        oparg_repr = ''
-
-    if isinstance(oparg_repr, tuple):
-      oparg_repr = list(oparg_repr)
-
-    qj._DEBUG_QJ and qj.LOG_FN('%s\noriginal oparg_repr: %r\n     new oparg_repr: %r' % (opname, instr.argval, oparg_repr))
-
-    instr_arg = 0 if instr.arg is None else instr.arg
-
-    stack_entry = _StackEntry(
-        _stack_effect3(instr.opname, instr_arg),
-        curr_i,
-        curr_l,
-        instr.opname,
-        instr_arg,
-        oparg_repr if isinstance(oparg_repr, list) else [str(oparg_repr)],
-        [],  # children
-    )
-
-    if len(stack) and instr.opname == 'CALL_FUNCTION_EX':
-      # CALL_FUNCTION_EX only sets the oparg to 0 or 1. 1 means there are kwargs to expand, as well as possibly tuple args.
-      # 0 means there are tuple args to expand only. In that case, we still need CALL_FUNCTION_EX to actually consume a
-      # stack entry, which will be the vararg.
-      stack_entry.stack_depth = -1
-
-    stack.append(stack_entry)
-
-    if curr_i == lasti:
-      break
+      result = f(*args, **kw)
+    if log:
+      _log_at_frame(sys._getframe(1), 'returning from %s' % name,
+                    qj.STR_FN(result))
+    return result
+  return wrap
+
 
-  qj._DEBUG_QJ and [qj.LOG_FN('se: %s' % str(se)) for se in stack] and qj.LOG_FN('\n\n')
-
-  return stack
-
-
-_STACK_EFFECTS3 = {
-    'NOP': 0,
-
-    'EXTENDED_ARG': 0,
-    'RESUME': 0,
-    'CACHE': 0,
-
-    'POP_TOP': -1,
-    'SWAP': 0,
-    'ROT_TWO': 0,
-    'ROT_THREE': 0,
-    'ROT_FOUR': 0,
-    'DUP_TOP': 1,
-    'DUP_TOP_TWO': 2,
-
-    'UNARY_POSITIVE': 0,
-    'UNARY_NEGATIVE': 0,
-    'UNARY_NOT': 0,
-    'UNARY_INVERT': 0,
-
-    'SET_ADD': -1,
-    'LIST_APPEND': -1,
-    'MAP_ADD': -2,
-
-    'BINARY_POWER': -1,
-    'BINARY_MULTIPLY': -1,
-    'BINARY_MATRIX_MULTIPLY': -1,
-    'BINARY_MODULO': -1,
-    'BINARY_ADD': -1,
-    'BINARY_SUBTRACT': -1,
-    'BINARY_SUBSCR': -1,
-    'BINARY_FLOOR_DIVIDE': -1,
-    'BINARY_TRUE_DIVIDE': -1,
-    'BINARY_OP': -1,
-
-    'INPLACE_FLOOR_DIVIDE': -1,
-    'INPLACE_TRUE_DIVIDE': -1,
-    'INPLACE_ADD': -1,
-    'INPLACE_SUBTRACT': -1,
-    'INPLACE_MULTIPLY': -1,
-    'INPLACE_MATRIX_MULTIPLY': -1,
-    'INPLACE_MODULO': -1,
-
-    'STORE_SUBSCR': -3,
-    'DELETE_SUBSCR': -2,
-
-    'BINARY_LSHIFT': -1,
-    'BINARY_RSHIFT': -1,
-    'BINARY_AND': -1,
-    'BINARY_XOR': -1,
-    'BINARY_OR': -1,
-    'INPLACE_POWER': -1,
-    'GET_ITER': 0,
-
-    'ASYNC_GEN_WRAP': 0,
-    'SEND': -1,  # jump > 0 ? -1 : 0;
-
-    'CHECK_EXC_MATCH': 0,
-    'CHECK_EG_MATCH': 0,
-
-    'JUMP_FORWARD': 0,
-    'JUMP_BACKWARD': 0,
-    'JUMP': 0,
-    'JUMP_BACKWARD_NO_INTERRUPT': 0,
-    'JUMP_NO_INTERRUPT': 0,
-
-    'JUMP_IF_TRUE_OR_POP': 0,  # jump ? 0 : -1;
-    'JUMP_IF_FALSE_OR_POP': 0,  # jump ? 0 : -1;
-
-    'POP_JUMP_BACKWARD_IF_NONE': -1,
-    'POP_JUMP_FORWARD_IF_NONE': -1,
-    'POP_JUMP_IF_NONE': -1,
-    'POP_JUMP_BACKWARD_IF_NOT_NONE': -1,
-    'POP_JUMP_FORWARD_IF_NOT_NONE': -1,
-    'POP_JUMP_IF_NOT_NONE': -1,
-    'POP_JUMP_FORWARD_IF_FALSE': -1,
-    'POP_JUMP_BACKWARD_IF_FALSE': -1,
-    'POP_JUMP_IF_FALSE': -1,
-    'POP_JUMP_FORWARD_IF_TRUE': -1,
-    'POP_JUMP_BACKWARD_IF_TRUE': -1,
-    'POP_JUMP_IF_TRUE': -1,
-
-    'RETURN_GENERATOR': 0,
-
-    'KW_NAMES': 0,
-
-    'PRECALL': 0,  # Was -oparg, but needs to be 0 because CALL comes next and needs to have the -oparg.
-
-    'PREP_RERAISE_STAR': -1,
-    'PUSH_EXC_INFO': 1,
-
-    'MAKE_CELL': 0,
-    'COPY_FREE_VARS': 0,
-    'COPY': 1,
-    'PUSH_NULL': 1,
-
-    'BEFORE_WITH': 1,
-
-    'SETUP_CLEANUP': 2,  # jump ? 2 : 0
-
-    'PRINT_EXPR': -1,
-    'LOAD_BUILD_CLASS': 1,
-    'INPLACE_LSHIFT': -1,
-    'INPLACE_RSHIFT': -1,
-    'INPLACE_AND': -1,
-    'INPLACE_XOR': -1,
-    'INPLACE_OR': -1,
-    'BREAK_LOOP': 0,
-    # TODO: in 3.11: jump ? 1 : 0;
-    'SETUP_WITH': 7,
-    'WITH_CLEANUP_START': 1,
-    'WITH_CLEANUP_FINISH': -1,  # Sometimes more
-    'RETURN_VALUE': -1,
-    'IMPORT_STAR': -1,
-    'SETUP_ANNOTATIONS': 0,
-    'YIELD_VALUE': 0,
-    'YIELD_FROM': -1,
-    'POP_BLOCK': 0,
-    # TODO: in 3.11: -1
-    'POP_EXCEPT': 0,  # -3 except if bad bytecode
-    'END_FINALLY': -1,  # or -2 or -3 if exception occurred
-
-    'STORE_NAME': -1,
-    'DELETE_NAME': 0,
-    'FOR_ITER': 1,  # or -1, at end of iterator
-
-    'STORE_ATTR': -2,
-    'DELETE_ATTR': -1,
-    'STORE_GLOBAL': -1,
-    'DELETE_GLOBAL': 0,
-    'LOAD_CONST': 1,
-    'LOAD_NAME': 1,
-    'LOAD_ATTR': 0,
-    'COMPARE_OP': -1,
-    'IS_OP': -1,
-    'CONTAINS_OP': -1,
-
-    'JUMP_IF_NOT_EXC_MATCH': -2,
-    'IMPORT_NAME': -1,
-    'IMPORT_FROM': 1,
-
-    'JUMP_FORWARD': 0,
-    'JUMP_IF_TRUE_OR_POP': 0,  # -1 if jump not taken
-    'JUMP_IF_FALSE_OR_POP': 0,  # -1 if jump not taken
-    'JUMP_ABSOLUTE': 0,
-
-    'POP_JUMP_IF_FALSE': -1,
-    'POP_JUMP_IF_TRUE': -1,
-
-    'LOAD_GLOBAL': 1,
-
-    'CONTINUE_LOOP': 0,
-    'SETUP_LOOP': 0,
-    'SETUP_EXCEPT': 6,
-    # TODO: in 3.11: jump ? 1 : 0;
-    'SETUP_FINALLY': 6,  # can push 3 values for the new exception + 3 others for the previous exception state
-    'RERAISE': -3,  # TODO: -1 in 3.11
-    'WITH_EXCEPT_START': 1,
-
-    'LOAD_FAST': 1,
-    'STORE_FAST': -1,
-    'DELETE_FAST': 0,
-    'STORE_ANNOTATION': -1,
-
-    'LOAD_CLOSURE': 1,
-    'LOAD_DEREF': 1,
-    'LOAD_CLASSDEREF': 1,
-    'STORE_DEREF': -1,
-    'DELETE_DEREF': 0,
-    'GET_AWAITABLE': 0,
-    'SETUP_ASYNC_WITH': 6,
-    'BEFORE_ASYNC_WITH': 1,
-    'GET_AITER': 0,
-    'GET_ANEXT': 1,
-    'GET_YIELD_FROM_ITER': 0,
-    # TODO: in 3.11: -2
-    'END_ASYNC_FOR': -7,
-
-    'LOAD_METHOD': 1,
-    'LOAD_ASSERTION_ERROR': 1,
-
-    'LIST_TO_TUPLE': 0,
-    'GEN_START': -1,
-    'LIST_EXTEND': -1,
-    'SET_UPDATE': -1,
-    'DICT_MERGE': -1,
-    'DICT_UPDATE': -1,
-
-    'COPY_DICT_WITHOUT_KEYS': 0,
-    # TODO: in 3.11: -2
-    'MATCH_CLASS': -1,
-    'GET_LEN': 1,
-    'MATCH_MAPPING': 1,
-    'MATCH_SEQUENCE': 1,
-    # TODO: in 3.11: 1
-    'MATCH_KEYS': 2,
-    'ROT_N': 0,
-}
-
-
-def _stack_effect3(op_code, oparg):
-  """Compute the effect an op_code and oparg have on the stack.  See python/compile.c."""
-  if op_code == 'UNPACK_SEQUENCE':
-    return oparg - 1
-  if op_code == 'UNPACK_EX':
-    return (oparg & 0xFF) + (oparg >> 8)
-  if op_code == 'BUILD_TUPLE':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_LIST':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_SET':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_STRING':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_LIST_UNPACK':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_TUPLE_UNPACK':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_TUPLE_UNPACK_WITH_CALL':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_SET_UNPACK':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_MAP_UNPACK':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_MAP_UNPACK_WITH_CALL':
-    return -oparg  # Was 1 - oparg
-  if op_code == 'BUILD_MAP':
-    return -2 * oparg  # Was 1 - 2 * oparg
-  if op_code == 'BUILD_CONST_KEY_MAP':
-    return -oparg
-  if op_code == 'RAISE_VARARGS':
-    return -oparg
-  if op_code == 'CALL':
-    return -oparg
-  if op_code == 'CALL_FUNCTION':
-    return -oparg
-  if op_code == 'CALL_METHOD':
-    return -oparg - 1
-  if op_code == 'CALL_FUNCTION_KW':
-    return -oparg - 1
-  if op_code == 'CALL_FUNCTION_EX':
-    return -((oparg & 0x01) != 0) - ((oparg & 0x02) != 0)
-  if op_code == 'MAKE_FUNCTION':
-    return -1 - ((oparg & 0x01) != 0) - ((oparg & 0x02) != 0) - ((oparg & 0x04) != 0) - ((oparg & 0x08) != 0)
-  if op_code == 'BUILD_SLICE':
-    return -2 if (oparg == 3) else -1
-  if op_code == 'FORMAT_VALUE':
-    # If there's a fmt_spec on the stack we go from 2->1 else 1->1.
-    return -1 if (oparg & 0x4) == 0x4 else 0
-  if op_code == 'EXTENDED_ARG':
-    return 0  # EXTENDED_ARG just builds up a longer argument value for the next instruction (there may be multiple in a row?)
-
-  if op_code not in _STACK_EFFECTS3 and not qj._DEBUG_QJ:
-    return 0  # Avoid crashing just because of updated bytecode functionality.
-  return _STACK_EFFECTS3[op_code]
-
-
-#------------------------------------------------------------------------------
-# Python 2.7 Helpers
-#------------------------------------------------------------------------------
-def _findlinestarts(code):
-  """Find the offsets in a byte code which are start of lines in the source.
-
-  Generate pairs (offset, lineno) as described in Python/compile.c.
+def _instrument_member(owner, name, member, label, time, log_calls, originals,
+                       taken):
+  """Instruments one function, or the function inside a static/class method."""
+  if (owner, name) in taken:
+    # Already instrumented through another target, which restores it.
+    return
+  fn = getattr(member, '__func__', member)
+  originals.append((owner, name, member))
+  if _use_monitoring(fn):
+    _monitor(fn, label, time, log_calls)
+  elif fn is member:
+    setattr(owner, name, _instrumented(fn, label, time, log_calls))
+  else:
+    setattr(owner, name, type(member)(_instrumented(fn, label, time, log_calls)))
+
+
+def _instrument_class(cls, time, log_calls, originals, taken):
+  for name, member in list(vars(cls).items()):
+    if (not name.startswith('__') and
+        isinstance(member, (types.FunctionType, staticmethod, classmethod))):
+      _instrument_member(cls, name, member, '%s.%s' % (cls.__name__, name),
+                         time, log_calls, originals, taken)
+
+
+def _instrument(target, time=False, log_calls=False):
+  """Adds timing and call logging to every function or method in target.
 
   Arguments:
-    code: code object.
+    target: A module or a class. For a module, the functions and classes defined
+            in that module (not imported into it) are instrumented. For a class,
+            its methods, static methods and class methods are instrumented.
+            Special methods like `__init__` are left alone. If qj.MONITORING is
+            set and sys.monitoring is available, the functions are instrumented
+            in place rather than replaced with wrappers. Functions already
+            instrumented through another target (e.g., a class of a module
+            that was instrumented first) are skipped.
+    time: Optional int. Log the average time of each function every `time`
+          calls, like `@qj(time=...)`.
+    log_calls: Optional float in (0, 1]. Log the arguments and return value of
+               one in every `1 / log_calls` calls to each function, starting
+               with the first. `log_calls=1` logs every call.
 
-  Yields:
-    Address and line number pairs.
+  Returns:
+    The sorted names of the instrumented functions.
   """
-  byte_increments = [ord(c) for c in code.co_lnotab[0::2]]
-  line_increments = [ord(c) for c in code.co_lnotab[1::2]]
-
-  lastlineno = None
-  lineno = code.co_firstlineno
-  addr = 0
-  for byte_incr, line_incr in zip(byte_increments, line_increments):
-    if byte_incr:
-      if lineno != lastlineno:
-        yield (addr, lineno)
-        lastlineno = lineno
-      addr += byte_incr
-    lineno += line_incr
-  if lineno != lastlineno:
-    yield (addr, lineno)
-
-
-def _disassemble(co, lasti):
-  code = co.co_code
-  linestarts = dict(_findlinestarts(co))
-  n = len(code)
-  i = 0
-  extended_arg = 0
-  free = None
-  while i < n:
-    s = ''
-    c = code[i]
-    op = ord(c)
-    if i in linestarts:
-      if i > 0:
-        qj.LOG_FN('')
-      s += '%3d' % linestarts[i]
-    else:
-      s += '   '
+  _uninstrument(target)
+  originals = []
+  # Each function is only instrumented through one target, so that
+  # uninstrumenting the targets in any order restores the originals.
+  taken = set((owner, name) for other in qj._instrumented.values()
+              for owner, name, _ in other)
+  if isinstance(target, types.ModuleType):
+    for name, member in list(vars(target).items()):
+      if getattr(member, '__module__', None) != target.__name__:
+        continue
+      if isinstance(member, types.FunctionType):
+        _instrument_member(target, name, member, name, time, log_calls,
+                           originals, taken)
+      elif isinstance(member, type):
+        _instrument_class(member, time, log_calls, originals, taken)
+  elif isinstance(target, type):
+    _instrument_class(target, time, log_calls, originals, taken)
+  else:
+    raise TypeError('qj.instrument expects a module or a class, not %r' % target)
+  qj._instrumented[target] = originals
+  return sorted('%s.%s' % (owner.__name__, name) if owner is not target
+                else name for owner, name, _ in originals)
 
-    if i == lasti:
-      s += '-->'
-    else:
-      s += '   '
-    s += repr(i).rjust(4) + ' '
-    s += opcode.opname[op].ljust(20)
-    i += 1
-    if op >= opcode.HAVE_ARGUMENT:
-      oparg = ord(code[i]) + ord(code[i + 1]) * 256 + extended_arg
-      extended_arg = 0
-      i += 2
-      if op == opcode.EXTENDED_ARG:
-        extended_arg = oparg * 65536
-      s += repr(oparg).rjust(5)
-      if op in opcode.hasconst:
-        s += '(' + repr(co.co_consts[oparg]) + ')'
-      elif op in opcode.hasname:
-        s += '(' + co.co_names[oparg] + ')'
-      elif op in opcode.hasjrel:
-        s += '(to ' + repr(i + oparg) + ')'
-      elif op in opcode.haslocal:
-        s += '(' + co.co_varnames[oparg] + ')'
-      elif op in opcode.hascompare:
-        s += '(' + opcode.cmp_op[oparg] + ')'
-      elif op in opcode.hasfree:
-        if free is None:
-          free = co.co_cellvars + co.co_freevars
-        s += '(' + free[oparg] + ')'
-    qj.LOG_FN(s)
-
-
-_STACK_EFFECTS = {
-    'POP_TOP': -1,
-    'ROT_TWO': 0,
-    'ROT_THREE': 0,
-    'DUP_TOP': 1,
-    'ROT_FOUR': 0,
-
-    'UNARY_POSITIVE': 0,
-    'UNARY_NEGATIVE': 0,
-    'UNARY_NOT': 0,
-    'UNARY_CONVERT': 0,
-    'UNARY_INVERT': 0,
-
-    'SET_ADD': -1,
-    'LIST_APPEND': -1,
-
-    'MAP_ADD': -2,
-
-    'BINARY_POWER': -1,
-    'BINARY_MULTIPLY': -1,
-    'BINARY_DIVIDE': -1,
-    'BINARY_MODULO': -1,
-    'BINARY_ADD': -1,
-    'BINARY_SUBTRACT': -1,
-    'BINARY_SUBSCR': -1,
-    'BINARY_FLOOR_DIVIDE': -1,
-    'BINARY_TRUE_DIVIDE': -1,
-    'INPLACE_FLOOR_DIVIDE': -1,
-    'INPLACE_TRUE_DIVIDE': -1,
-
-    'SLICE+0': 0,
-    'SLICE+1': -1,
-    'SLICE+2': -1,
-    'SLICE+3': -2,
-
-    'STORE_SLICE+0': -2,
-    'STORE_SLICE+1': -3,
-    'STORE_SLICE+2': -3,
-    'STORE_SLICE+3': -4,
-
-    'DELETE_SLICE+0': -1,
-    'DELETE_SLICE+1': -2,
-    'DELETE_SLICE+2': -2,
-    'DELETE_SLICE+3': -3,
-
-    'INPLACE_ADD': -1,
-    'INPLACE_SUBTRACT': -1,
-    'INPLACE_MULTIPLY': -1,
-    'INPLACE_DIVIDE': -1,
-    'INPLACE_MODULO': -1,
-    'STORE_SUBSCR': -3,
-    'STORE_MAP': -2,
-    'DELETE_SUBSCR': -2,
-
-    'BINARY_LSHIFT': -1,
-    'BINARY_RSHIFT': -1,
-    'BINARY_AND': -1,
-    'BINARY_XOR': -1,
-    'BINARY_OR': -1,
-    'INPLACE_POWER': -1,
-    'GET_ITER': 0,
-
-    'PRINT_EXPR': -1,
-    'PRINT_ITEM': -1,
-    'PRINT_NEWLINE': 0,
-    'PRINT_ITEM_TO': -2,
-    'PRINT_NEWLINE_TO': -1,
-    'INPLACE_LSHIFT': -1,
-    'INPLACE_RSHIFT': -1,
-    'INPLACE_AND': -1,
-    'INPLACE_XOR': -1,
-    'INPLACE_OR': -1,
-    'BREAK_LOOP': 0,
-    'SETUP_WITH': 4,
-    # Originally was -1 with note that it's sometimes more.
-    # Better to balance with SETUP_WITH.
-    # TODO(iansf): Still doesn't work.
-    'WITH_CLEANUP': -1,
-    'LOAD_LOCALS': 1,
-    'RETURN_VALUE': -1,
-    'IMPORT_STAR': -1,
-    'EXEC_STMT': -3,
-    'YIELD_VALUE': 0,
-
-    'POP_BLOCK': 0,
-    'END_FINALLY': -3,  # or -1 or -2 if no exception occurred or break/continue
-    'BUILD_CLASS': -2,
-
-    'STORE_NAME': -1,
-    'DELETE_NAME': 0,
-    # 1 at start of iterator, -1 at end of iterator, balances out to 0
-    'FOR_ITER': 0,
-
-    'STORE_ATTR': -2,
-    'DELETE_ATTR': -1,
-    'STORE_GLOBAL': -1,
-    'DELETE_GLOBAL': 0,
-    'LOAD_CONST': 1,
-    'LOAD_NAME': 1,
-    'BUILD_MAP': 1,
-    'LOAD_ATTR': 0,
-    'COMPARE_OP': -1,
-    'IMPORT_NAME': -1,
-    'IMPORT_FROM': 1,
-
-    'JUMP_FORWARD': 0,
-    'JUMP_IF_TRUE_OR_POP': 0,  # -1 if jump not taken
-    'JUMP_IF_FALSE_OR_POP': 0,  # -1 if jump not taken
-    'JUMP_ABSOLUTE': 0,
-
-    'POP_JUMP_IF_FALSE': -1,
-    'POP_JUMP_IF_TRUE': -1,
-
-    'LOAD_GLOBAL': 1,
-
-    'CONTINUE_LOOP': 0,
-    'SETUP_LOOP': 0,
-    'SETUP_EXCEPT': 0,
-    'SETUP_FINALLY': 0,
-
-    'LOAD_FAST': 1,
-    'STORE_FAST': -1,
-    'DELETE_FAST': 0,
-
-    'LOAD_CLOSURE': 1,
-    'LOAD_DEREF': 1,
-    'STORE_DEREF': -1,
-}
-
-
-def _stack_effect(op_code, oparg):
-  """Compute the effect an op_code and oparg have on the stack.  See python/compile.c."""
-  n_args = lambda o: (o % 256) + 2 * (o // 256)
-
-  if op_code == 'DUP_TOPX':
-    return oparg
-  elif op_code == 'UNPACK_SEQUENCE':
-    return oparg - 1
-  elif op_code == 'BUILD_TUPLE':
-    return -oparg  # Was 1 - oparg
-  elif op_code == 'BUILD_LIST':
-    return -oparg  # Was 1 - oparg
-  elif op_code == 'BUILD_SET':
-    return -oparg  # Was 1 - oparg
-  elif op_code == 'RAISE_VARARGS':
-    return -oparg
-  elif op_code == 'CALL_FUNCTION':
-    return -n_args(oparg)  # args + (#kwargs << 8)
-  elif op_code == 'CALL_FUNCTION_VAR':
-    return -n_args(oparg) - 1  # args + (#kwargs << 8)
-  elif op_code == 'CALL_FUNCTION_KW':
-    return -n_args(oparg) - 1  # args + (#kwargs << 8)
-  elif op_code == 'CALL_FUNCTION_VAR_KW':
-    return -n_args(oparg) - 2  # args + (#kwargs << 8)
-  elif op_code == 'MAKE_FUNCTION':
-    return -oparg
-  elif op_code == 'BUILD_SLICE':
-    if oparg == 3:
-      return -2
-    else:
-      return -1
-  elif op_code == 'MAKE_CLOSURE':
-    return -oparg - 1
-
-  return _STACK_EFFECTS[op_code]
-
-
-class _StackEntry(object):
-  """An entry in the decompilation stack."""
-
-  def __init__(self,
-               stack_depth,
-               curr_i,
-               curr_l,  # According to python, but can be inaccurate
-               opname,
-               oparg,
-               oparg_repr,
-               children,  # Array of StackEntries
-              ):
-    self.stack_depth = stack_depth
-    self.curr_i = curr_i
-    self.curr_l = curr_l
-    self.opname = opname
-    self.oparg = oparg
-    self.oparg_repr = oparg_repr
-    self.children = children
 
-  def __str__(self):
-    # pylint: disable=bad-continuation
-    return ('_StackEntry(stack_depth: {stack_depth}, '
-                        'curr_i: {curr_i}, '
-                        'opname: \'{opname}\', '
-                        'oparg: {oparg}, '
-                        'oparg_repr: {oparg_repr}, '
-                        'children: {children}'
-                        ')'.format(
-                            **self.__dict__))
-# pylint: enable=bad-continuation
-
-  __repr__ = __str__
-
-
-def _find_earliest_shortest_match(target, reg, search_start, search_end, num_attempts=10):
-  """Find the shortest string matching reg in the search area."""
-  shortest_match = None
-  shortest_match_search_start = 0
-  shortest_match_search_end = 0
-  qj._DEBUG_QJ and qj.LOG_FN('regex: %s' % repr(reg))
-  for i in range(num_attempts):
-    search_target = target[search_start:search_end]
-    qj._DEBUG_QJ and qj.LOG_FN('searching (%d): %s' % (i, search_target))
-
-    matches = re.search(reg, search_target)
-    if (matches
-        and (shortest_match is None
-             or (shortest_match is not None
-                 and (matches.end() - matches.start() < shortest_match.end() - shortest_match.start())))):
-      qj._DEBUG_QJ and qj.LOG_FN('found new shortest match: %s (%d, %d)' %
-                                 (matches.group(0), matches.start(),
-                                  matches.end()))
-
-      shortest_match = matches
-      shortest_match_search_start = search_start
-      shortest_match_search_end = search_end
-
-      search_end = search_start + matches.end()
-      search_start += matches.start() + 1
-
-      if not matches.group(0):
-        break
-    else:
+def _uninstrument(target):
+  """Restores the original functions of a module or class passed to qj.instrument.
+
+  Returns:
+    The sorted names of the restored functions.
+  """
+  originals = qj._instrumented.pop(target, [])
+  for owner, name, member in originals:
+    _unmonitor(getattr(member, '__func__', member))
+    if vars(owner).get(name) is not member:
+      setattr(owner, name, member)
+  return sorted('%s.%s' % (owner.__name__, name) if owner is not target
+                else name for owner, name, _ in originals)
+
+
+qj.instrument = _instrument
+qj.uninstrument = _uninstrument
+qj._instrumented = {}
+
+
+###############################################################################
+# Pre-bound site loggers
+###############################################################################
+class _SiteLogger(object):
+  """Callable that logs like a qj call at a fixed site with a fixed label.
+
+  Everything qj would compute from the calling frame is computed once, when
+  the logger is created, so each call only counts, formats and logs x.
+  """
+
+  __slots__ = ('_func_name', '_s', '_lineno', '_prefix', '_n', '_limited',
+               '_qj_dict', '_log_count_key')
+
+  def __init__(self, func_name, s, lineno, n, qj_dict, log_count_key):
+    self._func_name = func_name
+    self._s = s
+    self._lineno = lineno
+    self._prefix = '%s: %s <%d>:' % (func_name, s, lineno)
+    self._n = n
+    # As with qj, module-level code is exempt from the logging limit.
+    self._limited = 'module_level_code' not in func_name
+    # The log count lives in the creating frame's bookkeeping, so loggers
+    # created by the same instruction of one frame share it.
+    self._qj_dict = qj_dict
+    self._log_count_key = log_count_key
+
+  def __call__(self, x, b=True):
+    """Logs x, and returns it.
+
+    Arguments:
+      x: The thing to log.
+      b: Optional bool to enable or disable the logging of x.
+
+    Returns:
+      x.
+    """
+    if not (qj.LOG and b) or _logger_disabled():
+      return x
+    if self._limited:
+      count = self._qj_dict.get(self._log_count_key, 0) + 1
+      self._qj_dict[self._log_count_key] = count
+      if count > qj.MAX_FRAME_LOGS:
+        return x
+    prefix = self._prefix
+    log = ''
+    if self._n and 'numpy' in sys.modules:
+      try:
+        log, key = _numeric_summary(sys.modules['numpy'], x, self._n)
+        prefix = '%s: %s%s <%d>:' % (self._func_name, self._s, key,
+                                     self._lineno)
+      except:  # pylint: disable=bare-except
+        log = ''
+    if not log:
+      log = qj.STR_FN(x)
+    log = '(multiline log follows)\n%s' % log if '\n' in log else log
+    qj.LOG_FN('%s%s %s%s' % (qj.PREFIX, prefix, qj._COLOR_LOG(), log))
+    if self._limited and count == qj.MAX_FRAME_LOGS:
+      qj.LOG_FN('%s%s: %sMaximum per-site logging hit (%d). '
+                'No more logs will print from this logger. '
+                'Set qj.MAX_FRAME_LOGS to change the limit or call reset() '
+                'on the logger to zero out its log count.' %
+                (qj.PREFIX, self._func_name, qj._COLOR_LOG(), qj.MAX_FRAME_LOGS))
+    return x
+
+  def reset(self):
+    """Zeroes out the log count, so that logging continues after the limit."""
+    self._qj_dict[self._log_count_key] = 0
+
+
+def _at(s, n=False, _depth=1):
+  """Returns a logger bound to label s and to the call site that created it.
+
+  `log = qj.at('batch loss')` and then `log(loss)` in a loop logs each loss
+  like `qj(loss, 'batch loss')` would, with the same prefix, per-frame limit
+  and formatting, but without looking at the calling frame or its source code.
+
+  As with qj calls, the limit is per instruction of the calling frame: loggers
+  created by the same `qj.at` call in one frame, such as one created inside a
+  loop, share a single count, while loggers created on different lines each get
+  qj.MAX_FRAME_LOGS logs.
+
+  Arguments:
+    s: The label to log with.
+    n: Optional bool or int to log numeric summaries of x, as with qj's `n`.
+    _depth: Private parameter used to specify which stack frame the logs are
+            reported from.
+
+  Returns:
+    A callable that logs its argument and returns it.
+  """
+  f = sys._getframe(_depth)
+  qj_dict = f.f_locals.get('__qj_magic_wocha_doin__')
+  if qj_dict is None:
+    qj_dict = f.f_locals['__qj_magic_wocha_doin__'] = {}
+  return _SiteLogger(_frame_func_name(f), s, f.f_lineno, n, qj_dict,
+                     'frame_log_count_%d' % f.f_lasti)
+
+
+qj.at = qj.site = _at
+
+
+###############################################################################
+# Batches
+###############################################################################
+def _batch(values, s='', limit=10, n=False, b=True, _depth=1):
+  """Logs many values with one prefix and a single call to qj.LOG_FN.
+
+  `qj.batch(losses)` logs something like:
+    qj: <some_file> train: losses <12>: (multiline log follows)
+    1000 values, showing the first 10
+      [0] 0.69
+      ...
+
+  Arguments:
+    values: The values to log. Iterators are consumed into a list, even if the
+            log is disabled.
+    s: Optional string to prefix the log message with, as with qj's `s`.
+    limit: Optional number of values to log individually. The rest are only
+           counted, and summarized if `n` is set.
+    n: Optional bool to add the (min (mean std) max) of the numeric values to
+       the summary line.
+    b: Optional bool to enable or disable the log.
+    _depth: Private parameter used to specify which stack frame the log is
+            reported from.
+
+  Returns:
+    values, or the list they were consumed into if values was an iterator.
+  """
+  # Iterators are consumed whether or not the log is enabled, so callers always
+  # get the same kind of value back.
+  if not hasattr(values, '__len__'):
+    values = list(values)
+  if not (qj.LOG and b) or _logger_disabled():
+    return values
+
+  f = sys._getframe(_depth)
+  frame_state = _frame_log_state(f)
+  if frame_state is None:
+    return values
+  qj_dict, log_count_key, func_name, spaces = frame_state
+  s = s or _site_label(f) or str(type(values))
+
+  count = len(values)
+  limit = max(0, int(limit))
+  summary = '%d values' % count
+  if count > limit:
+    summary += ', showing the first %d' % limit
+  if n:
+    stats = _RunningStats()
+    for value in values:
+      try:
+        stats.add(float(value))
+      except (TypeError, ValueError):
+        pass
+    summary += ', (min (mean std) max): %s' % stats
+  lines = [summary]
+  for i, value in enumerate(values):
+    if i >= limit:
       break
+    lines.append('  [%d] %s' % (i, qj.STR_FN(value)))
 
-  return shortest_match, shortest_match_search_start, shortest_match_search_end
+  qj.LOG_FN('%s(multiline log follows)\n%s' % (
+      _site_format(f, func_name, spaces, s)[1], '\n'.join(lines)))
+  if qj_dict[log_count_key] == qj.MAX_FRAME_LOGS:
+    _log_frame_limit(func_name, spaces)
+  return values
 
 
-def _annotate_fn_args(stack, fn_opname, nargs, nkw=-1, consume_fn_name=True):
-  """Add commas and equals as appropriate to function argument lists in the stack."""
-  kwarg_names = []
-  if nkw == -1:
-    if sys.version_info[0] < 3:
-      # Compute nkw and nargs from nargs for python 2.7
-      nargs, nkw = (nargs % 256, 2 * nargs // 256)
-    else:
-      if fn_opname == 'CALL_FUNCTION_KW':
-        if qj._DEBUG_QJ:
-          assert len(stack) and stack[-1].opname == 'LOAD_CONST'
-        if not len(stack) or stack[-1].opname != 'LOAD_CONST':
-          return
-        se = stack.pop()
-        kwarg_names = se.oparg_repr[::-1]
-        se.oparg_repr = ['']
-        nkw = len(kwarg_names)
-        nargs -= nkw
-        if qj._DEBUG_QJ:
-          assert nargs >= 0 and nkw > 0
-      else:
-        nkw = 0
-
-  for i in range(nkw):
-    se = stack.pop()
-    if se.stack_depth == 0 and (len(se.oparg_repr) == 0 or se.oparg_repr[0] == ''):
-      # Skip stack entries that don't have any effect on the stack
-      continue
-    if i % 2 == 1 and sys.version_info[0] < 3:
-      if qj._DEBUG_QJ:
-        assert se.opname == 'LOAD_CONST'
-      if se.opname == 'LOAD_CONST':
-        # kwargs are pairs of key=value in code
-        se.oparg_repr += ['=']
-    else:
-      pops = []
-      if se.opname.startswith('CALL_FUNCTION'):
-        _annotate_fn_args(stack[:], se.opname, se.oparg, -1, True)
-      pops = _collect_pops(stack, se.stack_depth - 1 if se.opname.startswith('CALL_FUNCTION') else 0, [], False)
-      if i > 1 and len(pops):
-        pops[-1].oparg_repr += [',']
-      if sys.version_info[0] >= 3:
-        target_se = pops[-1] if len(pops) else se
-        target_se.oparg_repr = [kwarg_names[i], '='] + target_se.oparg_repr
-
-  for i in range(nargs):
-    se = stack.pop()
-    if se.opname.startswith('CALL_FUNCTION'):
-      _annotate_fn_args(stack, se.opname, se.oparg, -1, True)
-    elif len(se.oparg_repr) and se.oparg_repr[0] in {']', '}', ')'}:
-      if (i > 0 or nkw > 0):
-        se.oparg_repr += [',']
-    else:
-      pops = _collect_pops(stack, se.stack_depth, [], False)
-      if (i > 0 or nkw > 0) and len(pops):
-        pops[-1].oparg_repr += [',']
-
-  if consume_fn_name:
-    _collect_pops(stack, -1, [], False)
-
-
-def _collect_pops(stack, depth, pops, skip):
-  """Recursively collects stack entries off the top of the stack according to the stack entry's depth."""
-  if depth >= 0:
-    return pops
-
-  set_current_depth_after_recursion = False
-  set_skip_for_current_entry_children = False
-  set_skip_after_current_entry = False
-  extract_next_tokens = False
-  expect_extracted_tokens = []
-
-  se = stack.pop()
-  pops_len = len(pops)
-  if (pops_len > 1
-      and se.opname == 'BUILD_TUPLE'
-      and pops[-1].opname == 'LOAD_CONST'
-      and pops[-1].oparg_repr[0] in ['lambda', '{', '(', '[']
-      and pops[-2].opname in ['MAKE_CLOSURE', 'MAKE_FUNCTION']):
-    # Skip BUILD_TUPLE and its children if they are storing arguments for a closure, since those don't show up in the code.
-    skip = -se.stack_depth + 1
-
-  if (pops_len > 2
-      and sys.version_info[0] >= 3
-      and se.opname == 'BUILD_TUPLE'
-      and pops[-1].opname == 'LOAD_CONST'
-      and pops[-1].oparg_repr[0] in ['lambda', '{', '(', '[']
-      and pops[-2].opname == 'LOAD_CONST'
-      and pops[-3].opname in ['MAKE_CLOSURE', 'MAKE_FUNCTION']):
-    # Skip BUILD_TUPLE and its children if they are storing arguments for a closure, since those don't show up in the code.
-    skip = -se.stack_depth + 1
-
-  if (pops_len > 0
-      and se.opname == 'GET_ITER'
-      and pops[-1].opname in ('CALL_FUNCTION', 'PRECALL')):
-    # CALL_FUNCTION or PRECALL followed by GET_ITER means we are calling one of the comprehensions and we are about to load its arguments.
-    # The CALL_FUNCTION or PRECALL at the top of the stack should be invisible, since it expects a ')' which won't appear in the code.
-    if pops[-1].opname == 'PRECALL' and len(pops) > 2 and pops[-2].opname == 'CALL':
-      # In the case of the PRECALL CALL patter, the CALL has the expected ')' that shouldn't appear.
-      pops[-2].oparg_repr = ['']
-    else:
-      # Otherwise it's the CALL_FUNCTION that needs modification
-      pops[-1].oparg_repr = ['']
-    # We need to extract the arguments that we're about to load so that we can store their tokens inside of the upcoming comprehension.
-    extract_next_tokens = -1
-    expect_extracted_tokens = [
-        # Expect BUILD_TUPLE as the last stack token extracted (required=False) and replace its oparg_repr with ''.
-        (0, 'BUILD_TUPLE', False, 'replace', [''])
-    ]
-
-  if (pops_len > 1
-      and len(stack) > 0
-      and stack[-1].opname == 'BUILD_LIST'
-      and se.opname == 'LOAD_FAST'
-      and pops[-1].opname == 'LIST_EXTEND'
-      and pops[-2].opname == 'LIST_TO_TUPLE'):
-    # BUILD_LIST followed by LOAD_FAST followed LIST_EXTEND followed by LIST_TO_TUPLE probably means we are calling a function with *args.
-    # Prepend the LOAD_FAST repr with '*' and remove the other reprs.
-    se.oparg_repr = ['*'] + se.oparg_repr
-    stack[-1].oparg_repr = ['']
-    pops[-1].oparg_repr = ['']
-    pops[-2].oparg_repr = ['']
-
-  if (pops_len > 0
-      and len(stack) > 1
-      and stack[-2].opname == 'BUILD_TUPLE'
-      and stack[-1].opname == 'BUILD_MAP'
-      and se.opname == 'LOAD_FAST'
-      and pops[-1].opname == 'DICT_MERGE'):
-    # BUILD_TUPLE followed by BUILD_MAP followed by LOAD_FAST followed DICT_MERGE probably means we are calling a function with **kwargs.
-    # Remove the BUILD_TUPLE repr but leave the others alone, as they will be handled further below.
-    stack[-2].oparg_repr = ['']
-
-  if (pops_len > 0
-      and len(stack) > 0
-      and stack[-1].opname == 'BUILD_MAP'
-      and se.opname == 'LOAD_FAST'
-      and pops[-1].opname == 'DICT_MERGE'):
-    # BUILD_MAP followed by LOAD_FAST followed DICT_MERGE probably means we are calling a function with **kwargs.
-    # Prepend the LOAD_FAST repr with '**' and remove the BUILD_MAP and DICT_MERGE reprs.
-    se.oparg_repr = ['**'] + se.oparg_repr
-    stack[-1].oparg_repr = ['']
-    pops[-1].oparg_repr = ['']
-
-  if (len(stack)
-      and se.opname == 'BUILD_TUPLE_UNPACK_WITH_CALL'):
-    extract_next_tokens = se.stack_depth
-    expect_extracted_tokens = [
-        # Expect LOAD_FAST as the first element (required=True), and prepend its oparg_repr with '*'.
-        (0, 'LOAD_FAST', True, 'prepend', ['*']),
-        # Expect BUILD_TUPLE as the last stack token extracted (required=False) and replace its oparg_repr with ''.
-        (abs(extract_next_tokens) - 1, 'BUILD_TUPLE', False, 'replace', [''])
-    ]
-    set_current_depth_after_recursion = se.stack_depth
-    se.stack_depth = 0
-
-  if (pops_len > 0
-      and sys.version_info[0] >= 3
-      and se.opname == 'LOAD_CONST'
-      and pops[-1].opname == 'MAKE_FUNCTION'):
-    # In python 3, MAKE_FUNCTION followed by LOAD_CONST is loading the name of the function, which won't appear in the code.
-    se.oparg_repr = ['']
-    # Additionally, this entry shouldn't impact future stack computations, as MAKE_FUNCTION will be removed.
-    set_current_depth_after_recursion = 0
-
-  if pops_len and pops[-1].opname == 'LIST_APPEND':
-    # Skip all but the first stack entry of list comprehensions. Sets the skip value to be all remaining stack entries.
-    # The BUILD_LIST check below will disable skip at the right time.
-    set_skip_after_current_entry = len(stack)
-
-  if skip > 0 and se.opname == 'BUILD_LIST' and se.stack_depth == 0:
-    # If we're in skip mode and we just hit what might be the beginning of a list comprehension, check for a LIST_APPEND in the current pops.
-    for popped_se in pops[::-1]:
-      if popped_se.opname == 'LIST_APPEND':
-        skip = 0
-        break
+qj.batch = _batch
+
 
-  children_skip = skip
-  if (se.opname.startswith('UNARY_')
-      or (se.opname.startswith('BINARY_') and se.opname != 'BINARY_SUBSCR')
-      or se.opname == 'SLICE+2'
-      or se.opname == 'SLICE+3'
-      or se.opname == 'COMPARE_OP'):
-    # Unary and binary ops come after their operand(s) on the stack, but before (or between) their operand(s) in code, so we need to reverse that.
-
-    if set_skip_for_current_entry_children or skip > 0:
-      children_skip = 1
-    pops = _collect_pops(stack, -1, pops, children_skip)
-
-    if skip <= 0:
-      pops.append(se)
-      qj._DEBUG_QJ and qj.LOG_FN('added se: %r' % se)
+###############################################################################
+# sys.monitoring (PEP 669) backend
+###############################################################################
+# With qj.MONITORING set on Python 3.12+, timing and call logging for a
+# function are attached to its code object with sys.monitoring events instead
+# of a wrapper, so the function keeps its identity and code objects that aren't
+# being monitored run at full speed. Since all closures created from the same
+# code share its code object, they are monitored together.
+qj.MONITORING = False
+qj._monitored = {}
+qj._monitoring_tool = None
+
+# Calls that exit by raising never remove their start times from the table of
+# running calls (PY_UNWIND can only be monitored for the whole process), so the
+# table is checked against the frames that are actually running when it gets
+# this big.
+_MAX_RUNNING_CALLS = 1000
+
+# inspect.CO_VARARGS and inspect.CO_VARKEYWORDS, without importing inspect.
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
+
+class _MonitoredCode(object):
+  """Per-code-object settings and state for the sys.monitoring backend."""
+
+  __slots__ = ('fn', 'name', 'arg_names', 'logs_every', 'log_every', 'calls',
+               'running', 'running_limit')
+
+  def __init__(self, fn, name, logs_every, log_every):
+    co = fn.__code__
+    self.fn = fn
+    self.name = name
+    self.arg_names = co.co_varnames[
+        :co.co_argcount + co.co_kwonlyargcount
+        + bool(co.co_flags & _CO_VARARGS)
+        + bool(co.co_flags & _CO_VARKEYWORDS)]
+    self.logs_every = logs_every
+    self.log_every = log_every
+    self.calls = 0
+    self.running = {}
+    self.running_limit = _MAX_RUNNING_CALLS
+
+
+def _use_monitoring(fn):
+  return (qj.MONITORING and hasattr(sys, 'monitoring')
+          and isinstance(getattr(fn, '__code__', None), types.CodeType))
+
+
+def _monitoring_tool():
+  """Claims a sys.monitoring tool id for qj the first time it's needed."""
+  if qj._monitoring_tool is None:
+    monitoring = sys.monitoring
+    for tool in (3, 4, monitoring.PROFILER_ID):
+      if monitoring.get_tool(tool) is None:
+        break
     else:
-      qj._DEBUG_QJ and qj.LOG_FN('(skipping se: %r %r)' % (se.opname, se.oparg_repr))
+      raise RuntimeError('qj: no free sys.monitoring tool ids.')
+    monitoring.use_tool_id(tool, 'qj')
+    monitoring.register_callback(tool, monitoring.events.PY_START,
+                                 _on_py_start)
+    monitoring.register_callback(tool, monitoring.events.PY_RETURN,
+                                 _on_py_return)
+    qj._monitoring_tool = tool
+  return qj._monitoring_tool
+
+
+def _monitor(fn, name, time, log_calls):
+  """Times and/or logs calls to fn with sys.monitoring events on its code."""
+  tool = _monitoring_tool()
+  log_every = max(1, int(round(1.0 / float(log_calls)))) if log_calls else 0
+  qj._monitored[fn.__code__] = _MonitoredCode(fn, name, int(time), log_every)
+  events = sys.monitoring.events
+  sys.monitoring.set_local_events(tool, fn.__code__,
+                                  events.PY_START | events.PY_RETURN)
+
+
+def _unmonitor(fn):
+  if qj._monitored.pop(getattr(fn, '__code__', None), None) is not None:
+    sys.monitoring.set_local_events(qj._monitoring_tool, fn.__code__, 0)
+
+
+def _drop_finished_calls(monitored):
+  """Drops running calls whose frames aren't on any thread's stack."""
+  running_frames = set()
+  for f in sys._current_frames().values():
+    while f is not None:
+      running_frames.add(id(f))
+      f = f.f_back
+  for key in list(monitored.running):
+    if key not in running_frames:
+      monitored.running.pop(key, None)
+  monitored.running_limit = max(_MAX_RUNNING_CALLS, 2 * len(monitored.running))
+
+
+def _on_py_start(code, _):
+  monitored = qj._monitored.get(code)
+  if monitored is None:
+    return
+  f = sys._getframe(1)
+  monitored.calls += 1
+  log = bool(qj.LOG and monitored.log_every
+             and (monitored.calls - 1) % monitored.log_every == 0
+             and not _logger_disabled())
+  if len(monitored.running) >= monitored.running_limit:
+    _drop_finished_calls(monitored)
+  monitored.running[id(f)] = (_time.time(), log)
+  if log:
+    f_locals = f.f_locals
+    _log_at_frame(f.f_back, 'calling %s' % monitored.name, '%s(%s)' % (
+        monitored.name, ', '.join('%s=%r' % (arg, f_locals[arg])
+                                  for arg in monitored.arg_names
+                                  if arg in f_locals)))
+
+
+def _on_py_return(code, _, retval):
+  monitored = qj._monitored.get(code)
+  if monitored is None:
+    return
+  f = sys._getframe(1)
+  start = monitored.running.pop(id(f), None)
+  if start is None:
+    return
+  if monitored.logs_every:
+    _record_timing(monitored.fn, _time.time() - start[0], monitored.logs_every,
+                   _depth=4)
+  if start[1]:
+    _log_at_frame(f.f_back, 'returning from %s' % monitored.name,
+                  qj.STR_FN(retval))
+
+
+def _public_members(x):
+  """Lists x's public members for p=, with signatures for its functions.
+
+  Members are read from the __dict__s of x's class and its bases (and of x
+  itself), rather than with getattr, so properties and other descriptors are
+  never evaluated. The table for each class is only built once.
 
-    popped_depth = se.stack_depth + 1
+  Returns:
+    A list of strings like 'name' or 'name(arg, kwarg=None)', sorted by name.
+  """
+  if isinstance(x, type):
+    members = _member_table(x, bound=False)
   else:
-    # Non prefix/infix ops -- their representations come after their children in code, or they don't have children.
-    if skip <= 0:
-      pops.append(se)
-      qj._DEBUG_QJ and qj.LOG_FN('added se: %r' % se)
-    else:
-      qj._DEBUG_QJ and qj.LOG_FN('(skipping se: %r %r)' % (se.opname, se.oparg_repr))
-
-    if ((se.stack_depth < 0
-         and se.opname != 'BUILD_SLICE'
-         and se.opname.startswith('BUILD_'))
-        or se.stack_depth >= 0):
-      next_depth = se.stack_depth
-    elif (se.stack_depth < 0
-          and se.opname == 'DICT_MERGE'):
-      next_depth = se.stack_depth
-    else:
-      next_depth = se.stack_depth - 1
-
-    if set_skip_for_current_entry_children or skip > 0:
-      children_skip = abs(next_depth)
-    if se.opname == 'BUILD_SLICE':
-      # BUILD_SLICE's arguments need to be collected, as missing args are replaced with Nones which don't appear in the code.
-      slice_pops = _collect_pops(stack, next_depth, [], children_skip)
-      added_colon = 0
-      for slice_se in slice_pops:
-        if slice_se.opname == 'LOAD_CONST' and slice_se.oparg_repr[0] == 'None':
-          if added_colon >= 1:
-            slice_se.oparg_repr = ['']
-          else:
-            slice_se.oparg_repr = [':']
-            added_colon += 1
-        pops.append(slice_se)
-    else:
-      pops = _collect_pops(stack, next_depth, pops, children_skip)
+    members = _member_table(type(x), bound=True)
+    instance_dict = getattr(x, '__dict__', None)
+    if isinstance(instance_dict, dict):
+      instance_members = [(name, member) for name, member in instance_dict.items()
+                           if name == '__init__' or not name.startswith('_')]
+      if instance_members:
+        members = dict(members)
+        for name, member in instance_members:
+          members[name] = _describe_member(name, member, bound=False)
+  return [members[name] for name in sorted(members)]
+
+
+def _member_table(cls, bound):
+  """Returns a cached {name: description} dict of cls's public members."""
+  tables = qj._member_tables.get(cls)
+  if tables is None:
+    tables = qj._member_tables[cls] = {}
+  table = tables.get(bound)
+  if table is None:
+    table = {}
+    # Walk the MRO from object down, so subclasses override their bases.
+    for klass in reversed(cls.__mro__):
+      for name, member in list(vars(klass).items()):
+        if name == '__init__' or not name.startswith('_'):
+          table[name] = _describe_member(name, member, bound)
+    tables[bound] = table
+  return table
+
+
+def _describe_member(name, member, bound):
+  drop_first = bound
+  if isinstance(member, (staticmethod, classmethod)):
+    drop_first = isinstance(member, classmethod)
+    member = member.__func__
+  if isinstance(member, (types.FunctionType, type(object.__init__))):
+    return name + _signature(member, drop_first)
+  return name
+
+
+def _signature(fn, drop_first):
+  """Returns fn's signature as a string, computed once per function."""
+  try:
+    signatures = qj._signatures.get(fn)
+    if signatures is None:
+      signatures = qj._signatures[fn] = {}
+  except TypeError:  # Not weakly referenceable, e.g. slot wrappers.
+    signatures = {}
+  signature = signatures.get(drop_first)
+  if signature is None:
+    try:
+      import inspect  # pylint: disable=g-import-not-at-top
+      if hasattr(inspect, 'signature'):
+        sig = inspect.signature(fn)
+        params = list(sig.parameters.values())
+        # Methods looked up through an instance don't show self.
+        if (drop_first and params and params[0].kind in (
+            params[0].POSITIONAL_ONLY, params[0].POSITIONAL_OR_KEYWORD)):
+          sig = sig.replace(parameters=params[1:])
+        signature = str(sig)
+      else:  # Python 2
+        args, varargs, keywords, defaults = inspect.getargspec(fn)
+        if drop_first and args:
+          args = args[1:]
+          defaults = defaults and defaults[-len(args):] if args else None
+        signature = inspect.formatargspec(args, varargs, keywords, defaults)
+    except (TypeError, ValueError):
+      signature = ''
+    signatures[drop_first] = signature
+  return signature
+
+
+def _site_label(f):
+  """Returns the source code between the parentheses of the call f is making.
+
+  Labels are extracted once per call site and cached in qj._FN_MAPS. Returns ''
+  if the source code isn't available, or extracting the label fails.
+  """
+  code_key = (f.f_code.co_filename, f.f_code)
+  fn_calls = qj._FN_MAPS.get(code_key)
+  if fn_calls is None:
+    fn_calls = qj._FN_MAPS.setdefault(code_key, {})
+  if f.f_lasti not in fn_calls:
+    try:
+      if qj.BACKGROUND_LABELS:
+        # Log with a placeholder until the background thread replaces it.
+        fn_calls[f.f_lasti] = '%s:%d' % (os.path.basename(f.f_code.co_filename), f.f_lineno)
+        _queue_label(fn_calls, f.f_code, f.f_lasti, f.f_globals)
+      else:
+        from qj import labels  # pylint: disable=g-import-not-at-top
+        qj._DEBUG_QJ and labels._disassemble(f.f_code, f.f_lasti)
+        fn_calls[f.f_lasti] = labels._find_current_fn_call(f.f_code, f.f_lasti, f.f_globals)
+    except Exception:  # pylint: disable=broad-except
+      # Couldn't get the source code or make sense of it, so the caller falls
+      # back to the type. The failure is cached, as on the background thread,
+      # so it isn't retried on every log.
+      fn_calls[f.f_lasti] = ''
+  return fn_calls.setdefault(f.f_lasti, '').strip()
+
+
+def _frame_func_name(f):
+  """Returns the name logs made from frame f are reported under."""
+  func_name = f.f_code.co_name
+  if func_name == '<dictcomp>':
+    func_name = f.f_back.f_code.co_name
+  if func_name == '<genexpr>':
+    func_name = f.f_back.f_code.co_name
+  if func_name == '<listcomp>':
+    func_name = f.f_back.f_code.co_name
+  elif func_name == '<setcomp>':
+    func_name = f.f_back.f_code.co_name
+  elif func_name == '<lambda>':
+    func_name = f.f_back.f_code.co_name + '.lambda'
+  if func_name.startswith('<module>'):
+    func_name = func_name.replace('<module>', 'module_level_code')
+
+  filename = os.path.basename(f.f_code.co_filename)
+  # Don't include the filename when logging in ipython contexts.
+  if filename[0] != '<':
+    filename = filename.replace('.py', '')
+    func_name = '<{}> {}'.format(filename, func_name)
+  return func_name
+
+
+def _frame_log_state(f, z=False):
+  """Does the per-frame bookkeeping for a log made at f's current instruction.
 
-    # BUILD_LIST 0 marks the start of a list comprehension, but we need it to consume a slot on the stack.
-    if se.stack_depth == 0 and se.opname != 'BUILD_LIST':
-      popped_depth = 0
-    else:
-      popped_depth = 1
-
-  tokens = []
-  if extract_next_tokens < 0:
-    tokens = _collect_pops(stack, extract_next_tokens, [], skip)
-    for index, expected_token, required, fixup_type, fixup_value in expect_extracted_tokens:
-      if qj._DEBUG_QJ:
-        assert (index < 0 and index + len(tokens) > 0) or 0 <= index < len(tokens)
-        if required:
-          assert tokens[index].opname == expected_token
-      if (index < 0 and index + len(tokens) > 0) or 0 <= index < len(tokens) and tokens[index].opname == expected_token:
-        if fixup_type == 'prepend':
-          tokens[index].oparg_repr = fixup_value + tokens[index].oparg_repr
-        elif fixup_type == 'replace':
-          tokens[index].oparg_repr = fixup_value
-    tokens.reverse()
-    popped_depth -= extract_next_tokens
-
-  if children_skip > 0:
-    skip -= popped_depth
-
-  if set_skip_after_current_entry > 0:
-    skip = set_skip_after_current_entry + max(0, skip)
-
-  pops = _collect_pops(stack, depth + popped_depth, pops, skip)
-
-  if len(tokens):  # pylint: disable=g-explicit-length-test
-    target_se = pops[-1]
-    target_se.children.append(tokens)
-    target_se.oparg_repr = target_se.oparg_repr[:1] + [t for token in tokens for t in token.oparg_repr] + target_se.oparg_repr[1:]
-
-  if set_current_depth_after_recursion is not False:
-    se.stack_depth = set_current_depth_after_recursion
-
-  return pops
-
-
-def _build_instruction_stack(co, lasti):
-  code = co.co_code
-
-  linestarts = dict(_findlinestarts(co))
-
-  instr_to_ops = collections.OrderedDict()
-
-  num_instr = len(code)
-
-  if qj._DEBUG_QJ:
-    assert lasti < num_instr
-  if lasti >= num_instr:
-    return ''
-
-  instr = 0
-  extended_arg = 0
-  free = None
-  curr_l = 0
-  while instr <= lasti:
-    curr_i = instr
-    if instr in linestarts:
-      curr_l = linestarts[instr]
-
-    op = ord(code[instr])
-    opname = opcode.opname[op]
-
-    oparg = -1
-    oparg_repr = ''
-
-    instr += 1
-
-    if op >= opcode.HAVE_ARGUMENT:
-      oparg = ord(code[instr]) + ord(code[instr + 1]) * 256 + extended_arg
-      extended_arg = 0
-      instr += 2
-      if op == opcode.EXTENDED_ARG:
-        extended_arg = oparg * 65536
-
-      if op in opcode.hasconst:
-        oparg_repr = co.co_consts[oparg]
-        if isinstance(oparg_repr, types.CodeType):
-          qj._DEBUG_QJ and qj._DISASSEMBLE_FN(oparg_repr, -1)
-          if oparg_repr.co_name == '<lambda>':
-            oparg_repr = ['lambda', ':']
-          elif oparg_repr.co_name == '<dictcomp>' or oparg_repr.co_name == '<setcomp>':
-            oparg_repr = ['{', '}']
-          elif oparg_repr.co_name == '<genexpr>':
-            oparg_repr = ['(', ')']
-          else:
-            oparg_repr = ''
-      elif op in opcode.hasname:
-        oparg_repr = co.co_names[oparg]
-      elif op in opcode.hasjrel:
-        oparg_repr = ''  # instr + oparg
-      elif op in opcode.haslocal:
-        oparg_repr = co.co_varnames[oparg]
-        if oparg_repr.startswith('.'):
-          oparg_repr = ''  # Skip unnamed locals like .0
-      elif op in opcode.hascompare:
-        oparg_repr = opcode.cmp_op[oparg]
-      elif op in opcode.hasfree:
-        if free is None:
-          free = co.co_cellvars + co.co_freevars
-        oparg_repr = free[oparg]
-
-      if oparg > 0:
-        if opname == 'BUILD_LIST':
-          oparg_repr = ']'
-        elif opname == 'BUILD_TUPLE':
-          oparg_repr = ')'
-        elif opname == 'BUILD_SET':
-          oparg_repr = '}'
-        elif opname == 'BUILD_MAP':
-          oparg_repr = '{'  # BUILD_MAP happens at the beginning of the map
-        elif opname == 'LIST_APPEND':
-          oparg_repr = ']'
-        elif opname == 'SET_ADD':
-          oparg_repr = ''
-        elif opname.startswith('CALL_FUNCTION'):
-          oparg_repr = ')'
-        elif opname == 'MAP_ADD':
-          oparg_repr = ''
-        elif opname == 'FOR_ITER':
-          oparg_repr = ''
-        else:
-          oparg_repr = ''  # Default representation is empty.
-
-      elif oparg == 0:
-        if opname == 'BUILD_LIST':
-          # BUILD_LIST 0 occurs at the beginning of list comprehensions
-          oparg_repr = '['
-        elif opname == 'BUILD_TUPLE':
-          oparg_repr = '('
-        elif opname == 'BUILD_SET':
-          oparg_repr = '{'
-        elif opname == 'BUILD_MAP':
-          oparg_repr = '{'
-        elif opname.startswith('CALL_FUNCTION'):
-          oparg_repr = ')'
-        elif opname == 'MAKE_CLOSURE':
-          oparg_repr = ''
-        else:
-          oparg_repr = ''  # Default representation is empty.
+  Arguments:
+    f: The stack frame being logged from.
+    z: Whether to zero out the frame's state first.
 
-    else:
-      # Ops without arguments.
-      if opname == 'UNARY_POSITIVE':
-        oparg_repr = '+'
-      elif opname == 'UNARY_NEGATIVE':
-        oparg_repr = '-'
-      elif opname == 'UNARY_NOT':
-        oparg_repr = ''  # TODO(iansf)
-      elif opname == 'UNARY_CONVERT':
-        oparg_repr = ''  # TODO(iansf)
-      elif opname == 'UNARY_INVERT':
-        oparg_repr = '~'
-      elif opname == 'BINARY_POWER':
-        oparg_repr = '**'
-      elif opname == 'BINARY_MULTIPLY':
-        oparg_repr = '*'
-      elif opname == 'BINARY_DIVIDE':
-        oparg_repr = '/'
-      elif opname == 'BINARY_MODULO':
-        oparg_repr = '%'
-      elif opname == 'BINARY_ADD':
-        oparg_repr = '+'
-      elif opname == 'BINARY_SUBTRACT':
-        oparg_repr = '-'
-      elif opname == 'BINARY_SUBSCR':
-        oparg_repr = ']'
-      elif opname == 'BINARY_FLOOR_DIVIDE':
-        oparg_repr = '//'
-      elif opname == 'BINARY_TRUE_DIVIDE':
-        oparg_repr = '/'
-      elif opname == 'BINARY_LSHIFT':
-        oparg_repr = '<<'
-      elif opname == 'BINARY_RSHIFT':
-        oparg_repr = '>>'
-      elif opname == 'BINARY_AND':
-        oparg_repr = '&'
-      elif opname == 'BINARY_XOR':
-        oparg_repr = '^'
-      elif opname == 'BINARY_OR':
-        oparg_repr = '|'
-      elif opname == 'GET_ITER':
-        oparg_repr = ''
-      elif opname.startswith('SLICE+'):
-        oparg_repr = ':'
-      else:
-        oparg_repr = ''  # Default representation is empty.
+  Returns:
+    A tuple of (qj_dict, log_count_key, func_name, spaces), or None if the
+    per-frame logging limit has already been hit at this instruction.
+  """
+  # This is the magic dictionary where we write state that gives log output
+  # that can represent the underlying function's code structure, as well as
+  # tracking how many times we logged from the stack frame, which allows us
+  # to minimize log spam from logs in loops and comprehensions.
+  qj_dict = f.f_locals.get('__qj_magic_wocha_doin__', {})
+  qj_dict = {} if z else qj_dict
+  log_count_key = 'frame_log_count_%d' % f.f_lasti
+  qj_dict[log_count_key] = qj_dict.get(log_count_key, 0) + 1
+
+  if qj_dict[log_count_key] > qj.MAX_FRAME_LOGS:
+    return None
+
+  # We're going to log things, so go ahead and collect information about the
+  # caller's stack frame.
+  func_name = qj_dict.get('func_name')
+  if func_name is None:
+    func_name = qj_dict['func_name'] = _frame_func_name(f)
+
+  # If we are dealing with module-level code, don't limit logging, since
+  # large amounts of module-level logs generally means we're running in a
+  # colab, and it's annoying to have your logs suddenly stop after k runs.
+  if 'module_level_code' in func_name:
+    qj_dict[log_count_key] = 1
+
+  # This is the magic that allows us to indent the logs in a sensible
+  # manner. f_lasti is the last instruction index executed in the frame
+  # (i.e., the instruction that executed the call to qj). We add each
+  # instruction index into the dictionary, setting the value to the length
+  # of the dictionary after that addition, so the first instruction we see
+  # gets a value of 1, the second a value of 2, etc.
+  qj_instructions_dict = qj_dict.get('instructions', {})
+  qj_dict['instructions'] = qj_instructions_dict
+  qj_instructions_dict[f.f_lasti] = qj_instructions_dict.get(
+      f.f_lasti, len(qj_instructions_dict) + 1)
+  # Here, we use that value to determine how many spaces we need after the
+  # log prefix.
+  spaces = ' ' * qj_instructions_dict[f.f_lasti]
+  # And we store the dictionary back in the caller's frame.
+  f.f_locals['__qj_magic_wocha_doin__'] = qj_dict
+  return qj_dict, log_count_key, func_name, spaces
+
+
+def _site_format(f, func_name, spaces, s):
+  """Returns the prefix of logs from f's current instruction, and their head.
+
+  The head is everything logged before the value: qj.PREFIX, the prefix and the
+  log color. Both are cached per call site, and rebuilt only when something
+  they are built from changes.
+  """
+  site = (f.f_code, f.f_lasti)
+  c = qj._site_formats.get(site)
+  if (c is None or c[0] != s or c[1] != spaces or c[2] != func_name
+      or c[3] is not qj.PREFIX or c[4] is not qj.COLOR
+      or c[5] is not qj.LOG_COLOR):
+    prefix = '%s:%s%s <%d>:' % (func_name, spaces, s, f.f_lineno)
+    c = qj._site_formats[site] = (
+        s, spaces, func_name, qj.PREFIX, qj.COLOR, qj.LOG_COLOR, prefix,
+        '%s%s %s' % (qj.PREFIX, prefix, qj._COLOR_LOG()))
+  return c[6], c[7]
+
+
+def _log_frame_limit(func_name, spaces):
+  qj.LOG_FN('%s%s:%s%sMaximum per-frame logging hit (%d). '
+            'No more logs will print at this call within this stack frame. '
+            'Set qj.MAX_FRAME_LOGS to change the limit or pass z=1 to this qj call '
+            'to zero out the frame log count.' %
+            (qj.PREFIX, func_name, spaces, qj._COLOR_LOG(), qj.MAX_FRAME_LOGS))
+
+
+def _log_at_frame(f, s, log):
+  """Logs directly from frame f, with the same bookkeeping as a qj call there."""
+  if not qj.LOG or _logger_disabled():
+    return
+  frame_state = _frame_log_state(f)
+  if frame_state is None:
+    return
+  qj_dict, log_count_key, func_name, spaces = frame_state
+  log = '(multiline log follows)\n%s' % log if '\n' in log else log
+  qj.LOG_FN(_site_format(f, func_name, spaces, s)[1] + log)
+  if qj_dict[log_count_key] == qj.MAX_FRAME_LOGS:
+    _log_frame_limit(func_name, spaces)
+
+
+def _format_call(name, args, kwargs):
+  return '%s(%s)' % (name, ', '.join(['%r' % a for a in args]
+                                     + ['%s=%r' % (k, v)
+                                        for k, v in kwargs.items()]))
+
+
+_METHOD_TYPES = (types.BuiltinFunctionType, types.BuiltinMethodType,
+                 types.FunctionType, types.LambdaType, types.MethodType)
+
+
+def _logged_method(name, method):
+  """Wraps a bound method so that its calls and return values are logged."""
+  def logged(*args, **kwargs):
+    log = qj.LOG and not _logger_disabled()
+    if log:
+      _log_at_frame(sys._getframe(1), 'calling %s' % name,
+                    _format_call(name, args, kwargs))
+    result = method(*args, **kwargs)
+    if log:
+      _log_at_frame(sys._getframe(1), 'returning from %s' % name,
+                    qj.STR_FN(result))
+    return result
+  logged.__name__ = name
+  logged.__doc__ = getattr(method, '__doc__', None)
+  return logged
 
-    stack_entry = _StackEntry(
-        _stack_effect(opname, oparg),
-        curr_i,
-        curr_l,
-        opname,
-        oparg,
-        oparg_repr if isinstance(oparg_repr, list) else [str(oparg_repr)],
-        [],  # children
-    )
 
-    instr_to_ops[curr_i] = stack_entry
+class _CallLogger(object):
+  """Proxy that logs calls to the public methods of the object it wraps.
 
-  stack = [instr_to_ops[curr_i] for curr_i in sorted(instr_to_ops.keys())]
-  qj._DEBUG_QJ and [qj.LOG_FN('se: %s' % str(se)) for se in stack] and qj.LOG_FN('\n\n')
+  Methods are looked up and wrapped lazily, on attribute access, so wrapping an
+  object costs the same regardless of its type or how many methods it has.
+  Special methods (operators, len, iteration, etc.) are forwarded without
+  logging, and `__class__` reports the wrapped type, so isinstance checks still
+  pass.
+  """
 
-  return stack
+  __slots__ = ('_qj_target',)
+
+  def __init__(self, target):
+    object.__setattr__(self, '_qj_target', target)
+
+  @property
+  def __class__(self):
+    return type(self._qj_target)
+
+  def __getattr__(self, name):
+    attr = getattr(self._qj_target, name)
+    if name.startswith('_') or not isinstance(attr, _METHOD_TYPES):
+      return attr
+    return _logged_method(name, attr)
+
+  def __setattr__(self, name, value):
+    setattr(self._qj_target, name, value)
+
+  def __delattr__(self, name):
+    delattr(self._qj_target, name)
+
+  def __dir__(self):
+    return dir(self._qj_target)
+
+
+# Special methods are looked up on the type, bypassing __getattr__, so the proxy
+# type for each wrapped type forwards the ones that type defines.
+_FORWARDED_SPECIAL_METHODS = frozenset(
+    '__%s__' % name for name in (
+        'abs add aiter and anext await bool bytes call complex contains '
+        'delitem divmod enter eq exit float floordiv format ge getitem gt hash '
+        'iadd iand ifloordiv ilshift imatmul imod imul index int invert ior '
+        'ipow irshift isub iter itruediv ixor le len length_hint lshift lt '
+        'matmul missing mod mul ne neg next or pos pow radd rand rdivmod repr '
+        'reversed rfloordiv rlshift rmatmul rmod rmul ror round rpow rrshift '
+        'rshift rsub rtruediv rxor setitem str sub truediv xor fspath'
+    ).split())
+
+
+def _forward_special_method(name):
+  def forward(self, *args, **kwargs):
+    target = object.__getattribute__(self, '_qj_target')
+    result = getattr(target, name)(*args, **kwargs)
+    # Keep the proxy in place for in-place operators and self-iterators.
+    return self if result is target else result
+  forward.__name__ = name
+  return forward
+
+
+def _call_logger_type(cls):
+  """Returns the (cached) _CallLogger subclass used to wrap instances of cls."""
+  logger_type = qj._call_logger_types.get(cls)
+  if logger_type is None:
+    members = {'__slots__': ()}
+    for name in _FORWARDED_SPECIAL_METHODS:
+      if hasattr(cls, name):
+        members[name] = _forward_special_method(name)
+    if getattr(cls, '__hash__', None) is None:
+      members['__hash__'] = None
+    logger_type = type('qj_logged_%s' % cls.__name__, (_CallLogger,), members)
+    qj._call_logger_types[cls] = logger_type
+  return logger_type
+
+
+_FINGERPRINT_REPR = reprlib.Repr()
+_FINGERPRINT_REPR.maxlevel = 4
+_FINGERPRINT_REPR.maxtuple = _FINGERPRINT_REPR.maxlist = 100
+_FINGERPRINT_REPR.maxarray = _FINGERPRINT_REPR.maxdict = 100
+_FINGERPRINT_REPR.maxset = _FINGERPRINT_REPR.maxfrozenset = 100
+_FINGERPRINT_REPR.maxdeque = 100
+_FINGERPRINT_REPR.maxstring = _FINGERPRINT_REPR.maxother = 1000
+
+
+def _fingerprint(x):
+  """Cheap, bounded-size stand-in for x used to detect repeated values.
+
+  Bytes, arrays and other buffers are compared by a digest of their contents,
+  other hashable values by type, hash and a size-limited repr (unless they hash
+  by identity), and everything else by a size-limited repr. No reference to x
+  is kept.
+  """
+  x_type = type(x)
+  if (isinstance(x, (bytes, bytearray, memoryview))
+      or hasattr(x, '__array_interface__')):
+    try:
+      import hashlib  # pylint: disable=g-import-not-at-top
+      view = memoryview(x)
+      if not view.contiguous:
+        view = memoryview(view.tobytes())
+      # Python 2 memoryviews can't be cast.
+      data = view.cast('B') if hasattr(view, 'cast') else view.tobytes()
+      return (x_type, view.format, view.shape, hashlib.sha1(data).digest())
+    except (TypeError, ValueError, AttributeError):
+      pass
+  if x_type.__hash__ is not None and x_type.__hash__ is not object.__hash__:
+    try:
+      return (x_type, hash(x), _FINGERPRINT_REPR.repr(x))
+    except TypeError:
+      pass  # E.g., tuples of lists.
+  return (x_type, _FINGERPRINT_REPR.repr(x))
 
 
-def _find_current_fn_call(co, lasti):
-  """Find current function call in the byte code."""
-  qj._DEBUG_QJ and qj.LOG_FN('co = {}'.format(co))
+# Arrays are snapshotted as digests of chunks of this many elements, unless they
+# have at most _DIFF_EXACT_SIZE elements, in which case they are copied so that
+# diffs can count the changed elements exactly.
+_DIFF_CHUNK_SIZE = 4096
+_DIFF_EXACT_SIZE = 1 << 16
 
-  if sys.version_info[0] < 3:
-    stack = _build_instruction_stack(co, lasti)
-  else:
-    stack = _build_instruction_stack3(co, lasti)
 
-  source_lines, source_offset = inspect.getsourcelines(co)
-  source_lines = [l.strip() for l in source_lines]
+def _array_digests(x):
+  """Returns digests of consecutive _DIFF_CHUNK_SIZE element chunks of x."""
+  import hashlib  # pylint: disable=g-import-not-at-top
+  flat = x.reshape(-1) if x.flags.c_contiguous else x.flat
+  return [hashlib.sha1(flat[i:i + _DIFF_CHUNK_SIZE].tobytes()).digest()
+          for i in range(0, x.size, _DIFF_CHUNK_SIZE)]
 
-  # Apply stack effects backwards until we arrive at the stack entries for a complete function call
-  fn_stack = _collect_pops(stack[:-1], stack[-1].stack_depth, [], 0)
 
-  if not fn_stack and stack[-1].stack_depth == 0:
-    # The function call took 0 arguments, so return early with a special string.
-    return '<empty log>'
+def _diff_snapshot(x):
+  """Returns a (kind, state) snapshot of x to compare the next value against.
 
-  qj._DEBUG_QJ and qj.LOG_FN('collected fn_stack:\n%s\n\n' % '\n'.join(str(se) for se in fn_stack))
+  Container snapshots hold fingerprints of the items rather than the items, and
+  large array snapshots hold digests of chunks of the array.
+  """
+  np = sys.modules.get('numpy')
+  if np is not None and isinstance(x, np.ndarray):
+    if x.size <= _DIFF_EXACT_SIZE:
+      return 'ndarray', (x.shape, x.dtype, x.copy(), None)
+    return 'ndarray', (x.shape, x.dtype, None, _array_digests(x))
+  if isinstance(x, dict):
+    return 'dict', {k: _fingerprint(v) for k, v in x.items()}
+  if isinstance(x, (list, tuple)):
+    return 'sequence', [_fingerprint(v) for v in x]
+  if isinstance(x, (set, frozenset)):
+    return 'set', {_fingerprint(v): reprlib.repr(v) for v in x}
+  return 'value', _fingerprint(x)
+
+
+def _diff_items(keys, x):
+  return '{%s}' % ', '.join('%s: %s' % (reprlib.repr(k), reprlib.repr(x[k]))
+                            for k in keys)
+
+
+def _diff_log(before, after, x):
+  """Describes the change from snapshot `before` to snapshot `after` of x."""
+  kind, new = after
+  if before is None or before[0] != kind:
+    if kind == 'ndarray':
+      return '%s %s (first snapshot)' % (new[0], new[1])
+    if kind != 'value':
+      return '%s with %d items (first snapshot)' % (type(x).__name__, len(new))
+    return qj.STR_FN(x)
+  old = before[1]
+
+  if kind == 'value':
+    return 'no changes' if old == new else qj.STR_FN(x)
+
+  parts = []
+  if kind == 'dict':
+    added = [k for k in new if k not in old]
+    removed = [k for k in old if k not in new]
+    changed = [k for k in new if k in old and old[k] != new[k]]
+    if added:
+      parts.append('added %s' % _diff_items(added, x))
+    if removed:
+      parts.append('removed [%s]' % ', '.join(reprlib.repr(k) for k in removed))
+    if changed:
+      parts.append('changed %s' % _diff_items(changed, x))
+
+  elif kind == 'set':
+    added = [new[f] for f in new if f not in old]
+    removed = [old[f] for f in old if f not in new]
+    if added:
+      parts.append('added {%s}' % ', '.join(added))
+    if removed:
+      parts.append('removed {%s}' % ', '.join(removed))
+
+  elif kind == 'sequence':
+    ranges = []
+    for i in range(min(len(old), len(new))):
+      if old[i] != new[i]:
+        if ranges and ranges[-1][1] == i:
+          ranges[-1][1] = i + 1
+        else:
+          ranges.append([i, i + 1])
+    if len(new) > len(old):
+      if ranges and ranges[-1][1] == len(old):
+        ranges[-1][1] = len(new)
+      else:
+        ranges.append([len(old), len(new)])
+    parts.extend('[%d:%d] = %s' % (a, b, reprlib.repr(list(x[a:b])))
+                 for a, b in ranges)
+    if len(new) < len(old):
+      parts.append('[%d:%d] removed' % (len(new), len(old)))
+    if len(new) != len(old):
+      parts.insert(0, 'len %d -> %d' % (len(old), len(new)))
+
+  elif kind == 'ndarray':
+    old_shape, old_dtype, old_values, old_digests = old
+    shape, dtype, values, digests = new
+    if old_shape != shape or old_dtype != dtype:
+      return '%s %s -> %s %s' % (old_shape, old_dtype, shape, dtype)
+    np = sys.modules['numpy']
+    if values is None:
+      chunks = [i for i, (a, b) in enumerate(zip(old_digests, digests)) if a != b]
+      if chunks:
+        ranges = []
+        for i in chunks:
+          if ranges and ranges[-1][1] == i * _DIFF_CHUNK_SIZE:
+            ranges[-1][1] = min((i + 1) * _DIFF_CHUNK_SIZE, x.size)
+          else:
+            ranges.append([i * _DIFF_CHUNK_SIZE,
+                           min((i + 1) * _DIFF_CHUNK_SIZE, x.size)])
+        shown = ', '.join('[%d:%d]' % (a, b) for a, b in ranges[:3])
+        parts.append('%d of %d chunks of %d elements changed in flat indices %s%s'
+                     % (len(chunks), len(digests), _DIFF_CHUNK_SIZE, shown,
+                        ', ...' if len(ranges) > 3 else ''))
+      return ', '.join(parts) or 'no changes'
+    changed = old_values != values
+    if dtype.kind in 'fc':
+      changed &= ~(np.isnan(old_values) & np.isnan(values))
+    indices = np.flatnonzero(changed)
+    if len(indices):
+      parts.append('%d of %d elements changed in flat indices [%d:%d]' % (
+          len(indices), values.size, indices[0], indices[-1] + 1))
+      if dtype.kind in 'iuf':
+        delta = np.abs(values.ravel()[indices].astype(float)
+                       - old_values.ravel()[indices].astype(float))
+        delta = delta[np.isfinite(delta)]
+        if delta.size:
+          parts.append('max abs change %r' % delta.max().item())
+
+  return ', '.join(parts) or 'no changes'
+
+
+class _RateMeter(object):
+  """Counts events over the last minute in a ring of one-second buckets.
+
+  Recording an event is constant time, and memory is fixed regardless of the
+  event rate.
+  """
 
-  # Prepare to annotate the stack with extra symbols, and filter out MAKE_FUNCTION and MAKE_CLOSURE calls, which are no longer needed.
-  annotate_stack = [se for se in fn_stack if not se.opname.startswith('MAKE_')]
-  annotate_stack.reverse()
-  _annotate_fn_args(annotate_stack, stack[-1].opname, stack[-1].oparg, -1, False)
+  _WINDOWS = (1, 10, 60)
+  _BUCKETS = 64  # Must be more than the largest window.
+
+  def __init__(self, now):
+    self.buckets = [0] * self._BUCKETS
+    self.second = int(now)
+    self.start = now
+    self.last_report = now
+    self.total = 0
+
+  def add(self, now):
+    second = int(now)
+    if second != self.second:
+      for s in range(max(self.second + 1, second - self._BUCKETS + 1), second + 1):
+        self.buckets[s % self._BUCKETS] = 0
+      self.second = second
+    self.buckets[second % self._BUCKETS] += 1
+    self.total += 1
+
+  def report(self, now):
+    # Each window covers its full length in seconds, plus however much of the
+    # current second has passed, unless the meter is younger than that.
+    rates = []
+    for window in self._WINDOWS:
+      count = sum(self.buckets[(self.second - i) % self._BUCKETS]
+                  for i in range(window + 1))
+      span = min(window + now - self.second, now - self.start)
+      rates.append('%.1f/sec over %ds' % (count / span if span > 0 else 0.0,
+                                          window))
+    return '%s (%d events)' % (', '.join(rates), self.total)
+
+
+class _RunningStats(object):
+  """Fixed-memory count, min, max, mean and variance (Welford's algorithm)."""
+
+  def __init__(self):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.min = None
+    self.max = None
+
+  def add(self, value):
+    self.count += 1
+    delta = value - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (value - self.mean)
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
 
-  qj._DEBUG_QJ and qj.LOG_FN('annotated fn_stack:\n%s\n\n' % '\n'.join(str(se) for se in fn_stack))
+  def __str__(self):
+    if not self.count:
+      return 'no numeric values'
+    return '(%r, (%r, %r), %r)' % (self.min, self.mean,
+                                   (self.m2 / self.count) ** 0.5, self.max)
 
-  # Find the range of lines to search over.
-  min_l = stack[-1].curr_l
-  max_l = stack[0].curr_l
-  for se in fn_stack:
-    min_l = min(min_l, se.curr_l)
-    max_l = max(max_l, se.curr_l)
 
-  qj._DEBUG_QJ and qj.LOG_FN('source lines range: %d -> %d (indices: %d, %d)' % (min_l, max_l, min_l - source_offset, max_l - source_offset + 1))
-  source_chunk = ' '.join(
-      [l for l in source_lines[min_l - source_offset:max_l - source_offset + 1] if l and not l.startswith('#')])
+class _Aggregate(_RunningStats):
+  """Running stats plus a histogram with one bucket per power of two."""
 
-  qj._DEBUG_QJ and qj.LOG_FN('source_chunk: %r' % source_chunk)
+  def __init__(self, now):  # pylint: disable=super-init-not-called
+    self.reset(now)
 
-  # Build up all of the tokens for the function call.
-  tokens = []
-  for se in fn_stack:
-    opname = se.opname
-    for oparg_repr in se.oparg_repr[::-1]:
-      # Clean up the tokens
-      if not oparg_repr:
-        continue
-      oparg_repr = re.escape(oparg_repr.replace('\n', '\\n'))
-      tokens.append(oparg_repr)
-
-  tokens.reverse()
-  qj._DEBUG_QJ and qj.LOG_FN('extracted tokens: {}'.format(tokens))
-  if qj._DEBUG_QJ:
-    assert tokens
-
-  # Add tokens for the function call we're extracting.
-  tokens = ['\\('] + tokens + ['\\)']
-
-  reg = r'[\b]*?.*?[\b]*?'.join(tokens)
-  qj._DEBUG_QJ and qj.LOG_FN(reg)
-
-  # Search for the function call using the full set of tokens.
-  # Expand the search with source lines after the current set if we don't find a match.
-  shortest_match = None
-  match_attempts = 0
-  max_match_attempts = 10
-  while not shortest_match and match_attempts < max_match_attempts:
-    (shortest_match, _, _) = (
-        _find_earliest_shortest_match(source_chunk, reg, 0, len(source_chunk), num_attempts=10))
-    if not shortest_match:
-      match_attempts += 1
-
-      min_l -= 1
-      prev_line = ''
-      while not prev_line and min_l - source_offset >= 0 and min_l - source_offset < len(source_lines):
-        prev_line = source_lines[min_l - source_offset]
-        if prev_line.startswith('#'):
-          prev_line = ''
-        if not prev_line:
-          min_l -= 1
-      prev_line += ' ' if prev_line else ''
-      source_chunk = prev_line + source_chunk
-
-      max_l += 1
-      next_line = ''
-      while not next_line and max_l - source_offset >= 0 and max_l - source_offset < len(source_lines):
-        next_line = source_lines[max_l - source_offset]
-        if next_line.startswith('#'):
-          next_line = ''
-        if not next_line:
-          max_l += 1
-      next_line = (' ' if next_line else '') + next_line
-      source_chunk += next_line
-
-  # Return the string for the function call
-  if qj._DEBUG_QJ:
-    assert shortest_match
-  if shortest_match is not None:
-    match = shortest_match.group(0)
-    if qj._DEBUG_QJ:
-      assert match.startswith('(') and match.endswith(')')
-    # Do some parentheses cleanup.
-    if match.startswith('('):
-      match = match[1:]
-    lparens = match.count('(')
-    rparens = match.count(')')
-    if lparens > rparens:
-      match += ')' * (lparens - rparens)
-    elif lparens < rparens:
-      rparens_to_remove = rparens - lparens
-      while len(match) and match[-1] == ')' and rparens_to_remove > 0:
-        match = match[:-1]
-        rparens_to_remove -= 1
-    match = match.strip()
-    return match
-  else:
-    return ''
+  def reset(self, now):
+    _RunningStats.__init__(self)
+    self.start = now
+    self.values = 0
+    self.non_finite = 0
+    self.non_numeric = 0
+    self.hist = {}
 
-qj._DISASSEMBLE_FN = _disassemble if sys.version_info[0] < 3 else _disassemble3
+  def add(self, value):
+    self.values += 1
+    try:
+      value = float(value)
+    except (TypeError, ValueError):
+      self.non_numeric += 1
+      return
+    if value - value != 0.0:
+      self.non_finite += 1
+      return
+    super(_Aggregate, self).add(value)
+    # Buckets are keyed by sign and binary exponent, so there are only ever a
+    # few thousand possible keys.
+    key = (value > 0) - (value < 0), math.frexp(value)[1] if value else 0
+    self.hist[key] = self.hist.get(key, 0) + 1
+
+  @staticmethod
+  def _bucket_name(key):
+    sign, exponent = key
+    if not sign:
+      return '0'
+    lo, hi = 2.0 ** (exponent - 1), 2.0 ** exponent
+    if sign > 0:
+      return '[%g, %g)' % (lo, hi)
+    return '(%g, %g]' % (-hi, -lo)
+
+  def report(self):
+    hist = ', '.join(
+        '%s: %d' % (self._bucket_name(key), self.hist[key])
+        for key in sorted(self.hist, key=lambda k: (k[0], k[0] * k[1])))
+    log = '%d values, (min (mean std) max): %s, hist: {%s}' % (
+        self.values, super(_Aggregate, self).__str__(), hist)
+    if self.non_finite:
+      log += ', %d nan/inf' % self.non_finite
+    if self.non_numeric:
+      log += ', %d non-numeric' % self.non_numeric
+    return log
+
+
+class _LoggedIterator(object):
+  """Iterator that logs the items of another iterator as they are consumed.
+
+  Nothing is read ahead or stored, so wrapping a stream doesn't change when (or
+  whether) its items are computed. Logs are reported from the code consuming
+  the iterator.
+  """
+
+  def __init__(self, iterable, label, log_first, stats):
+    self._iterable = iterable
+    self._it = iter(iterable)
+    self._label = label
+    self._log_first = log_first
+    self._next_progress = max(1, log_first) * 2
+    self._stats = _RunningStats() if stats else None
+    self._count = 0
+    self._start = None
+    self._done = False
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self._start is None:
+      self._start = _time.time()
+    try:
+      item = next(self._it)
+    except StopIteration:
+      self._finish('exhausted')
+      raise
+    self._count += 1
+    if self._stats is not None:
+      try:
+        self._stats.add(float(item))
+      except (TypeError, ValueError):
+        pass
+    if self._count <= self._log_first:
+      qj(x=item, s='%s item %d (%s)' % (self._label, self._count, self._rate()),
+         _depth=2)
+    elif self._count == self._next_progress:
+      self._next_progress *= 2
+      qj(x=self._summary(), s='%s progress' % self._label, _depth=2)
+    return item
+
+  next = __next__  # Python 2
+
+  def close(self):
+    """Close the wrapped iterator, if it can be closed, and log the summary."""
+    if hasattr(self._it, 'close'):
+      self._it.close()
+    self._finish('closed')
+
+  def _rate(self):
+    elapsed = _time.time() - (self._start or _time.time())
+    return '%.1f items/sec' % (self._count / elapsed if elapsed > 0 else 0.0)
+
+  def _summary(self):
+    summary = '%d items, %s' % (self._count, self._rate())
+    if self._stats is not None:
+      summary += ', (min (mean std) max): %s' % self._stats
+    return summary
+
+  def _finish(self, how):
+    if self._done:
+      return
+    self._done = True
+    qj(x=self._summary(), s='%s %s' % (self._label, how), _depth=3)
 
-###############################################################################
-# End Code Correlation Code
-###############################################################################
 
 # pylint: enable=g-long-lambda, protected-access, expression-not-assigned
 # pylint: enable=line-too-long
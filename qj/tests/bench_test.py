@@ -0,0 +1,51 @@
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+from qj import qj
+from qj import bench
+
+
+class BenchTest(unittest.TestCase):
+
+  def test_run_benchmarks(self):
+    log_fn = qj.LOG_FN
+    report = bench.run_benchmarks('disabled|warm_log_with_s', repeat=1, min_time=0.0)
+    self.assertEqual(set(report['results']),
+                     {'disabled_global', 'disabled_b', 'warm_log_with_s'})
+    for result in report['results'].values():
+      self.assertGreater(result['ns_per_call_min'], 0)
+      self.assertLessEqual(result['ns_per_call_min'], result['ns_per_call_median'])
+    self.assertIs(qj.LOG_FN, log_fn)
+
+  def test_compare_flags_regressions(self):
+    baseline = {'results': {'a': {'ns_per_call_min': 100.0},
+                            'b': {'ns_per_call_min': 100.0},
+                            'c': {'skipped': 'requires numpy'}}}
+    current = {'results': {'a': {'ns_per_call_min': 110.0},
+                           'b': {'ns_per_call_min': 200.0},
+                           'c': {'ns_per_call_min': 1.0},
+                           'd': {'ns_per_call_min': 1.0}}}
+    rows = bench.compare(baseline, current, threshold=0.25)
+    self.assertEqual([(r[0], r[-1]) for r in rows], [('a', False), ('b', True)])
+
+
+if __name__ == '__main__':
+  unittest.main()
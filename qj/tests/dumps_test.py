@@ -0,0 +1,84 @@
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from qj import dumps
+
+
+def _raise_in(depth, payload):
+  if depth:
+    return _raise_in(depth - 1, payload)
+  local_value = 'x' * 1000
+  raise KeyError(local_value[:3])
+
+
+class DumpsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dump_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dump_dir)
+
+  def _write(self, depth=0):
+    try:
+      _raise_in(depth, payload=list(range(10000)))
+    except KeyError as e:
+      return dumps.write(e, self.dump_dir, 'test')
+
+  def test_capture_is_bounded(self):
+    record = dumps.load(self._write(depth=100))
+    self.assertEqual(record['exception'], 'KeyError')
+    self.assertEqual(record['message'], "'xxx'")
+    self.assertEqual(len(record['frames']), dumps._MAX_FRAMES)
+    self.assertGreater(record['omitted_frames'], 0)
+    frame = record['frames'][-1]
+    self.assertEqual(frame['function'], '_raise_in')
+    self.assertEqual(frame['args']['depth'], '0')
+    self.assertLess(len(frame['args']['payload']), 100)
+    self.assertLess(len(frame['locals']['local_value']), 300)
+
+  def test_main_lists_and_shows_dumps(self):
+    path = self._write()
+    with mock.patch('sys.stdout') as stdout:
+      self.assertEqual(dumps.main([self.dump_dir]), 0)
+    listing = ''.join(c[0][0] for c in stdout.write.call_args_list)
+    self.assertIn(os.path.basename(path), listing)
+    self.assertIn("KeyError: 'xxx'  (test)", listing)
+
+    with mock.patch('sys.stdout') as stdout:
+      self.assertEqual(dumps.main([path]), 0)
+    shown = ''.join(c[0][0] for c in stdout.write.call_args_list)
+    self.assertIn('in _raise_in', shown)
+    self.assertIn("local local_value = 'xxxx", shown)
+    self.assertIn('arg depth = 0', shown)
+
+  def test_main_without_dumps(self):
+    with mock.patch('sys.stdout'):
+      self.assertEqual(dumps.main([self.dump_dir]), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
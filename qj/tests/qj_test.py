@@ -17,17 +17,36 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
+import gc
+import inspect
+import json
 import logging
+import mmap
+import os
 import pprint
 import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import types
+import weakref
 
 import unittest
 import mock
 
+try:
+  import numpy as np  # pylint: disable=g-import-not-at-top
+except ImportError:
+  np = None
+
 from qj import qj
 from qj.tests import qj_test_helper
 
+qj_module = sys.modules[qj.__module__]
+
 DEBUG_TESTS = False
 
 
@@ -59,6 +78,13 @@ class QjTest(unittest.TestCase):
     qj.PREFIX = 'qj: '
     qj.COLOR = False
     qj._DEBUG_QJ = False
+    qj.MONITORING = False
+    qj.BACKGROUND_LABELS = False
+    qj.DUMP_DIR = None
+    qj.DUMP_RERAISE = True
+    qj.NOTEBOOK_CAPTURE = None
+    qj.NOTEBOOK_FLUSH_SECONDS = 0.1
+    qj.AGG_SECONDS = 10.0
 
   def test_logs(self):
     with mock.patch('logging.info') as mock_log_fn:
@@ -67,6 +93,299 @@ class QjTest(unittest.TestCase):
       mock_log_fn.assert_called_once_with(RegExp(
           r"qj: <qj_test> test_logs: 'some log' <\d+>: some log"))
 
+  def test_logs_constant_tuple_source(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      qj([3, 1, 2])
+      mock_log_fn.assert_called_once_with(RegExp(
+          r'qj: <qj_test> test_logs_constant_tuple_source: \[3, 1, 2\] <\d+>: \[3, 1, 2\]$'))
+
+  def test_opcode_tables_cover_interpreter(self):
+    from qj import labels  # pylint: disable=g-import-not-at-top
+    for name, op in labels.dis.opmap.items():
+      effect = labels._STACK_EFFECTS[op]
+      self.assertTrue(isinstance(effect, int) or callable(effect), name)
+    self.assertEqual(labels._STACK_EFFECTS[labels.dis.opmap['LOAD_FAST']], 1)
+    self.assertEqual(labels._ZERO_ARG_TOKENS[labels.dis.opmap['BUILD_LIST']], '[')
+    self.assertEqual(labels._ARG_TOKENS[labels.dis.opmap['BUILD_LIST']], ']')
+
+  def test_labels_are_extracted_once_per_site(self):
+    from qj import labels  # pylint: disable=g-import-not-at-top
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      with mock.patch.object(labels, '_find_current_fn_call',
+                             wraps=labels._find_current_fn_call) as mock_find:
+        for i in range(3):
+          qj(i + 1)
+        self.assertEqual(mock_find.call_count, 1)
+      mock_log_fn.assert_called_with(RegExp(
+          r'qj: <qj_test> test_labels_are_extracted_once_per_site: i \+ 1 <\d+>: 3'))
+
+  def test_source_index_is_shared_until_the_file_changes(self):
+    from qj import labels  # pylint: disable=g-import-not-at-top
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'module.py')
+      with open(path, 'w') as f:
+        f.write('x = 1\n\n  # comment\ny = (x,\n     2)\n')
+      index = labels._source_index(path)
+      self.assertIs(labels._source_index(path), index)
+      self.assertEqual(index.code_lines, [1, 4, 5])
+      self.assertEqual(index.chunk(1, 2), 'y = (x, 2)')
+      self.assertEqual(index.chunk(2, 1), '')
+
+      with open(path, 'w') as f:
+        f.write('z = 3\n')
+      os.utime(path, (0, 0))
+      changed = labels._source_index(path)
+      self.assertIsNot(changed, index)
+      self.assertEqual(changed.chunk(0, 0), 'z = 3')
+    finally:
+      shutil.rmtree(directory)
+
+  def test_logs_with_background_labels(self):
+    qj.BACKGROUND_LABELS = True
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      for i in range(2):
+        qj(i * 2)
+        if qj._label_queue:
+          qj._label_queue.join()
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(
+              r'qj: <qj_test> test_logs_with_background_labels: qj_test\.py:\d+ <\d+>: 0')),
+          mock.call(RegExp(
+              r'qj: <qj_test> test_logs_with_background_labels: i \* 2 <\d+>: 2')),
+      ])
+      self.assertEqual(qj._label_thread.name, 'qj-labels')
+
+  def test_label_search_stays_in_function(self):
+    l = [1, 2]
+    x = 3
+
+    def g():
+      return qj(x in l)
+
+    def k():
+      return qj(
+          x in l
+      )
+
+    def h(y):  # pylint: disable=unused-variable
+      return y[0] + len(y)
+
+    from qj import labels  # pylint: disable=g-import-not-at-top
+    for fn in (g, k):
+      # Searches end at the last line of the function, including the closing
+      # line of a multiline call, and don't run on into h.
+      lines, first = inspect.getsourcelines(fn)
+      index = labels._source_index(fn.__code__.co_filename)
+      self.assertEqual(labels._last_line(fn.__code__, index), first + len(lines) - 1)
+
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      g()
+      k()
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> g: x in l <\d+>: False$')),
+          mock.call(RegExp(r'qj: <qj_test> k: x in l <\d+>: False$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 2)
+
+  def test_logs_type_when_label_extraction_fails(self):
+    from qj import labels  # pylint: disable=g-import-not-at-top
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      with mock.patch.object(labels, '_find_current_fn_call',
+                             side_effect=IndexError) as mock_find:
+        for i in range(3):
+          self.assertEqual(qj(i), i)
+        # The failure is cached, so extraction isn't retried on every log.
+        self.assertEqual(mock_find.call_count, 1)
+      mock_log_fn.assert_called_with(RegExp(
+          r"qj: <qj_test> test_logs_type_when_label_extraction_fails: <(class|type) 'int'> <\d+>: 2"))
+      self.assertEqual(mock_log_fn.call_count, 3)
+
+  def test_site_logger_logs_and_returns_arg(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      log = qj.at('batch loss')
+      with mock.patch('sys._getframe') as mock_getframe:
+        outs = [log(loss) for loss in (0.5, 0.25)]
+        log('not logged', b=0)
+        mock_getframe.assert_not_called()
+      self.assertEqual(outs, [0.5, 0.25])
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(
+              r'qj: <qj_test> test_site_logger_logs_and_returns_arg: batch loss <\d+>: 0.5$')),
+          mock.call(RegExp(
+              r'qj: <qj_test> test_site_logger_logs_and_returns_arg: batch loss <\d+>: 0.25$')),
+      ])
+      self.assertEqual(mock_log_fn.call_count, 2)
+      self.assertIs(qj.site, qj.at)
+
+  def test_site_logger_limits_logs(self):
+    qj.MAX_FRAME_LOGS = 2
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      log = qj.at('x')
+      for i in range(4):
+        log(i)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_site_logger_limits_logs: x <\d+>: 0')),
+          mock.call(RegExp(r'qj: <qj_test> test_site_logger_limits_logs: x <\d+>: 1')),
+          mock.call(RegExp(r'Maximum per-site logging hit \(2\)')),
+      ])
+      self.assertEqual(mock_log_fn.call_count, 3)
+
+      log.reset()
+      log('again\nand again')
+      mock_log_fn.assert_called_with(RegExp(
+          r'x <\d+>: \(multiline log follows\)\nagain\nand again'))
+
+  def test_site_loggers_share_frame_limit(self):
+    qj.MAX_FRAME_LOGS = 2
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      other = qj.at('y')
+      for i in range(3):
+        log = qj.at('x')
+        log(i)
+        log(i)
+        other(i)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'test_site_loggers_share_frame_limit: x <\d+>: 0$')),
+          mock.call(RegExp(r'test_site_loggers_share_frame_limit: x <\d+>: 0$')),
+          mock.call(RegExp(r'Maximum per-site logging hit \(2\)')),
+          mock.call(RegExp(r'test_site_loggers_share_frame_limit: y <\d+>: 0$')),
+          mock.call(RegExp(r'test_site_loggers_share_frame_limit: y <\d+>: 1$')),
+          mock.call(RegExp(r'Maximum per-site logging hit \(2\)')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 6)
+
+      log.reset()
+      log(3)
+      mock_log_fn.assert_called_with(RegExp(r'x <\d+>: 3$'))
+
+  def test_site_format_follows_settings(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      for prefix, color in (('qj: ', False), ('QJ: ', False), ('QJ: ', True)):
+        qj.PREFIX = prefix
+        qj.COLOR = color
+        qj(1, 'one')
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'^qj: <qj_test> test_site_format_follows_settings: one <\d+>: 1$')),
+          mock.call(RegExp(r'^QJ: <qj_test> test_site_format_follows_settings: one <\d+>: 1$')),
+          mock.call(RegExp(r'^QJ: <qj_test> test_site_format_follows_settings: one <\d+>: \033\[92m1$')),
+      ])
+    self.assertEqual(qj._COLOR_FN('a', 1), '\033[91ma 1\033[0m')
+    qj.COLOR = False
+    self.assertEqual(qj._COLOR_FN('a'), 'a')
+
+  def test_logger_level_disables_logging_early(self):
+    qj.LOG_FN = qj_module._log
+    logger = logging.getLogger('qj')
+    try:
+      with mock.patch.object(logger, 'info') as mock_info:
+        logger.setLevel(logging.WARNING)
+        log = qj.at('one')
+        with mock.patch('sys._getframe') as mock_getframe:
+          self.assertEqual(qj(1), 1)
+          self.assertEqual(log(1), 1)
+          self.assertEqual(qj.batch([1]), [1])
+          mock_getframe.assert_not_called()
+        mock_info.assert_not_called()
+
+        logger.setLevel(logging.INFO)
+        qj(1, 'one')
+        mock_info.assert_called_once_with(RegExp(
+            r'qj: <qj_test> test_logger_level_disables_logging_early: one <\d+>: 1'))
+    finally:
+      logger.setLevel(logging.NOTSET)
+
+  def test_logger_level_disables_call_logging_early(self):
+    qj.LOG_FN = qj_module._log
+    logger = logging.getLogger('qj')
+
+    class Box(object):
+
+      def get(self, v):
+        return v
+
+    box = qj(Box(), 'box', log_all_calls=1)
+    originals = qj.instrument(Box, log_calls=1)
+    try:
+      with mock.patch.object(logger, 'info') as mock_info:
+        logger.setLevel(logging.WARNING)
+        with mock.patch.object(qj_module, '_log_at_frame') as mock_log_at_frame, \
+             mock.patch.object(qj_module, '_format_call') as mock_format_call:
+          self.assertEqual(box.get(1), 1)
+          self.assertEqual(Box().get(2), 2)
+          mock_log_at_frame.assert_not_called()
+          mock_format_call.assert_not_called()
+        mock_info.assert_not_called()
+    finally:
+      logger.setLevel(logging.NOTSET)
+      qj.uninstrument(Box)
+    self.assertTrue(originals)
+
+  def test_batch_logs_once(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      losses = [0.5, 0.25, 'nan?', 1.0]
+      out = qj.batch(losses, limit=2, n=1)
+      self.assertIs(out, losses)
+      mock_log_fn.assert_called_once_with(
+          RegExp(r'qj: <qj_test> test_batch_logs_once: losses, limit=2, n=1 <\d+>: '
+                 r'\(multiline log follows\)\n'
+                 r'4 values, showing the first 2, \(min \(mean std\) max\): '
+                 r'\(0\.25, \(0\.58\d*, 0\.31\d*\), 1\.0\)\n'
+                 r'  \[0\] 0\.5\n'
+                 r'  \[1\] 0\.25$'))
+
+  def test_batch_consumes_iterators(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      out = qj.batch((i * 2 for i in range(3)), 'doubles')
+      self.assertEqual(out, [0, 2, 4])
+      mock_log_fn.assert_called_once_with(
+          RegExp(r'doubles <\d+>: \(multiline log follows\)\n3 values\n'
+                 r'  \[0\] 0\n  \[1\] 2\n  \[2\] 4$'))
+
+      self.assertEqual(qj.batch(iter([1]), b=0), [1])
+      qj.LOG = False
+      self.assertEqual(qj.batch(iter([1])), [1])
+      self.assertEqual(mock_log_fn.call_count, 1)
+
+  @unittest.skipIf(np is None, 'requires numpy')
+  def test_site_logger_numeric_summary(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      qj.at('arr', n=1)(np.arange(4.0))
+      mock_log_fn.assert_called_once_with(RegExp(
+          r'qj: <qj_test> test_site_logger_numeric_summary: arr \(shape.*\) <\d+>: '))
+
+  def test_token_matcher_matches_lazy_regex(self):
+    from qj import labels  # pylint: disable=g-import-not-at-top
+    target = 'f(a, (b)) + qj(g(a), b=(c)) + (a, b)'
+    for tokens in (['(', 'a', ')'], ['(', 'g', '(', 'a', ')', 'b', '=', 'c', ')'],
+                   ['(', 'b', ')', ')'], ['(', 'd', ')']):
+      match = re.search('.*?'.join(re.escape(t) for t in tokens), target)
+      self.assertEqual(labels._match_tokens(target, tokens, 0, len(target)),
+                       match and match.span())
+    self.assertEqual(labels._find_earliest_shortest_match(target, ['(', 'b', ')']),
+                     (5, 8))
+
+  def test_token_matcher_is_linear(self):
+    from qj import labels  # pylint: disable=g-import-not-at-top
+    # The equivalent regex backtracks for a very long time on this.
+    target = '(' * 20000 + 'x' * 20000
+    tokens = ['('] + ['x'] * 20 + ['y', ')']
+    self.assertIsNone(labels._find_earliest_shortest_match(target, tokens))
+    self.assertEqual(labels._find_earliest_shortest_match('f(((x)', ['(', 'x', ')']),
+                     (3, 6))
+
   def test_logs_and_returns_arg(self):
     with mock.patch('logging.info') as mock_log_fn:
       qj.LOG_FN = mock_log_fn
@@ -304,6 +623,84 @@ class QjTest(unittest.TestCase):
       ], any_order=False)
       self.assertEqual(mock_log_fn.call_count, 2)
 
+  def test_p_does_not_evaluate_properties(self):
+    class Base(object):
+      attr = 1
+
+      @property
+      def expensive(self):
+        raise AssertionError('property evaluated')
+
+      @staticmethod
+      def static(a, b=2):
+        pass
+
+      @classmethod
+      def klass(cls, q):
+        pass
+
+    class Model(Base):
+      __slots__ = ('slot',)
+
+      def method(self, a, *args, **kwargs):
+        pass
+
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      qj(p=True, x=Model(), s='model')
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(
+              r'qj:\s+Public properties:\n'
+              r'\s+__init__[^\n]*\n'
+              r'\s+attr\n'
+              r'\s+expensive\n'
+              r'\s+klass\(q\)\n'
+              r'\s+method\(a, \*args, \*\*kwargs\)\n'
+              r'\s+slot\n'
+              r'\s+static\(a, b=2\)$')),
+      ], any_order=False)
+
+  def test_p_caches_member_table(self):
+    class Thing(object):
+
+      def method(self, a):
+        pass
+
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      # Python 2 reads signatures with inspect.getargspec.
+      spec_fn = 'signature' if hasattr(inspect, 'signature') else 'getargspec'
+      with mock.patch.object(inspect, spec_fn, wraps=getattr(inspect, spec_fn)) as mock_signature:
+        qj(p=True, x=Thing(), s='thing')
+        self.assertGreater(mock_signature.call_count, 0)
+        mock_signature.reset_mock()
+        for _ in range(2):
+          qj(p=True, x=Thing(), s='thing')
+        mock_signature.assert_not_called()
+      self.assertEqual(mock_log_fn.call_count, 6)
+      thing = Thing()
+      thing.extra = 1
+      qj(p=True, x=thing, s='thing')
+      mock_log_fn.assert_called_with(RegExp(r'\s+extra\n\s+method\(a\)$'))
+
+  def test_p_caches_do_not_keep_classes_alive(self):
+    def log_thing():
+      class Thing(object):
+
+        def method(self, a):
+          pass
+
+      qj(p=True, x=Thing(), s='thing')
+      return weakref.ref(Thing), weakref.ref(Thing.method)
+
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      thing_type, method = log_thing()
+      mock_log_fn.assert_called_with(RegExp(r'\s+method\(a\)$'))
+      gc.collect()
+      self.assertIsNone(thing_type())
+      self.assertIsNone(method())
+
   def test_logs_with_t(self):
     with mock.patch('logging.info') as mock_log_fn:
 
@@ -478,6 +875,114 @@ class QjTest(unittest.TestCase):
       # Running with `$ nosetests` goes down this path.
       self.assertEqual(qj, __builtins__['qj'])
 
+  def _run_python(self, *args):
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+    process = subprocess.Popen((sys.executable,) + args, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    self.assertEqual(process.returncode, 0, err)
+    return out.decode('utf-8'), err.decode('utf-8')
+
+  def test_import_is_lazy_and_side_effect_free(self):
+    out, _ = self._run_python('-c', '\n'.join([
+        'import json, sys',
+        'builtins = sys.modules["builtins" if sys.version_info[0] > 2 else "__builtin__"]',
+        'before = set(sys.modules)',
+        'from qj import qj',
+        'lazy = ("dis", "hashlib", "inspect", "logging", "opcode", "qj.labels")',
+        'imported = sorted(m for m in lazy if m in sys.modules and m not in before)',
+        'import logging',
+        'handlers = len(logging.getLogger().handlers)',
+        'qj(1, "one")',
+        'print(json.dumps([imported, handlers, hasattr(builtins, "qj"),',
+        '                  "qj.labels" in sys.modules,',
+        '                  len(logging.getLogger().handlers)]))']))
+    imported, handlers, made_global, labels_loaded, handlers_after = json.loads(out)
+    # Nothing heavy is imported and logging isn't configured until qj logs.
+    self.assertEqual(imported, [])
+    self.assertEqual(handlers, 0)
+    # python -c isn't an interactive session.
+    self.assertFalse(made_global)
+    # Logging with an explicit label doesn't need label extraction.
+    self.assertFalse(labels_loaded)
+    self.assertEqual(handlers_after, 1)
+
+  def test_notebook_log_writes_in_chunks(self):
+    capture = mock.Mock()
+    capture.start.return_value = True
+    qj.NOTEBOOK_CAPTURE = capture
+    qj.NOTEBOOK_FLUSH_SECONDS = 10
+    write = mock.Mock()
+    log_fn = qj_module._NotebookLog(write)
+    with mock.patch.object(log_fn, '_hook'):
+      for i in range(3):
+        log_fn('log %d' % i)
+      write.assert_not_called()
+      log_fn.flush()
+      write.assert_has_calls([mock.call('log 0'), mock.call('log 1'), mock.call('log 2')])
+      self.assertEqual(capture.start.call_count, 1)
+      self.assertEqual(capture.end.call_count, 1)
+
+      # Buffered logs are flushed shortly after the first of them.
+      qj.NOTEBOOK_FLUSH_SECONDS = 0.01
+      flushed = threading.Event()
+      capture.end.side_effect = lambda: flushed.set()
+      log_fn('log 3')
+      self.assertTrue(flushed.wait(10))
+      write.assert_called_with('log 3')
+      self.assertEqual(capture.start.call_count, 2)
+
+  def test_notebook_log_flushes_before_debugger_and_reraise(self):
+    qj.NOTEBOOK_CAPTURE = qj_module._NullCapture()
+    qj.NOTEBOOK_FLUSH_SECONDS = 10
+    write = mock.Mock()
+    qj.LOG_FN = qj_module._NotebookLog(write)
+    written_at_debug = []
+    qj.DEBUG_FN = lambda frame: written_at_debug.append(write.call_count)
+    with mock.patch.object(qj.LOG_FN, '_hook'):
+      try:
+        qj(1, 'one', d=1)
+        self.assertEqual(written_at_debug, [1])
+
+        @qj(catch=1)
+        def fail():
+          raise ValueError('fail')
+
+        qj.DUMP_DIR = tempfile.mkdtemp()
+        try:
+          with self.assertRaises(ValueError):
+            fail()
+          write.assert_called_with(RegExp(r'Caught an exception in .*post-mortem dump'))
+          self.assertEqual(qj.LOG_FN._buffer, [])
+        finally:
+          shutil.rmtree(qj.DUMP_DIR)
+      finally:
+        qj.DEBUG_FN = None
+
+  def test_notebook_log_flushes_when_full(self):
+    qj.NOTEBOOK_CAPTURE = qj_module._NullCapture()
+    qj.NOTEBOOK_FLUSH_SECONDS = 10
+    write = mock.Mock()
+    log_fn = qj_module._NotebookLog(write)
+    with mock.patch.object(log_fn, '_hook'):
+      for i in range(qj_module._NOTEBOOK_MAX_BUFFERED):
+        log_fn(i)
+      self.assertEqual(write.call_count, qj_module._NOTEBOOK_MAX_BUFFERED)
+      log_fn.flush()
+      self.assertEqual(write.call_count, qj_module._NOTEBOOK_MAX_BUFFERED)
+
+  @unittest.skipIf(sys.version_info < (3, 7), '-X importtime requires Python 3.7+')
+  def test_import_time_budget(self):
+    budget_us = 100000
+    times = []
+    for _ in range(3):
+      _, err = self._run_python('-X', 'importtime', '-c', 'import qj')
+      # The last line is the top level qj package: 'import time: self | cumulative | qj'.
+      times.append(int(err.strip().splitlines()[-1].split('|')[1]))
+    self.assertLess(min(times), budget_us)
+
   def test_multiline(self):
     with mock.patch('logging.info') as mock_log_fn:
       qj.LOG_FN = mock_log_fn
@@ -903,6 +1408,233 @@ class QjTest(unittest.TestCase):
         self.assertEqual(mock_log_fn.call_count, 3)
         self.assertEqual(mock_debug_fn.call_count, 1)
 
+  def test_logs_with_catch_dump(self):
+    dump_dir = tempfile.mkdtemp()
+    try:
+      with mock.patch('logging.info') as mock_log_fn:
+        qj.LOG_FN = mock_log_fn
+        qj.DEBUG_FN = mock.Mock()
+        # The first dump creates the directory, the second finds it.
+        qj.DUMP_DIR = os.path.join(dump_dir, 'dumps')
+        @qj(catch=1)
+        def foo(a, big):
+          b = a * 2
+          raise ValueError('FOO %d' % b)
+        with self.assertRaises(ValueError):
+          foo(3, big=list(range(10000)))
+        qj.DEBUG_FN.assert_not_called()
+        mock_log_fn.assert_called_with(RegExp(
+            r'qj: <qj_test> test_logs_with_catch_dump:  Caught an exception in <function .*foo at 0x.*> '
+            r'\(post-mortem dump: .*qj_dump_\d+_\d+_\d+\.json\) <\d+>: FOO 6'))
+
+        qj.DUMP_RERAISE = False
+        self.assertIsNone(foo(1, big=None))
+
+      paths = sorted(os.listdir(qj.DUMP_DIR))
+      self.assertEqual(len(paths), 2)
+      with open(os.path.join(qj.DUMP_DIR, paths[0])) as f:
+        record = json.load(f)
+      self.assertEqual(record['exception'], 'ValueError')
+      frame = record['frames'][-1]
+      self.assertEqual(frame['function'], 'foo')
+      self.assertEqual(frame['args']['a'], '3')
+      self.assertLess(len(frame['args']['big']), 100)
+      self.assertEqual(frame['locals'], {'b': '6'})
+    finally:
+      shutil.rmtree(dump_dir)
+
+  def test_instrument_class(self):
+    class Adder(object):
+
+      def add(self, a, b=1):
+        return a + b
+
+      @staticmethod
+      def double(a):
+        return a * 2
+
+      @classmethod
+      def name(cls):
+        return cls.__name__
+
+    originals = dict(vars(Adder))
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      self.assertEqual(qj.instrument(Adder, log_calls=0.5),
+                       ['add', 'double', 'name'])
+      adder = Adder()
+      for i in range(3):
+        self.assertEqual(adder.add(i, b=2), i + 2)
+      self.assertEqual(Adder.double(3), 6)
+      self.assertEqual(adder.name(), 'Adder')
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class: calling Adder\.add <\d+>: '
+                           r'Adder\.add\(<.*Adder object at 0x.*>, 0, b=2\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class: returning from Adder\.add <\d+>: 2')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class: calling Adder\.add <\d+>: '
+                           r'Adder\.add\(<.*Adder object at 0x.*>, 2, b=2\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class: returning from Adder\.add <\d+>: 4')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class:  calling Adder\.double <\d+>: '
+                           r'Adder\.double\(3\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class:  returning from Adder\.double <\d+>: 6')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class:   calling Adder\.name <\d+>: '
+                           r'Adder\.name\(<class .*Adder.>\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_class:   returning from Adder\.name <\d+>: Adder')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 8)
+
+      self.assertEqual(qj.uninstrument(Adder), ['add', 'double', 'name'])
+      self.assertEqual(dict(vars(Adder)), originals)
+      self.assertEqual(qj.uninstrument(Adder), [])
+      adder.add(1)
+      self.assertEqual(mock_log_fn.call_count, 8)
+
+  def test_instrument_module(self):
+    module = types.ModuleType('qj_instrumented_module')
+    exec(  # pylint: disable=exec-used
+        'import os\n'
+        'from os.path import join\n'
+        'def square(v):\n'
+        '  return v * v\n'
+        'class Box(object):\n'
+        '  def get(self):\n'
+        '    return 1\n', vars(module))
+    square = module.square
+    get = vars(module.Box)['get']
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      self.assertEqual(qj.instrument(module, time=2), ['Box.get', 'square'])
+      self.assertIsNot(module.square, square)
+      self.assertIs(module.join, os.path.join)
+      for i in range(4):
+        self.assertEqual(module.square(i), i * i)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_module: Average timing for <function square at 0x.*> '
+                           r'across 2 calls <\d+>: \d\.\d\d\d\d seconds')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_module: Average timing for <function square at 0x.*> '
+                           r'across 4 calls <\d+>: \d\.\d\d\d\d seconds')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 2)
+
+      self.assertEqual(qj.uninstrument(module), ['Box.get', 'square'])
+      self.assertIs(module.square, square)
+      self.assertIs(vars(module.Box)['get'], get)
+
+  def test_instrument_module_and_its_class(self):
+    module = types.ModuleType('qj_instrumented_module')
+    exec(  # pylint: disable=exec-used
+        'class Box(object):\n'
+        '  def get(self):\n'
+        '    return 1\n'
+        '  def put(self):\n'
+        '    return 2\n', vars(module))
+    get = vars(module.Box)['get']
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      for first, second in [(module, module.Box), (module.Box, module)]:
+        self.assertEqual(qj.instrument(first, time=2), ['Box.get', 'Box.put']
+                         if first is module else ['get', 'put'])
+        self.assertEqual(qj.instrument(second, time=2), [])
+        self.assertIsNot(vars(module.Box)['get'], get)
+        self.assertEqual(qj.uninstrument(module), ['Box.get', 'Box.put']
+                         if first is module else [])
+        self.assertEqual(qj.uninstrument(module.Box), ['get', 'put']
+                         if first is module.Box else [])
+        self.assertIs(vars(module.Box)['get'], get)
+      self.assertEqual(mock_log_fn.call_count, 0)
+
+  @unittest.skipIf(not hasattr(sys, 'monitoring'), 'sys.monitoring required')
+  def test_logs_with_time_monitoring(self):
+    qj.MONITORING = True
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      def foo():
+        pass
+      timed = qj(foo, 'foo', time=1)
+      self.assertIs(timed, foo)
+      foo()
+      mock_log_fn.assert_has_calls(
+          [
+              mock.call(RegExp(r'qj:\s+Timing calls with sys\.monitoring\.')),
+              mock.call(
+                  RegExp(r'qj: <qj_test> test_logs_with_time_monitoring:  Average timing for <function .*foo at 0x.*> '
+                         r'across 1 call <\d+>: \d\.\d\d\d\d seconds')),
+          ],
+          any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 3)
+
+  @unittest.skipIf(not hasattr(sys, 'monitoring'), 'sys.monitoring required')
+  def test_instrument_monitoring(self):
+    class Adder(object):
+
+      def add(self, a, b=1):
+        return a + b
+
+      @staticmethod
+      def double(a):
+        return a * 2
+
+    originals = dict(vars(Adder))
+    add = Adder.add
+    qj.MONITORING = True
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      self.assertEqual(qj.instrument(Adder, log_calls=1), ['add', 'double'])
+      self.assertEqual(dict(vars(Adder)), originals)
+      self.assertIs(Adder.add, add)
+      self.assertEqual(Adder().add(1, b=2), 3)
+      self.assertEqual(Adder.double(3), 6)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_monitoring: calling Adder\.add <\d+>: '
+                           r'Adder\.add\(self=<.*Adder object at 0x.*>, a=1, b=2\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_monitoring: returning from Adder\.add <\d+>: 3')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_monitoring:  calling Adder\.double <\d+>: '
+                           r'Adder\.double\(a=3\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_instrument_monitoring:  returning from Adder\.double <\d+>: 6')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 4)
+
+      self.assertEqual(qj.uninstrument(Adder), ['add', 'double'])
+      self.assertEqual(sys.monitoring.get_local_events(qj._monitoring_tool, add.__code__), 0)
+      Adder().add(1)
+      self.assertEqual(mock_log_fn.call_count, 4)
+
+  @unittest.skipIf(not hasattr(sys, 'monitoring'), 'sys.monitoring required')
+  def test_instrument_monitoring_drops_calls_that_raise(self):
+    # Keeping the exceptions keeps their frames, so each call has its own id.
+    errors = []
+
+    class Checker(object):
+
+      def check(self, a):
+        if a < 0:
+          raise ValueError(a)
+        for _ in range(a):
+          try:
+            self.check(-1)
+          except ValueError as e:
+            errors.append(e)
+        return a
+
+    qj.MONITORING = True
+    with mock.patch('logging.info') as mock_log_fn, \
+         mock.patch.object(qj_module, '_MAX_RUNNING_CALLS', 4):
+      qj.LOG_FN = mock_log_fn
+      qj.instrument(Checker, time=1)
+      monitored = qj._monitored[Checker.check.__code__]
+      # Nothing is monitored outside of check's code object.
+      self.assertEqual(sys.monitoring.get_events(qj._monitoring_tool), 0)
+      # The outer call survives the drops of the calls that raised inside it.
+      self.assertEqual(Checker().check(20), 20)
+      self.assertLessEqual(len(monitored.running), 4)
+      mock_log_fn.assert_called_once_with(RegExp(
+          r'Average timing for .*check.* across 1 call <\d+>: \d\.\d\d\d\d seconds'))
+      qj.uninstrument(Checker)
+
+  def test_instrument_rejects_other_types(self):
+    with self.assertRaises(TypeError):
+      qj.instrument(len)
+
   def test_logs_with_log_all_calls(self):
     with mock.patch('logging.info') as mock_log_fn:
       qj.LOG_FN = mock_log_fn
@@ -922,6 +1654,506 @@ class QjTest(unittest.TestCase):
           any_order=False)
       self.assertEqual(mock_log_fn.call_count, 4)
 
+  def test_logs_with_log_all_calls_slots(self):
+    class Counter(object):
+      __slots__ = ('count',)
+
+      def __init__(self):
+        self.count = 0
+
+      def add(self, k=1):
+        self.count += k
+        return self.count
+
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      c = qj(Counter(), 'c', log_all_calls=1)
+      c.add(k=2)
+      self.assertEqual(c.count, 2)
+      self.assertIsInstance(c, Counter)
+      mock_log_fn.assert_has_calls(
+          [
+              mock.call(
+                  RegExp(r'qj: <qj_test> test_logs_with_log_all_calls_slots:  calling add <\d+>: add\(k=2\)')),
+              mock.call(
+                  RegExp(r'qj: <qj_test> test_logs_with_log_all_calls_slots:  returning from add <\d+>: 2')),
+          ],
+          any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 4)
+
+  def test_log_all_calls_forwards_special_methods(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      l = [3, 1, 2]
+      l = qj(l, log_all_calls=1)
+      l += [0]
+      l.sort()
+      self.assertEqual(len(l), 4)
+      self.assertEqual(list(l), [0, 1, 2, 3])
+      self.assertEqual(l[1], 1)
+      self.assertEqual(l, [0, 1, 2, 3])
+      self.assertIsInstance(l, list)
+      l.append(4)
+      self.assertEqual(mock_log_fn.call_count, 6)
+      self.assertIs(type(qj(list(), log_all_calls=1)), type(l))
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_n(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      arr = np.arange(10, dtype=np.float32).reshape(2, 5)
+      out = qj(arr, n=1)
+      mock_log_fn.assert_called_once_with(RegExp(
+          r'qj: <qj_test> test_logs_with_n: arr, n=1 \(shape dtype \(min \(mean std\) max\) hist \(nan inf\)\) <\d+>: '
+          r"\(\(2, 5\), 'float32', \(0\.0, \(4\.5, 2\.87\d*\), 9\.0\), array\(\[2, 2, 2, 2, 2\]\), \(0, 0\)\)"))
+      self.assertIs(out, arr)
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_n_nan_inf(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      arr = np.array([1.0, np.nan, 3.0, np.inf, -np.inf, np.nan])
+      qj(arr, n=2)
+      mock_log_fn.assert_called_once_with(RegExp(
+          r"<\d+>: \(\(6,\), 'float64', \(1\.0, \(2\.0, 1\.0\), 3\.0\), array\(\[1, 0, 0, 0, 1\]\), \(2, 2\)\)"))
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_n_strided(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      arr = np.arange(20.0).reshape(4, 5).T[::2]
+      qj(arr, n=1)
+      mock_log_fn.assert_called_once_with(RegExp(
+          r"<\d+>: \(\(3, 4\), 'float64', \(0\.0, \(9\.5, %s\), 19\.0\), array\(\[%s\]\), \(0, 0\)\)" %
+          (re.escape(repr(float(np.std(arr)))), ', '.join(str(c) for c in np.histogram(arr, bins=5)[0]))))
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_n_sampled(self):
+    n_sample_size = qj.N_SAMPLE_SIZE
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      try:
+        qj.N_SAMPLE_SIZE = 10
+        arr = np.arange(100)
+        qj(arr, n=1)
+        mock_log_fn.assert_called_once_with(RegExp(
+            r'arr, n=1 \(shape dtype \(min \(mean std\) max\) hist \(nan inf\), sampled every 10\) <\d+>: '
+            r"\(\(100,\), 'int\d+', \(0, \(45\.0, 28\.72\d*\), 90\)"))
+      finally:
+        qj.N_SAMPLE_SIZE = n_sample_size
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_n_buffer_protocol(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      doubles = array.array('d', [1.0, 2.0, 3.0])
+      qj(doubles, n=1)
+      raw = bytes(bytearray([0, 255, 0, 255]))
+      qj(raw, n=1)
+      view = memoryview(bytearray(range(6))).cast('B', (2, 3))
+      qj(view, n=1)
+      buf = mmap.mmap(-1, 8)
+      try:
+        buf[:8] = bytes(bytearray(range(8)))
+        qj(buf, n=1)
+      finally:
+        buf.close()
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r"doubles, n=1 .*<\d+>: \(\(3,\), 'float64', \(1\.0, \(2\.0, ")),
+          mock.call(RegExp(r"raw, n=1 .*<\d+>: \(\(4,\), 'uint8', \(0, \(127\.5, 127\.5\), 255\)")),
+          mock.call(RegExp(r"view, n=1 .*<\d+>: \(\(2, 3\), 'uint8', \(0, \(2\.5, ")),
+          mock.call(RegExp(r"buf, n=1 .*<\d+>: \(\(8,\), 'uint8', \(0, \(3\.5, ")),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 4)
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_n_not_numeric(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      qj('abc', n=1)
+      mock_log_fn.assert_called_once_with(RegExp(
+          r"qj: <qj_test> test_logs_with_n_not_numeric: 'abc', n=1 <\d+>: abc"))
+
+  def test_logs_with_it(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      def gen():
+        for i in range(5):
+          yield i
+      values = qj(gen(), 'values', it=2, n=1)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_it: values <\d+>: <generator object')),
+          mock.call(RegExp(r'qj:\s+Wrapping return value in iterator logger\.')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 2)
+      self.assertEqual(list(values), [0, 1, 2, 3, 4])
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_it:  values item 1 \([\d.]+ items/sec\) <\d+>: 0')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_it:  values item 2 \([\d.]+ items/sec\) <\d+>: 1')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_it:  values progress <\d+>: 4 items, [\d.]+ items/sec, '
+                           r'\(min \(mean std\) max\): \(0\.0, \(1\.5, 1\.118\d*\), 3\.0\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_it:  values exhausted <\d+>: 5 items, [\d.]+ items/sec, '
+                           r'\(min \(mean std\) max\): \(0\.0, \(2\.0, 1\.414\d*\), 4\.0\)')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 6)
+
+  def test_logs_with_it_close(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      closed = []
+      def gen():
+        try:
+          for i in range(5):
+            yield i
+        finally:
+          closed.append(True)
+      values = qj(gen(), 'values', it=1)
+      self.assertEqual(next(values), 0)
+      self.assertEqual(next(values), 1)
+      values.close()
+      values.close()
+      self.assertEqual(closed, [True])
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'values item 1 \([\d.]+ items/sec\) <\d+>: 0')),
+          mock.call(RegExp(r'values progress <\d+>: 2 items, [\d.]+ items/sec$')),
+          mock.call(RegExp(r'values closed <\d+>: 2 items, [\d.]+ items/sec$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 5)
+
+  def test_no_logs_with_it(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG = False
+      qj.LOG_FN = mock_log_fn
+      values = iter([1, 2])
+      self.assertIs(qj(values, it=1), values)
+      mock_log_fn.assert_not_called()
+
+  def test_shared_state_under_thread_stress(self):
+    threads, calls = 8, 500
+    logs = []
+    qj.LOG_FN = logs.append
+    qj.MAX_FRAME_LOGS = 10**9
+    qj._rate_meters.clear()
+    qj._aggregates.clear()
+
+    def untimed():
+      pass
+    timed = qj(time=10**9)(untimed)
+
+    def hammer():
+      for i in range(calls):
+        timed()
+        qj(i, rate_meter=3600)
+        qj(i, agg=10**9)
+        qj(tic=1)
+        qj(i + 1)
+        qj(toc=1)
+
+    qj._tics = []
+    # Switch threads as often as possible (Python 2 counts instructions).
+    get_interval, set_interval, fastest = (
+        (sys.getswitchinterval, sys.setswitchinterval, 1e-6)
+        if hasattr(sys, 'setswitchinterval')
+        else (sys.getcheckinterval, sys.setcheckinterval, 1))
+    interval = get_interval()
+    set_interval(fastest)
+    try:
+      workers = [threading.Thread(target=hammer) for _ in range(threads)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+    finally:
+      set_interval(interval)
+
+    self.assertEqual(qj._tics, [])
+    self.assertEqual(qj._timings.get(untimed)[0], threads * calls)
+    self.assertEqual([m.total for m in qj._rate_meters.values()], [threads * calls])
+    self.assertEqual([a.values for a in qj._aggregates.values()], [threads * calls])
+    labels = set(m.group(1) for m in (re.match(r'qj: <qj_test> hammer: +(.*) <\d+>: \d+$', log) for log in logs) if m)
+    self.assertEqual(labels, {'i + 1'})
+    self.assertFalse([log for log in logs if 'Unable to compute toc' in log])
+
+  def test_timing_logs_count_calls_from_all_threads(self):
+    logs = []
+    qj.LOG_FN = logs.append
+
+    @qj(time=100)
+    def timed():
+      pass
+
+    def worker():
+      for _ in range(50):
+        timed()
+
+    workers = [threading.Thread(target=worker) for _ in range(8)]
+    for w in workers:
+      w.start()
+    for w in workers:
+      w.join()
+    counts = [int(m.group(1)) for m in (re.search(r'across (\d+) calls', log) for log in logs) if m]
+    self.assertEqual(counts, [100, 200, 300, 400])
+
+  def test_toc_closes_tic_from_another_thread(self):
+    logs = []
+    qj.LOG_FN = logs.append
+    qj._tics = []
+    tic = threading.Thread(target=lambda: qj(tic=1, s='worker'))
+    tic.start()
+    tic.join()
+    qj(toc=1)
+    self.assertEqual(qj._tics, [])
+    self.assertTrue([log for log in logs if re.search(r'seconds since worker\.$', log)])
+
+  def test_logs_with_rate_meter(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      with mock.patch.object(qj_module, '_monotonic') as mock_time, \
+           mock.patch('time.time') as mock_wall_time:
+        for t, wall_t in zip([1000.0, 1000.5, 1001.0, 1001.5, 1002.0, 1012.5],
+                             [50.0, 50.5, 10.0, 10.5, 99999.0, 0.0]):
+          # Steps in the wall clock don't affect the rates.
+          mock_time.return_value = t
+          mock_wall_time.return_value = wall_t
+          qj(t, 'tick', rate_meter=1)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_rate_meter: tick <\d+>: '
+                           r'3\.0/sec over 1s, 3\.0/sec over 10s, 3\.0/sec over 60s \(3 events\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_rate_meter: tick <\d+>: '
+                           r'3\.0/sec over 1s, 2\.5/sec over 10s, 2\.5/sec over 60s \(5 events\)')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_rate_meter: tick <\d+>: '
+                           r'0\.7/sec over 1s, 0\.2/sec over 10s, 0\.5/sec over 60s \(6 events\)')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 3)
+
+  def test_rate_meter_returns_x(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      x = object()
+      self.assertIs(qj(x, rate_meter=60), x)
+      mock_log_fn.assert_not_called()
+
+  def test_logs_with_agg(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      for v in [0, 1, 1.5, 3, -2, -0.5, float('nan'), 'a', 7, 100, 5]:
+        self.assertIs(qj(v, 'depth', agg=5), v)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_agg: depth <\d+>: 5 values, '
+                           r'\(min \(mean std\) max\): \(-2\.0, \(0\.7, 1\.66\d*\), 3\.0\), '
+                           r'hist: \{\(-4, -2\]: 1, 0: 1, \[1, 2\): 2, \[2, 4\): 1\}$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_agg: depth <\d+>: 5 values, '
+                           r'\(min \(mean std\) max\): \(-0\.5, \(35\.5, 45\.7\d*\), 100\.0\), '
+                           r'hist: \{\(-1, -0\.5\]: 1, \[4, 8\): 1, \[64, 128\): 1\}, 1 nan/inf, 1 non-numeric$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 2)
+
+  def test_logs_with_agg_after_timeout(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      with mock.patch.object(qj_module, '_monotonic') as mock_time:
+        for t in [1000.0, 1005.0, 1010.0, 1011.0]:
+          mock_time.return_value = t
+          qj(t - 1000.0, 'latency', agg=1)
+      mock_log_fn.assert_called_once_with(RegExp(
+          r'qj: <qj_test> test_logs_with_agg_after_timeout: latency <\d+>: 3 values, '
+          r'\(min \(mean std\) max\): \(0\.0, \(5\.0, 4\.08\d*\), 10\.0\), '
+          r'hist: \{0: 1, \[4, 8\): 1, \[8, 16\): 1\}$'))
+
+  def test_logs_with_agg_after_agg_seconds(self):
+    qj.AGG_SECONDS = 2.0
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      # Stepping the wall clock back doesn't stretch the window.
+      with mock.patch.object(qj_module, '_monotonic') as mock_time, \
+           mock.patch('time.time') as mock_wall_time:
+        for t in [1000.0, 1001.0, 1002.0, 1003.0, 1004.5]:
+          mock_time.return_value = t
+          mock_wall_time.return_value = 2000.0 - t
+          qj(t - 1000.0, 'latency', agg=1)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'latency <\d+>: 3 values, \(min \(mean std\) max\): \(0\.0, \(1\.0, ')),
+          mock.call(RegExp(r'latency <\d+>: 2 values, \(min \(mean std\) max\): \(3\.0, \(3\.75, ')),
+      ])
+      self.assertEqual(mock_log_fn.call_count, 2)
+
+  def test_logs_with_changed(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      for v in [1, 1, 1, -1, -2, -2, [1], [1], [2]]:
+        self.assertIs(qj(v, changed=1), v)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_changed: v, changed=1 <\d+>: 1$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_changed: v, changed=1 '
+                           r'\(previous value repeated 2 times\) <\d+>: -1$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_changed: v, changed=1 <\d+>: -2$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_changed: v, changed=1 '
+                           r'\(previous value repeated 1 time\) <\d+>: \[1\]$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_changed: v, changed=1 '
+                           r'\(previous value repeated 1 time\) <\d+>: \[2\]$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 5)
+
+  def test_changed_skips_formatting_repeats(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      str_fn = mock.Mock(return_value='formatted')
+      qj.STR_FN = str_fn
+      try:
+        for _ in range(3):
+          qj('polling', changed=1)
+      finally:
+        qj.STR_FN = str
+      self.assertEqual(str_fn.call_count, 1)
+      mock_log_fn.assert_called_once_with(RegExp(r'formatted$'))
+
+  def test_changed_keeps_no_reference_to_values(self):
+    class Key(object):
+
+      def __init__(self, v):
+        self.v = v
+
+      def __hash__(self):
+        return hash(self.v)
+
+      def __eq__(self, other):
+        return self.v == other.v
+
+      def __repr__(self):
+        return 'Key(%r)' % self.v
+
+    def log_key(v):
+      key = Key(v)
+      qj(key, 'key', changed=1)
+      return weakref.ref(key)
+
+    data = b'x' * 10000
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      for v in [1, 1, 2]:
+        self.assertIsNone(log_key(v)())
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'log_key: key <\d+>: Key\(1\)$')),
+          mock.call(RegExp(r'log_key: key \(previous value repeated 1 time\) <\d+>: Key\(2\)$')),
+      ], any_order=False)
+    # Bytes are compared by a digest of their contents, like other buffers.
+    fingerprint = qj_module._fingerprint(data)
+    self.assertFalse([part for part in fingerprint if part is data])
+    self.assertEqual(qj_module._fingerprint(bytes(bytearray(data))), fingerprint)
+    self.assertNotEqual(qj_module._fingerprint(data[:-1] + b'y'), fingerprint)
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_changed_array(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      a = np.zeros(6)
+      for i in range(4):
+        if i == 2:
+          a[2] = 1
+        qj(a[::2], 'a', changed=1)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'a <\d+>: \[0\. 0\. 0\.\]$')),
+          mock.call(RegExp(r'a \(previous value repeated 1 time\) <\d+>: \[0\. 1\. 0\.\]$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 2)
+
+  def test_logs_with_diff(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      d = {'a': 1, 'b': 2}
+      l = [1, 2, 3, 4, 5]
+      for i in range(3):
+        qj(d, 'd', diff=1)
+        qj(l, 'l', diff=1)
+        d['c%d' % i] = i
+        d.pop('a', None)
+        d['b'] = i
+        if i:
+          del l[-2:]
+        else:
+          l[1:3] = [7, 8, 9]
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_diff: d <\d+>: dict with 2 items \(first snapshot\)$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_diff:  l <\d+>: list with 5 items \(first snapshot\)$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_diff: d <\d+>: '
+                           r"added \{'c0': 0\}, removed \['a'\], changed \{'b': 0\}$")),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_diff:  l <\d+>: len 5 -> 6, \[1:6\] = \[7, 8, 9, 4, 5\]$')),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_diff: d <\d+>: '
+                           r"added \{'c1': 1\}, changed \{'b': 1\}$")),
+          mock.call(RegExp(r'qj: <qj_test> test_logs_with_diff:  l <\d+>: len 6 -> 4, \[4:6\] removed$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 6)
+
+  def test_logs_with_diff_no_changes(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      for _ in range(2):
+        qj({1, 2}, 's', diff=1)
+        qj(3, 'x', diff=1)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r's <\d+>: set with 2 items \(first snapshot\)$')),
+          mock.call(RegExp(r'x <\d+>: 3$')),
+          mock.call(RegExp(r's <\d+>: no changes$')),
+          mock.call(RegExp(r'x <\d+>: no changes$')),
+      ], any_order=False)
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_diff_array(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      a = np.zeros((10, 10))
+      a[0, 0] = np.nan
+      for _ in range(2):
+        qj(a, 'a', diff=1)
+        a[3, 4:6] += 1.5
+        a[7, 1] = np.nan
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'a <\d+>: \(10, 10\) float64 \(first snapshot\)$')),
+          mock.call(RegExp(r'a <\d+>: 3 of 100 elements changed in flat indices \[34:72\], '
+                           r'max abs change 1\.5$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 2)
+
+  @unittest.skipIf(np is None, 'numpy required')
+  def test_logs_with_diff_large_array(self):
+    with mock.patch('logging.info') as mock_log_fn, \
+         mock.patch.object(qj_module, '_DIFF_CHUNK_SIZE', 10), \
+         mock.patch.object(qj_module, '_DIFF_EXACT_SIZE', 50):
+      qj.LOG_FN = mock_log_fn
+      a = np.zeros((20, 10))
+      t = a[:, ::2]
+      for i in range(2):
+        qj(a, 'a', diff=1)
+        qj(t, 't', diff=1)
+        a[0, 3] = a[1, 2] = a[5, 4] = a[19, 9] = i + 1
+      snapshot = qj_module._diff_snapshot(a)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r'a <\d+>: \(20, 10\) float64 \(first snapshot\)$')),
+          mock.call(RegExp(r't <\d+>: \(20, 5\) float64 \(first snapshot\)$')),
+          mock.call(RegExp(r'a <\d+>: 4 of 20 chunks of 10 elements changed in flat '
+                           r'indices \[0:20\], \[50:60\], \[190:200\]$')),
+          mock.call(RegExp(r't <\d+>: 2 of 10 chunks of 10 elements changed in flat '
+                           r'indices \[0:10\], \[20:30\]$')),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 4)
+      self.assertIsNone(snapshot[1][2])
+      self.assertEqual(len(snapshot[1][3]), 20)
+
+  def test_logs_with_diff_set(self):
+    with mock.patch('logging.info') as mock_log_fn:
+      qj.LOG_FN = mock_log_fn
+      s = {1, 'a'}
+      for i in range(2):
+        qj(s, 's', diff=1)
+        s.discard('a')
+        s.add(i + 2)
+      mock_log_fn.assert_has_calls([
+          mock.call(RegExp(r's <\d+>: set with 2 items \(first snapshot\)$')),
+          mock.call(RegExp(r"s <\d+>: added \{2\}, removed \{'a'\}$")),
+      ], any_order=False)
+      self.assertEqual(mock_log_fn.call_count, 2)
+      self.assertFalse(any(v in s for v in qj_module._diff_snapshot(s)[1].values()))
+
   def test_logs_no_s_empty(self):
     def empty():
       qj()
@@ -0,0 +1,69 @@
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+
+import unittest
+
+from qj import bench_labels
+
+
+@unittest.skipIf(sys.version_info[0] < 3, 'Python 3+ required')
+class BenchLabelsTest(unittest.TestCase):
+
+  def test_corpus_size(self):
+    names = [name for name, _, _ in bench_labels.corpus()]
+    self.assertGreater(len(names), 300)
+    self.assertEqual(len(names), len(set(names)))
+
+  def test_run_corpus(self):
+    report = bench_labels.run_corpus(r'^(plain_0[0-3]|kwarg_0[0-3]|multiline_args|empty)$', repeat=1)
+    self.assertEqual(report['total'], 10)
+    if sys.version_info[:2] <= (3, 11):
+      # Labels on 3.12 and higher are often wrong, but are still extracted.
+      self.assertEqual(report['matched'], 10)
+    for result in report['results'].values():
+      self.assertGreater(result['ns'], 0)
+
+  def test_corpus_extraction_never_raises(self):
+    # Ops missing from the stack effect tables used to unbalance the stack
+    # model on 3.12, e.g. for dict comprehensions that are inlined there.
+    report = bench_labels.run_corpus(r'_38$|dict_comp_closure', repeat=1)
+    self.assertEqual(report['total'], 8)
+    for name, result in report['results'].items():
+      self.assertNotIn('error', result, name)
+
+  def test_compare_flags_broken_labels(self):
+    baseline = {'results': {'a': {'match': True, 'label': 'x', 'ns': 100.0},
+                            'b': {'match': True, 'label': 'x', 'ns': 100.0},
+                            'c': {'match': False, 'label': '', 'ns': 100.0},
+                            'd': {'match': False, 'label': '', 'ns': 100.0}}}
+    current = {'results': {'a': {'match': True, 'label': 'x', 'ns': 100.0},
+                           'b': {'match': False, 'label': 'y', 'ns': 100.0},
+                           'c': {'match': False, 'label': '', 'ns': 400.0},
+                           'd': {'match': False, 'label': 'x) def f(', 'ns': 100.0}}}
+    broken, changed, ratio, slower = bench_labels.compare(baseline, current)
+    self.assertEqual(broken, ['b'])
+    self.assertEqual(changed, ['d'])
+    self.assertEqual(ratio, 7.0 / 4.0)
+    self.assertTrue(slower)
+
+
+if __name__ == '__main__':
+  unittest.main()